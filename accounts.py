@@ -0,0 +1,190 @@
+# accounts.py
+"""
+Multi-mailbox configuration and the concurrent sync scheduler.
+
+Mailboxes are listed in a JSON file (ACCOUNTS_FILE, default accounts.json):
+
+    [
+        {"id": "sales", "email": "sales@example.com", "username": "DOMAIN\\\\svc",
+         "password_env": "SALES_PASSWORD", "server": "mail.example.com",
+         "folders": ["inbox", "sent"], "days": 7,
+         "max_messages": 500, "min_interval": 300}
+    ]
+
+"password" may be given inline instead of "password_env". Without the file
+the single EXCHANGE_* mailbox from .env is synced as account "default", the
+id legacy rows are assigned to.
+
+Every account has its own throttling budget: at most max_messages stored
+per sync run, and at least min_interval seconds between runs. The scheduler
+syncs due accounts concurrently, one worker thread per account.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ingestion import connect_account, get_time_frame, iter_folder_messages, load_settings, store_messages
+from models import DEFAULT_ACCOUNT_ID
+from throttle import get_throttle
+
+ACCOUNTS_FILE = os.getenv('ACCOUNTS_FILE', 'accounts.json')
+SYNC_WORKERS = int(os.getenv('SYNC_WORKERS', '4'))
+DEFAULT_FOLDERS = ('sent', 'inbox')
+
+
+class AccountConfig:
+    """One mailbox to sync, with its throttling budget."""
+
+    def __init__(self, account_id, email, username, password, server, days=None,
+                 folders=DEFAULT_FOLDERS, max_messages=None, min_interval=0):
+        self.account_id = account_id
+        self.email = email
+        self.username = username
+        self.password = password
+        self.server = server
+        self.days = days
+        self.folders = tuple(folders)
+        self.max_messages = max_messages
+        self.min_interval = min_interval
+
+    def __repr__(self):
+        return f"AccountConfig({self.account_id!r}, {self.email!r})"
+
+
+def parse_account(entry):
+    password = entry.get('password')
+    if password is None and entry.get('password_env'):
+        password = os.getenv(entry['password_env'])
+    if not all([entry.get('id'), entry.get('email'), entry.get('username'), password, entry.get('server')]):
+        raise ValueError(f"Account entry {entry.get('id') or entry.get('email')!r} is incomplete")
+    return AccountConfig(
+        entry['id'],
+        entry['email'],
+        entry['username'],
+        password,
+        entry['server'],
+        days=entry.get('days'),
+        folders=entry.get('folders', DEFAULT_FOLDERS),
+        max_messages=entry.get('max_messages'),
+        min_interval=entry.get('min_interval', 0),
+    )
+
+
+def load_accounts(path=ACCOUNTS_FILE, settings=None):
+    """Accounts from the JSON file, or the single .env mailbox when there is none."""
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as handle:
+            accounts = [parse_account(entry) for entry in json.load(handle)]
+        ids = [account.account_id for account in accounts]
+        if len(set(ids)) != len(ids):
+            raise ValueError(f"Duplicate account ids in {path}")
+        return accounts
+
+    settings = settings or load_settings()
+    return [AccountConfig(
+        DEFAULT_ACCOUNT_ID,
+        settings['EXCHANGE_EMAIL'],
+        settings['EXCHANGE_DOMAIN_USERNAME'],
+        settings['EXCHANGE_PASSWORD'],
+        settings['EXCHANGE_SERVER'],
+        days=settings['DAYS_AGO'],
+    )]
+
+
+def iter_account_messages(account, config, time_frame, throttle=None):
+    for folder_name in config.folders:
+        logging.info(f"[{config.account_id}] Processing {folder_name} emails...")
+        # Looking the folder up is an EWS call (GetFolder) too.
+        folder = throttle.call(getattr, account, folder_name) if throttle else getattr(account, folder_name)
+        yield from iter_folder_messages(folder, time_frame, throttle=throttle)
+
+
+def sync_account(config, session_factory, timezone_name, default_days=1, connect=connect_account):
+    """Store new messages from one mailbox; returns the number created.
+
+    Stops after config.max_messages new messages; the rest are picked up
+    by the next run. Every EWS call goes through the account's throttle.
+    session_factory() is only entered to write a batch that has already
+    been fetched, never across EWS calls or throttle back-offs, so
+    concurrent syncs can share a single writer connection.
+    """
+    throttle = get_throttle(config.account_id)
+    account = throttle.call(connect, config.email, config.username, config.password, config.server)
+    time_frame = get_time_frame(timezone_name, config.days or default_days)
+    messages = iter_account_messages(account, config, time_frame, throttle)
+    return store_messages(messages, session_factory, account_id=config.account_id, limit=config.max_messages)
+
+
+class AccountScheduler:
+    """Run sync_one(config) for every due account, concurrently."""
+
+    def __init__(self, accounts, sync_one, max_workers=SYNC_WORKERS, clock=time.monotonic):
+        self.accounts = list(accounts)
+        self.sync_one = sync_one
+        self.max_workers = max_workers
+        self.clock = clock
+        self._last_started = {}
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def due(self):
+        now = self.clock()
+        with self._lock:
+            return [
+                account for account in self.accounts
+                if account.account_id not in self._running
+                and now - self._last_started.get(account.account_id, float('-inf')) >= account.min_interval
+            ]
+
+    def _run(self, account):
+        try:
+            return {'created': self.sync_one(account)}
+        except Exception as e:
+            logging.error(f"Sync of account {account.account_id} failed: {str(e)}")
+            return {'error': str(e)}
+        finally:
+            with self._lock:
+                self._running.discard(account.account_id)
+
+    def run_once(self):
+        """Sync every due account; returns {account_id: {'created': n} or {'error': msg}}.
+
+        Accounts still inside their min_interval are reported as skipped.
+        """
+        due = self.due()
+        with self._lock:
+            for account in due:
+                self._running.add(account.account_id)
+                self._last_started[account.account_id] = self.clock()
+
+        results = {account.account_id: {'skipped': True} for account in self.accounts}
+        if due:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(due)),
+                                    thread_name_prefix='account-sync') as pool:
+                for account, result in zip(due, pool.map(self._run, due)):
+                    results[account.account_id] = result
+        return results
+
+    def run_account(self, account_id):
+        """Sync one account now, whatever its min_interval; returns its result.
+
+        Reported as skipped if a sync of it is already running.
+        """
+        account = next((account for account in self.accounts if account.account_id == account_id), None)
+        if account is None:
+            return {'error': f"Unknown account {account_id}"}
+        with self._lock:
+            if account_id in self._running:
+                return {'skipped': True}
+            self._running.add(account_id)
+            self._last_started[account_id] = self.clock()
+        return self._run(account)
+
+    def run_forever(self, interval, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            self.run_once()
+            stop_event.wait(interval)
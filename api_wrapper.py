@@ -17,14 +17,13 @@ def ensure_json_response(f):
             
             # If it's already a Response, ensure it's JSON
             if isinstance(result, Response):
-                # Check if it has the correct content type
-                if not result.headers.get('Content-Type', '').startswith('application/json'):
-                    # Extract data and convert to proper JSON response
-                    data = result.get_data(as_text=True)
-                    logging.warning(f"Non-JSON response detected, converting: {data[:100]}...")
-                    return jsonify({"success": False, "message": "Non-JSON response detected", "data": data[:500]})
-                return result
-                
+                # Judge by mimetype; streamed bodies (NDJSON, downloads) are never read back
+                if result.is_json or result.is_streamed:
+                    return result
+                data = result.get_data(as_text=True)
+                logging.warning(f"Non-JSON response detected, converting: {data[:100]}...")
+                return jsonify({"success": False, "message": "Non-JSON response detected", "data": data[:500]})
+
             # If it's a tuple (data, status_code), handle it
             elif isinstance(result, tuple) and len(result) == 2:
                 data, status_code = result
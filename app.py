@@ -1,90 +1,112 @@
 # app.py    
 import io
+import json
 import logging
+import operator
 import os
 import re
 import threading
-import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from datetime import datetime, timedelta
-from html import escape
+from datetime import datetime
 from json.decoder import JSONDecodeError
 from pathlib import Path
 
 import pytz
-from dotenv import load_dotenv
-from exchangelib import Account, Configuration, Credentials, DELEGATE, FileAttachment, ItemAttachment, Message
-from exchangelib.errors import ErrorTooManyObjectsOpened
 from flask import (
     Flask,
+    Response,
     abort,
+    has_app_context,
     jsonify,
+    redirect,
     render_template,
     request,
     send_file,
 )
 from werkzeug.exceptions import HTTPException
 from sqlalchemy import (
-    Column,
-    DateTime,
-    ForeignKey,
-    Integer,
-    LargeBinary,
-    String,
-    Text,
+    bindparam,
     create_engine,
+    event,
+    func,
     inspect,
     or_,
+    select,
     text,
 )
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import (
-    declarative_base,
-    relationship,
+    Session,
     scoped_session,
-    selectinload,
     sessionmaker,
 )
+from sqlalchemy.pool import QueuePool
 from waitress import serve
 
 from api_wrapper import ensure_json_response, json_response
+from cache import ResultCache, create_cache
+from compression import response_compressor
+from ingestion import format_datetime as ingestion_format_datetime
+from ingestion import (
+    RENDER_CHUNK_SIZE,
+    RENDER_WORKERS,
+    SETTINGS_CACHE,
+    DatabaseSink,
+    EmlZipSink,
+    ExportMessage,
+    MboxSink,
+    MessageData,
+    ZipSink,
+    RenderRow,
+    ZipStream,
+    build_email_html,
+    connect_account,
+    get_time_frame,
+    get_timezone,
+    ingest,
+    iter_folder_messages,
+    iter_rendered_chunks,
+    load_settings,
+    normalize_content_id,
+    rewrite_cid_urls,
+    zip_entry_name,
+)
+from accounts import AccountScheduler, load_accounts, sync_account
+from models import (
+    DEFAULT_ACCOUNT_ID,
+    Attachment,
+    AttachmentPreview,
+    AttachmentText,
+    Base,
+    Email,
+    ExportRun,
+    read_counter,
+)
+from profiling import admin_required, request_profiler
+from retention import ARCHIVE_DIR, get_archived_email, search_archives
+from suggest import PrefixIndex
+from throttle import get_throttle, throttle_metrics
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Get environment variables with validation
-def get_env_var(var_name):
-    # Get the absolute path of the .env file
-    env_path = Path(__file__).resolve().parent / '.env'
-    # logger.debug(f"Loading .env file from: {env_path}")
-    
-    # Force reload of .env file
-    load_dotenv(env_path, override=True)
-    
-    value = os.getenv(var_name)
-    logger.debug(f"Variable {var_name} = {value}")
-    
-    if value is None:
-        raise ValueError(f"Missing environment variable: {var_name}")
-    return value.strip("'\"")  # Remove any quotes
-
+# The .env file is read once; every setting comes from that single load.
 try:
-    logger.debug("Starting environment variable loading...")
-    EXCHANGE_EMAIL = get_env_var('EXCHANGE_EMAIL')
-    EXCHANGE_DOMAIN_USERNAME = get_env_var('EXCHANGE_DOMAIN_USERNAME')
-    EXCHANGE_PASSWORD = get_env_var('EXCHANGE_PASSWORD')
-    EXCHANGE_SERVER = get_env_var('EXCHANGE_SERVER')
-    EXCHANGE_VERSION = get_env_var('EXCHANGE_VERSION')
-    OUTPUT_DIR = get_env_var('OUTPUT_DIR')
-    TIMEZONE = get_env_var('TIMEZONE')
-    DAYS_AGO = int(get_env_var('DAYS_AGO'))
-    logger.debug("Finished loading environment variables")
+    SETTINGS = load_settings()
 except ValueError as e:
     logger.error(f"Environment configuration error: {str(e)}")
     raise
 
-# Ensure output directory exists
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+EXCHANGE_EMAIL = SETTINGS['EXCHANGE_EMAIL']
+EXCHANGE_DOMAIN_USERNAME = SETTINGS['EXCHANGE_DOMAIN_USERNAME']
+EXCHANGE_PASSWORD = SETTINGS['EXCHANGE_PASSWORD']
+EXCHANGE_SERVER = SETTINGS['EXCHANGE_SERVER']
+EXCHANGE_VERSION = SETTINGS['EXCHANGE_VERSION']
+OUTPUT_DIR = SETTINGS['OUTPUT_DIR']
+TIMEZONE = SETTINGS['TIMEZONE']
+DAYS_AGO = SETTINGS['DAYS_AGO']
 
 # Database setup
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///emails.db')
@@ -95,46 +117,251 @@ connect_args = {}
 if DATABASE_URL.startswith('postgresql://') and 'sslmode=' not in DATABASE_URL:
     connect_args['sslmode'] = os.getenv('DATABASE_SSLMODE', 'require')
 
-engine_kwargs = {'pool_pre_ping': True}
-if connect_args:
-    engine_kwargs['connect_args'] = connect_args
-
-engine = create_engine(DATABASE_URL, **engine_kwargs)
+# SQLite tuning applied to every new DBAPI connection. WAL lets readers keep
+# working while an ingest holds the write lock.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-64000')),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000')),
+}
+SQLITE_WRITER_TIMEOUT = int(os.getenv('SQLITE_WRITER_TIMEOUT', '30'))
+
+
+def is_file_sqlite_url(database_url):
+    """Return True for SQLite URLs that point at a file rather than memory."""
+    if not database_url.startswith('sqlite'):
+        return False
+    database = make_url(database_url).database
+    return bool(database) and database != ':memory:' and not database.startswith('file::memory:')
+
+
+def configure_sqlite_engine(target_engine, pragmas=None):
+    """Apply the tuned SQLite profile on every new connection."""
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+
+    @event.listens_for(target_engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+        # pysqlite issues BEGIN lazily, before the first write, so a SAVEPOINT
+        # could open (and its RELEASE commit) the outer transaction. SQLAlchemy
+        # emits BEGIN itself instead, as its SQLite documentation recommends.
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(target_engine, 'begin')
+    def begin_transaction(connection):
+        # On the raw connection, like pysqlite's own BEGIN, so it stays out of
+        # the statement timings and profiles.
+        connection.connection.driver_connection.execute('BEGIN')
+
+    return target_engine
+
+
+def env_flag(var_name, default):
+    """Read a boolean toggle such as DB_POOL_PRE_PING from the environment."""
+    return os.getenv(var_name, default).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Connection pool sizing for the web tier. The pool defaults to one
+# connection per waitress worker thread so request threads never queue for a
+# connection, with a little overflow for background ingest work.
+WAITRESS_THREADS = int(os.getenv('WAITRESS_THREADS', '4'))
+DB_POOL_SETTINGS = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', str(WAITRESS_THREADS))),
+    'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '2')),
+    'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '30')),
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+    'pool_use_lifo': True,
+}
+DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', 'true')
+DB_QUERY_CACHE_SIZE = int(os.getenv('DB_QUERY_CACHE_SIZE', '1200'))
+
+_pool_stats_lock = threading.Lock()
+pool_stats = {}
+
+
+def instrument_pool(target_engine, name):
+    """Count pool connects, checkouts, checkins and invalidations for an engine."""
+    counters = {'connects': 0, 'checkouts': 0, 'checkins': 0, 'invalidations': 0}
+    with _pool_stats_lock:
+        pool_stats[name] = (target_engine, counters)
+
+    def counter(key):
+        def increment(*args):
+            with _pool_stats_lock:
+                counters[key] += 1
+        return increment
+
+    event.listen(target_engine, 'connect', counter('connects'))
+    event.listen(target_engine, 'checkout', counter('checkouts'))
+    event.listen(target_engine, 'checkin', counter('checkins'))
+    event.listen(target_engine, 'invalidate', counter('invalidations'))
+    return target_engine
+
+
+def get_pool_metrics():
+    """Snapshot pool occupancy and event counters for every instrumented engine."""
+    metrics = {}
+    with _pool_stats_lock:
+        for name, (target_engine, counters) in pool_stats.items():
+            pool = target_engine.pool
+            snapshot = dict(counters)
+            snapshot['pool_class'] = type(pool).__name__
+            for attribute in ('size', 'checkedin', 'checkedout', 'overflow'):
+                method = getattr(pool, attribute, None)
+                if callable(method):
+                    snapshot[attribute] = method()
+            metrics[name] = snapshot
+    return metrics
+
+
+def create_database_engines(database_url, **extra_kwargs):
+    """Build the read engine and the engine used for writes.
+
+    File-backed SQLite databases get the tuned profile and a dedicated writer
+    engine limited to one connection, so ingests are serialized instead of
+    fighting over the database lock. Other backends share a single engine
+    sized from DB_POOL_SETTINGS.
+    """
+    kwargs = {'pool_pre_ping': DB_POOL_PRE_PING, 'query_cache_size': DB_QUERY_CACHE_SIZE}
+    if connect_args:
+        kwargs['connect_args'] = connect_args
+    if not database_url.startswith('sqlite') or is_file_sqlite_url(database_url):
+        kwargs.update(DB_POOL_SETTINGS)
+    kwargs.update(extra_kwargs)
+
+    if not is_file_sqlite_url(database_url):
+        read_engine = create_engine(database_url, **kwargs)
+        return read_engine, read_engine
+
+    kwargs.setdefault('connect_args', {})
+    kwargs['connect_args'] = {**kwargs['connect_args'], 'check_same_thread': False}
+    read_engine = configure_sqlite_engine(create_engine(database_url, **kwargs))
+    writer_kwargs = {
+        **kwargs,
+        'poolclass': QueuePool,
+        'pool_size': 1,
+        'max_overflow': 0,
+        'pool_timeout': SQLITE_WRITER_TIMEOUT,
+    }
+    write_engine = configure_sqlite_engine(create_engine(database_url, **writer_kwargs))
+    return read_engine, write_engine
+
+
+engine, writer_engine = create_database_engines(DATABASE_URL)
+instrument_pool(engine, 'read')
+if writer_engine is not engine:
+    instrument_pool(writer_engine, 'write')
 SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False))
-Base = declarative_base()
-
-
-def utcnow():
-    return datetime.now(pytz.UTC)
-
-
-class Email(Base):
-    __tablename__ = 'emails'
-
-    id = Column(Integer, primary_key=True)
-    message_id = Column(String(255), unique=True, index=True)
-    subject = Column(Text)
-    sender = Column(String(255))
-    recipients = Column(Text)
-    datetime_received = Column(DateTime(timezone=True))
-    body = Column(Text)
-    created_at = Column(DateTime(timezone=True), default=utcnow)
-
-    attachments = relationship('Attachment', back_populates='email', cascade='all, delete-orphan')
-
-
-class Attachment(Base):
-    __tablename__ = 'attachments'
-
-    id = Column(Integer, primary_key=True)
-    email_id = Column(Integer, ForeignKey('emails.id', ondelete='CASCADE'), index=True)
-    filename = Column(Text)
-    content_type = Column(String(255))
-    data = Column(LargeBinary)
-    size = Column(Integer)
-    created_at = Column(DateTime(timezone=True), default=utcnow)
+WriterSessionLocal = scoped_session(
+    sessionmaker(bind=writer_engine, autoflush=False, autocommit=False, expire_on_commit=False)
+)
+# Hot-path statements are built once so SQLAlchemy's compiled cache is hit on
+# every request instead of rebuilding the statement tree each time.
+RECENT_EMAILS_STMT = (
+    select(
+        Email.id,
+        Email.subject,
+        Email.sender,
+        Email.datetime_received,
+        Email.attachment_count,
+        Email.attachment_total_bytes,
+    )
+    .order_by(Email.datetime_received.desc())
+    .limit(100)
+)
+ATTACHMENT_TEXT_MATCH = (
+    select(Attachment.email_id)
+    .join(AttachmentText, AttachmentText.content_hash == Attachment.content_hash)
+    .where(AttachmentText.text.ilike(bindparam('pattern')))
+)
+SEARCH_EMAILS_STMT = (
+    select(Email)
+    .where(
+        or_(
+            Email.subject.ilike(bindparam('pattern')),
+            Email.sender.ilike(bindparam('pattern')),
+            Email.recipients.ilike(bindparam('pattern')),
+            Email.body.ilike(bindparam('pattern')),
+            Email.id.in_(ATTACHMENT_TEXT_MATCH),
+        )
+    )
+    .order_by(Email.datetime_received.desc())
+)
+VIEW_EMAIL_STMT = select(Email).where(Email.id == bindparam('email_id'))
+LIST_ATTACHMENTS_STMT = (
+    select(
+        Attachment.id,
+        Attachment.filename,
+        func.coalesce(Attachment.size, func.length(Attachment.data)).label('size'),
+        Attachment.content_hash,
+        AttachmentPreview.kind.label('preview_kind'),
+    )
+    .outerjoin(AttachmentPreview, AttachmentPreview.content_hash == Attachment.content_hash)
+    .where(Attachment.email_id == bindparam('email_id'))
+    .order_by(Attachment.id)
+)
+PREVIEW_STMT = (
+    select(AttachmentPreview.kind, AttachmentPreview.content_type, AttachmentPreview.data)
+    .where(AttachmentPreview.content_hash == bindparam('content_hash'))
+)
+CONTENT_HASH_RE = re.compile(r'[0-9a-f]{64}')
+CID_ATTACHMENTS_STMT = select(Attachment.id, Attachment.content_id, Attachment.content_hash).where(
+    Attachment.email_id == bindparam('email_id'),
+    Attachment.content_id.isnot(None),
+)
 
-    email = relationship('Email', back_populates='attachments')
+# Inline URLs name the content hash, so the browser can cache inline images
+# for as long as it likes.
+INLINE_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+# memory:// (default), redis://host:6379/0 or sqlite:///path/to/cache.db.
+# Redis lets every waitress process share one cache.
+CACHE_URL = os.getenv('CACHE_URL', 'memory://')
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '1024'))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '3600'))
+VIEW_CACHE_TTL = int(os.getenv('VIEW_CACHE_TTL', str(24 * 60 * 60)))
+
+SUGGEST_MAX_TERMS = int(os.getenv('SUGGEST_MAX_TERMS', '1000000'))
+SUGGEST_LIMIT = int(os.getenv('SUGGEST_LIMIT', '10'))
+SUGGEST_SOURCE_STMT = select(Email.sender, Email.recipients, Email.subject).execution_options(yield_per=1000)
+
+
+# Columns added after the first release, as (table, column, SQL default).
+# ensure_database_schema() adds any that a legacy database is missing.
+ADDED_COLUMNS = [
+    ('attachments', 'content_id', None),
+    ('attachments', 'is_inline', 'FALSE'),
+    ('attachments', 'content_hash', None),
+    ('emails', 'folder', None),
+    ('emails', 'attachment_count', None),
+    ('emails', 'attachment_total_bytes', None),
+    ('emails', 'account_id', f"'{DEFAULT_ACCOUNT_ID}'"),
+    ('export_runs', 'last_email_id', None),
+]
+
+
+def backfill_attachment_aggregates(target_engine):
+    """Compute attachment_count/attachment_total_bytes for emails that lack them."""
+    with target_engine.begin() as connection:
+        result = connection.execute(text(
+            "UPDATE emails SET "
+            "attachment_count = (SELECT COUNT(*) FROM attachments WHERE attachments.email_id = emails.id), "
+            "attachment_total_bytes = (SELECT COALESCE(SUM(COALESCE(attachments.size, LENGTH(attachments.data))), 0) "
+            "FROM attachments WHERE attachments.email_id = emails.id) "
+            "WHERE attachment_count IS NULL OR attachment_total_bytes IS NULL"
+        ))
+    if result.rowcount:
+        logging.info(f"Backfilled attachment aggregates for {result.rowcount} emails")
+    return result.rowcount
 
 
 def ensure_database_schema(target_engine):
@@ -195,8 +422,53 @@ def ensure_database_schema(target_engine):
                     )
                 )
 
+    def ensure_column(table_name, column_name, default_sql=None):
+        if table_name not in inspector.get_table_names():
+            return
+
+        columns = {column['name'] for column in inspector.get_columns(table_name)}
+        if column_name in columns:
+            return
+
+        column = Base.metadata.tables[table_name].c[column_name]
+        column_type = column.type.compile(dialect=target_engine.dialect)
+        statement = f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"
+        if default_sql is not None:
+            statement += f" DEFAULT {default_sql}"
+        with target_engine.begin() as connection:
+            connection.execute(text(statement))
+
     ensure_created_at('emails')
     ensure_created_at('attachments')
+    for table_name, column_name, default_sql in ADDED_COLUMNS:
+        ensure_column(table_name, column_name, default_sql)
+
+    # message_id used to be unique on its own; it is now unique per account.
+    inspector = inspect(target_engine)
+    if 'emails' in inspector.get_table_names():
+        for index in inspector.get_indexes('emails'):
+            if index['unique'] and index['column_names'] == ['message_id']:
+                with target_engine.begin() as connection:
+                    connection.execute(text(f"DROP INDEX {index['name']}"))
+
+    # Indexes declared on added columns are not created by create_all() for
+    # tables that already existed.
+    inspector = inspect(target_engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if all(column.name in columns for column in index.columns):
+                index.create(bind=target_engine, checkfirst=True)
+
+    if {'emails', 'attachments'} <= existing_tables:
+        email_columns = {column['name'] for column in inspector.get_columns('emails')}
+        attachment_columns = {column['name'] for column in inspector.get_columns('attachments')}
+        if {'attachment_count', 'attachment_total_bytes'} <= email_columns and \
+                {'email_id', 'size', 'data'} <= attachment_columns:
+            backfill_attachment_aggregates(target_engine)
 
 
 _db_init_lock = threading.Lock()
@@ -215,20 +487,19 @@ def initialize_database(force: bool = False):
         if _db_initialized and not force:
             return
 
-        with engine.begin() as connection:
+        with writer_engine.begin() as connection:
             Base.metadata.create_all(bind=connection)
 
-        ensure_database_schema(engine)
+        ensure_database_schema(writer_engine)
         _db_initialized = True
 
 
-initialize_database()
-
-
 @contextmanager
-def session_scope():
+def session_scope(write=False):
+    """Provide a transactional session; pass write=True for ingest work."""
     initialize_database()
-    session = SessionLocal()
+    registry = WriterSessionLocal if write else SessionLocal
+    session = registry()
     try:
         yield session
         session.commit()
@@ -237,10 +508,22 @@ def session_scope():
         raise
     finally:
         session.close()
-        SessionLocal.remove()
+        # Requests discard their sessions once, in remove_sessions(). CLI,
+        # scheduler and background threads have no teardown, so theirs go now.
+        if not has_app_context():
+            registry.remove()
 
 
 app = Flask(__name__, static_folder='static')
+request_profiler.install(app, [engine, writer_engine])
+response_compressor.install(app)
+
+
+@app.teardown_appcontext
+def remove_sessions(exception=None):
+    SessionLocal.remove()
+    WriterSessionLocal.remove()
+
 
 @app.errorhandler(Exception)
 def handle_exception(e):
@@ -252,203 +535,111 @@ def handle_exception(e):
         "error": type(e).__name__
     }), code
 
-def sanitize_filename(filename):
-    """Sanitize the filename by removing or replacing invalid characters."""
-    invalid_chars = r'[<>:"/\\|?*\x00-\x1f]'
-    filename = re.sub(invalid_chars, '_', filename or '')
-    filename = filename.rstrip('. ')
-    if not filename:
-        filename = 'unnamed'
-    if len(filename) > 245:
-        filename = filename[:245]
-    return filename
-
-
-def build_email_html(email_record):
-    """Create an HTML representation of an email stored in the database."""
-    subject = email_record.subject or 'No Subject'
-    received = email_record.datetime_received.isoformat() if email_record.datetime_received else 'Unknown'
-    sender = email_record.sender or 'Unknown Sender'
-    recipients = email_record.recipients or 'Unknown'
-    body = email_record.body or ''
+def process_email(account, email_folder, session, time_frame, account_id=DEFAULT_ACCOUNT_ID):
+    """Process emails in the specified folder and persist them to the database."""
+    with DatabaseSink(session, account_id=account_id) as sink:
+        messages = iter_folder_messages(email_folder, time_frame, throttle=get_throttle(account_id))
+        yield from ingest(messages, [sink])
 
-    if body.strip():
-        if re.search(r'<[^>]+>', body):
-            body_html = body
-        else:
-            body_html = f"<pre>{escape(body)}</pre>"
-    else:
-        body_html = '<p><em>No body content</em></p>'
-
-    return (
-        "<html><body\n"
-        f"<h1>Subject: {escape(subject)}</h1>\n"
-        f"<p><strong>Received:</strong> {escape(received)}</p>\n"
-        f"<p><strong>Sender:</strong> {escape(sender)}</p>\n"
-        f"<p><strong>To:</strong> {escape(recipients)}</p>\n"
-        "<p><strong>Body:</strong></p>\n"
-        f"{body_html}\n"
-        "</body></html>\n"
-    )
 
+def process_email_item(item, session, account_id=DEFAULT_ACCOUNT_ID):
+    """Persist a single email item and its attachments."""
+    sink = DatabaseSink(session, account_id=account_id)
+    message = item if isinstance(item, MessageData) else MessageData(item)
+    if sink.contains(message):
+        return False
+    return sink.add(message)
 
 
-def get_message_identifier(item):
-    identifier = getattr(item, 'message_id', None)
-    if identifier:
-        return identifier
-    return getattr(item, 'item_id', None)
+def format_datetime(dt):
+    return ingestion_format_datetime(dt, TIMEZONE)
 
+def setup_exchange_connection():
+    """Setup Exchange connection using environment variables."""
+    if not all([EXCHANGE_EMAIL, EXCHANGE_DOMAIN_USERNAME, EXCHANGE_PASSWORD, EXCHANGE_SERVER, EXCHANGE_VERSION]):
+        logging.error("One or more environment variables are missing.")
+        raise ValueError("Missing environment variables.")
 
-def process_email(account, email_folder, session, time_frame):
-    """Process emails in the specified folder and persist them to the database."""
-    try:
-        queryset = email_folder.filter(datetime_received__gte=time_frame).order_by('-datetime_received')
-        for item in queryset:
-            if isinstance(item, Message):
-                yield process_email_item(item, session)
-    except ErrorTooManyObjectsOpened as e:
-        logging.error(f"Too many objects error: {e}")
+    Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+    account = connect_account(EXCHANGE_EMAIL, EXCHANGE_DOMAIN_USERNAME, EXCHANGE_PASSWORD, EXCHANGE_SERVER)
+    time_frame = get_time_frame(TIMEZONE, DAYS_AGO)
+    return account, OUTPUT_DIR, time_frame
 
 
-def process_email_item(item, session):
-    """Persist a single email item and its attachments."""
-    message_identifier = get_message_identifier(item)
-    if not message_identifier:
-        message_identifier = f"{item.subject}-{item.datetime_received}-{getattr(item, 'sender', '')}"
+SYNC_INTERVAL = int(os.getenv('SYNC_INTERVAL', '0'))
+_scheduler_lock = threading.Lock()
+_account_scheduler = None
 
-    existing = session.query(Email).filter(Email.message_id == message_identifier).first()
-    if existing:
-        return False
 
-    recipients = ', '.join([
-        r.email_address or r.name
-        for r in (item.to_recipients or [])
-        if getattr(r, 'email_address', None) or getattr(r, 'name', None)
-    ])
-
-    email_record = Email(
-        message_id=message_identifier,
-        subject=item.subject,
-        sender=item.sender.email_address if item.sender else None,
-        recipients=recipients,
-        datetime_received=item.datetime_received,
-        body=str(item.body) if item.body is not None else None,
-    )
-    session.add(email_record)
-    session.flush()
+def sync_configured_account(config):
+    return sync_account(config, lambda: session_scope(write=True), TIMEZONE, default_days=DAYS_AGO)
 
-    if getattr(item, 'attachments', None):
-        for attachment in item.attachments:
-            try:
-                if isinstance(attachment, FileAttachment):
-                    data = attachment.content or b''
-                    filename = sanitize_filename(attachment.name)
-                    session.add(
-                        Attachment(
-                            email_id=email_record.id,
-                            filename=filename,
-                            content_type=getattr(attachment, 'content_type', None),
-                            data=data,
-                            size=len(data),
-                        )
-                    )
-                elif isinstance(attachment, ItemAttachment):
-                    attached_item = attachment.item
-                    attached_subject = sanitize_filename(getattr(attached_item, 'subject', 'Attached Email'))
-                    received = getattr(attached_item, 'datetime_received', datetime.now(pytz.UTC))
-                    attached_filename = f"attached_email_{attached_subject}_{received.strftime('%Y%m%d%H%M%S')}.html"
-                    attached_body = getattr(attached_item, 'body', '')
-                    attached_sender = getattr(attached_item, 'sender', None)
-                    attached_sender_email = (
-                        attached_sender.email_address if getattr(attached_sender, 'email_address', None) else str(attached_sender)
-                    )
-                    attached_html = (
-                        "<html><body\n"
-                        f"<h1>Subject: {escape(getattr(attached_item, 'subject', 'No Subject'))}</h1>\n"
-                        f"<p><strong>Received:</strong> {escape(received.isoformat())}</p>\n"
-                        f"<p><strong>Sender:</strong> {escape(attached_sender_email or 'Unknown')}</p>\n"
-                        "<p><strong>Body:</strong></p>\n"
-                        f"{attached_body}\n"
-                        "</body></html>\n"
-                    ).encode('utf-8')
-                    session.add(
-                        Attachment(
-                            email_id=email_record.id,
-                            filename=attached_filename,
-                            content_type='text/html',
-                            data=attached_html,
-                            size=len(attached_html),
-                        )
-                    )
-            except Exception as exc:
-                logging.error(f"Error saving attachment: {exc}")
 
-    return True
+def get_account_scheduler():
+    """Scheduler over the configured mailboxes, created on first use."""
+    global _account_scheduler
+    with _scheduler_lock:
+        if _account_scheduler is None:
+            _account_scheduler = AccountScheduler(load_accounts(), sync_configured_account)
+        return _account_scheduler
 
 
-def format_datetime(dt):
-    if not dt:
-        return 'Unknown'
-    try:
-        target_tz = pytz.timezone(TIMEZONE)
-        if dt.tzinfo is None:
-            dt = target_tz.localize(dt)
-        else:
-            dt = dt.astimezone(target_tz)
-        return dt.strftime('%m/%d/%Y %I:%M %p')
-    except Exception:
-        return dt.strftime('%m/%d/%Y %I:%M %p') if isinstance(dt, datetime) else str(dt)
+def start_mail_listeners(stop_event=None):
+    """Listen for new mail on every configured account, one thread each."""
+    from listener import EWSPullClient, MailListener
 
-def setup_exchange_connection():
-    """Setup Exchange connection using environment variables."""
-    email = EXCHANGE_EMAIL
-    domain_username = EXCHANGE_DOMAIN_USERNAME
-    password = EXCHANGE_PASSWORD
-    server = EXCHANGE_SERVER
-    version = EXCHANGE_VERSION
-    output_dir = OUTPUT_DIR
-    timezone_name = TIMEZONE
-    days_ago = DAYS_AGO
-    
-    if not all([email, domain_username, password, server, version]):
-        logging.error("One or more environment variables are missing.")
-        raise ValueError("Missing environment variables.")
-    
-    # Setup exchange connection
-    credentials = Credentials(username=domain_username, password=password)
-    config = Configuration(server=server, credentials=credentials)
-    account = Account(
-        primary_smtp_address=email,
-        credentials=credentials,
-        autodiscover=True,
-        access_type=DELEGATE,
-        config=config
+    stop_event = stop_event or threading.Event()
+    workers = []
+    for config in load_accounts():
+        def listen(config=config):
+            try:
+                account = get_throttle(config.account_id).call(
+                    connect_account, config.email, config.username, config.password, config.server
+                )
+            except Exception as e:
+                logging.error(f"Mail listener for {config.account_id} could not connect: {str(e)}")
+                return
+            folders = [getattr(account, name) for name in config.folders]
+            listener = MailListener(
+                EWSPullClient(account, folders, throttle=get_throttle(config.account_id)),
+                lambda: session_scope(write=True),
+                process_email_item,
+                account_id=config.account_id,
+                # Fill a hole left by an expired watermark with a window sync of this account.
+                on_gap=lambda account_id: get_account_scheduler().run_account(account_id),
+            )
+            listener.run(stop_event)
+
+        worker = threading.Thread(target=listen, name=f'mail-listener-{config.account_id}', daemon=True)
+        worker.start()
+        workers.append(worker)
+    return stop_event, workers
+
+
+def start_account_sync_loop(interval=SYNC_INTERVAL):
+    """Sync every account in the background every interval seconds."""
+    worker = threading.Thread(
+        target=lambda: get_account_scheduler().run_forever(interval),
+        name='account-sync-loop',
+        daemon=True,
     )
-    
-    # Calculate time frame
-    local_tz = pytz.timezone(timezone_name)
-    time_frame = local_tz.localize(datetime.now() - timedelta(days=days_ago))
-    
-    return account, output_dir, time_frame
+    worker.start()
+    return worker
 
 
 @app.route('/')
 def index():
     try:
         with session_scope() as session:
-            query = (
-                session.query(Email)
-                .order_by(Email.datetime_received.desc())
-                .limit(100)
-            )
             recent_emails = []
-            for email in query:
+            for email in session.execute(RECENT_EMAILS_STMT):
                 recent_emails.append({
                     'id': email.id,
                     'subject': email.subject or 'No Subject',
                     'sender': email.sender or 'Unknown Sender',
                     'datetime_received': format_datetime(email.datetime_received),
+                    'attachment_count': email.attachment_count or 0,
+                    'attachment_total_bytes': email.attachment_total_bytes or 0,
                 })
 
         default_content = "<p class='text-muted text-center'>Select an email to view its contents.</p>"
@@ -458,67 +649,276 @@ def index():
         default_content = "<p class='text-muted text-center'>Select an email to view its contents.</p>"
         return render_template('index.html', emails=[], email_content=default_content)
 
+def make_snippet(plain_text, index):
+    """Cut a short excerpt around a match position (or the start when index is -1)."""
+    if index != -1:
+        start = max(0, index - 50)
+        snippet = plain_text[start:index + 150]
+    else:
+        snippet = plain_text[:200]
+    if snippet:
+        snippet = snippet.strip() + '...'
+    return snippet
+
+
+_extraction_lock = threading.Lock()
+
+
+def run_attachment_extraction():
+    """Extract searchable text from newly stored attachments, then build their previews."""
+    from attachment_preview import generate_pending
+    from attachment_text import extract_pending
+
+    if not _extraction_lock.acquire(blocking=False):
+        return
+    try:
+        extract_pending(session_scope, lambda: session_scope(write=True))
+        # Text previews reuse the text cached just now.
+        generate_pending(session_scope, lambda: session_scope(write=True))
+    except Exception as e:
+        logging.error(f"Attachment text extraction failed: {str(e)}")
+    finally:
+        _extraction_lock.release()
+
+
+def start_attachment_extraction():
+    """Run attachment extraction in the background unless it is already running."""
+    if _extraction_lock.locked():
+        return None
+    worker = threading.Thread(target=run_attachment_extraction, name='attachment-text', daemon=True)
+    worker.start()
+    return worker
+
+
+suggest_index = PrefixIndex(max_terms=SUGGEST_MAX_TERMS)
+_suggest_lock = threading.Lock()
+_suggest_ready = threading.Event()
+
+
+def build_suggest_index():
+    """Load senders, recipients and subject words from the database into the index."""
+    if _suggest_ready.is_set():
+        return suggest_index
+    with _suggest_lock:
+        if _suggest_ready.is_set():
+            return suggest_index
+        with session_scope() as session:
+            for sender, recipients, subject in session.execute(SUGGEST_SOURCE_STMT):
+                suggest_index.add_email(sender, recipients, subject)
+        _suggest_ready.set()
+        logging.info(f"Suggest index built with {len(suggest_index)} terms")
+    return suggest_index
+
+
+def start_suggest_index_build():
+    if _suggest_ready.is_set():
+        return None
+    worker = threading.Thread(target=build_suggest_index, name='suggest-index', daemon=True)
+    worker.start()
+    return worker
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_new_emails(session, flush_context):
+    new_emails = [instance for instance in session.new if isinstance(instance, Email)]
+    if new_emails:
+        # Values are copied now: after the commit the instances are expired.
+        session.info.setdefault('suggest_new', []).extend(
+            (instance, instance.sender, instance.recipients, instance.subject) for instance in new_emails
+        )
+
+
+@event.listens_for(Session, 'after_commit')
+def index_new_emails(session):
+    new_emails = session.info.pop('suggest_new', ())
+    # Before the first build starts the rows are picked up by build_suggest_index();
+    # during it a row may be counted twice, which only nudges its ranking.
+    if not (_suggest_ready.is_set() or _suggest_lock.locked()):
+        return
+    for instance, sender, recipients, subject in new_emails:
+        # Rows from a rolled back savepoint are transient again.
+        if not inspect(instance).transient:
+            suggest_index.add_email(sender, recipients, subject)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_new_emails(session):
+    if not session.in_transaction():
+        session.info.pop('suggest_new', None)
+
+
+@app.route('/suggest')
+@ensure_json_response
+def suggest():
+    prefix = request.args.get('q', '').strip()
+    if not prefix:
+        return {'suggestions': []}
+    try:
+        limit = min(max(int(request.args.get('limit', SUGGEST_LIMIT)), 1), 50)
+    except ValueError:
+        limit = SUGGEST_LIMIT
+    matches = build_suggest_index().suggest(prefix, limit)
+    return {'suggestions': [{'value': value, 'kind': kind} for value, kind in matches]}
+
+
+app_cache = create_cache(CACHE_URL, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES)
+
+
+def read_generation(name):
+    """A ChangeCounter, bumped by every process that commits changes it tracks.
+
+    This one primary-key lookup is all the database work a cached /search or
+    /view answer costs.
+    """
+    initialize_database()
+    with engine.connect() as connection:
+        return read_counter(connection, name)
+
+
+search_cache = ResultCache(
+    app_cache, namespace='search', ttl=SEARCH_CACHE_TTL, generation_source=lambda: read_generation('search'),
+)
+
+
+def normalize_search_query(query):
+    return ' '.join(query.split()).lower()
+
+
+def parse_search_page(args):
+    """Read limit/offset from the query string; limit is optional."""
+    limit = args.get('limit', type=int)
+    offset = args.get('offset', 0, type=int)
+    if (limit is not None and limit < 1) or offset < 0:
+        raise ValueError("limit must be positive and offset must not be negative.")
+    return limit, offset
+
+
 @app.route('/search')
 @ensure_json_response
 def search():
-    query = request.args.get('query', '').strip()
+    query = normalize_search_query(request.args.get('query', ''))
     if not query:
         return jsonify({"error": "No search query provided."}), 400
+    try:
+        limit, offset = parse_search_page(request.args)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    account = request.args.get('account', '').strip() or None
+    include_archive = request.args.get('include_archive', '').lower() in ('1', 'true', 'yes', 'on')
+    cache_key = (query, account, limit, offset, include_archive)
+    # A hit still reads the generation counter; see read_generation().
+    generation = search_cache.generation
+    cached = search_cache.get(cache_key, generation)
+    if cached is not None:
+        return cached
 
     search_pattern = f"%{query}%"
-    lowercase_query = query.lower()
     results = []
 
     try:
         with session_scope() as session:
-            emails = (
-                session.query(Email)
-                .filter(
-                    or_(
-                        Email.subject.ilike(search_pattern),
-                        Email.sender.ilike(search_pattern),
-                        Email.recipients.ilike(search_pattern),
-                        Email.body.ilike(search_pattern),
-                    )
-                )
-                .order_by(Email.datetime_received.desc())
-                .all()
-            )
-
+            statement = SEARCH_EMAILS_STMT.offset(offset)
+            if account is not None:
+                statement = statement.where(Email.account_id == account)
+            if limit is not None:
+                statement = statement.limit(limit)
+            emails = session.execute(statement, {'pattern': search_pattern}).scalars().all()
+
+            snippets = {}
+            unmatched_ids = []
             for email in emails:
                 body_text = email.body or ''
                 plain_text = re.sub('<[^<]+?>', '', body_text)
-                index = plain_text.lower().find(lowercase_query)
-                if index != -1:
-                    start = max(0, index - 50)
-                    snippet = plain_text[start:index + 150]
-                else:
-                    snippet = plain_text[:200]
-                if snippet:
-                    snippet = snippet.strip() + '...'
+                index = plain_text.lower().find(query)
+                if index == -1:
+                    unmatched_ids.append(email.id)
+                snippets[email.id] = make_snippet(plain_text, index)
+
+            # Emails found only through an attachment get their snippet from it.
+            if unmatched_ids:
+                attachment_hits = session.execute(
+                    select(Attachment.email_id, AttachmentText.text)
+                    .join(AttachmentText, AttachmentText.content_hash == Attachment.content_hash)
+                    .where(Attachment.email_id.in_(unmatched_ids), AttachmentText.text.ilike(search_pattern))
+                )
+                for email_id, attachment_text in attachment_hits:
+                    index = attachment_text.lower().find(query)
+                    snippets[email_id] = make_snippet(attachment_text, index)
 
+            for email in emails:
                 results.append({
                     'id': email.id,
+                    'account_id': email.account_id,
                     'subject': email.subject or 'No Subject',
                     'sender': email.sender or 'Unknown Sender',
                     'datetime_received': format_datetime(email.datetime_received),
-                    'snippet': snippet,
+                    'attachment_count': email.attachment_count or 0,
+                    'attachment_total_bytes': email.attachment_total_bytes or 0,
+                    'snippet': snippets[email.id],
                 })
 
-        return {"results": results}
+        payload = {"results": results, "limit": limit, "offset": offset}
+        if include_archive:
+            payload["archived_results"] = search_archive_tier(query, account, limit, offset)
+        search_cache.put(cache_key, payload, generation)
+        return payload
 
     except Exception as e:
         logging.error(f"Search error: {str(e)}")
         return {"error": str(e)}, 500
 
+def search_archive_tier(query, account, limit, offset):
+    """Search the cold archive files; paged independently of the main results."""
+    matches = search_archives(query, ARCHIVE_DIR, account, None if limit is None else offset + limit)
+    results = []
+    for month, email, body_text in matches[offset:]:
+        plain_text = re.sub('<[^<]+?>', '', body_text)
+        results.append({
+            'id': email['id'],
+            'archive': month,
+            'view_url': f"/archive/{month}/{email['id']}",
+            'account_id': email['account_id'],
+            'subject': email['subject'] or 'No Subject',
+            'sender': email['sender'] or 'Unknown Sender',
+            'datetime_received': format_datetime(email['datetime_received']),
+            'attachment_count': email['attachment_count'],
+            'attachment_total_bytes': email['attachment_total_bytes'],
+            'snippet': make_snippet(plain_text, plain_text.lower().find(query)),
+        })
+    return results
+
+
+def render_email_view(session, email_record):
+    """Render an email for /view with cid: images pointing at the inline endpoint."""
+    body = email_record.body or ''
+    if 'cid:' not in body.lower():
+        return build_email_html(email_record)
+
+    urls_by_cid = {
+        normalize_content_id(content_id): f"/attachments/{attachment_id}/inline/{digest}"
+        for attachment_id, content_id, digest in session.execute(CID_ATTACHMENTS_STMT, {'email_id': email_record.id})
+        if digest is not None
+    }
+    return build_email_html(email_record, body=rewrite_cid_urls(body, urls_by_cid.get))
+
+
 @app.route('/view/<int:email_id>')
 def view(email_id):
+    # Stored emails never change, so the rendered page can be shared by every
+    # worker; the generation moves on when retention deletes emails.
+    cache_key = f"view:{read_generation('view')}:{email_id}"
+    cached = app_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
         with session_scope() as session:
-            email_record = session.get(Email, email_id)
+            email_record = session.execute(VIEW_EMAIL_STMT, {'email_id': email_id}).scalar_one_or_none()
             if not email_record:
                 abort(404)
-            return build_email_html(email_record)
+            html = render_email_view(session, email_record)
+        app_cache.set(cache_key, html, VIEW_CACHE_TTL)
+        return html
     except HTTPException:
         raise
     except Exception as e:
@@ -526,6 +926,17 @@ def view(email_id):
         abort(500)
 
 
+@app.route('/archive/<month>/<int:email_id>')
+def view_archived(month, email_id):
+    archived = get_archived_email(month, email_id, ARCHIVE_DIR)
+    if archived is None:
+        abort(404)
+    email, _ = archived
+    return build_email_html(RenderRow(
+        email['subject'], email['sender'], email['recipients'], email['datetime_received'], email['body'],
+    ))
+
+
 @app.route('/attachments/<int:attachment_id>/download')
 def download_attachment(attachment_id):
     try:
@@ -533,6 +944,9 @@ def download_attachment(attachment_id):
             attachment = session.get(Attachment, attachment_id)
             if not attachment:
                 abort(404)
+            if attachment.data is None and attachment.size:
+                # Content removed by the retention purge job.
+                abort(410)
             file_data = attachment.data or b''
             buffer = io.BytesIO(file_data)
             buffer.seek(0)
@@ -549,21 +963,115 @@ def download_attachment(attachment_id):
         abort(500)
 
 
+@app.route('/attachments/<int:attachment_id>/inline')
+def inline_attachment_by_id(attachment_id):
+    """Redirect to the content-addressed inline URL of an attachment."""
+    with session_scope() as session:
+        digest = session.execute(
+            select(Attachment.content_hash).where(Attachment.id == attachment_id)
+        ).scalar()
+    if digest is None:
+        abort(404)
+    return redirect(f"/attachments/{attachment_id}/inline/{digest}")
+
+
+@app.route('/attachments/<int:attachment_id>/inline/<content_hash>')
+def inline_attachment(attachment_id, content_hash):
+    """Serve an attachment for embedding in a rendered email, cached as immutable.
+
+    The URL and ETag carry the content hash, not just the row id: ids can be
+    reused on databases created before AUTOINCREMENT, and a browser holding
+    an immutable copy would never ask again.
+    """
+    if not CONTENT_HASH_RE.fullmatch(content_hash):
+        abort(404)
+    etag = f"attachment-{content_hash}"
+    # Weak comparison: compressed responses carry the ETag as W/"...".
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        try:
+            with session_scope() as session:
+                attachment = session.get(Attachment, attachment_id)
+                if not attachment or attachment.content_hash != content_hash:
+                    abort(404)
+                content_type = attachment.content_type or 'application/octet-stream'
+                response = send_file(
+                    io.BytesIO(attachment.data or b''),
+                    mimetype=content_type,
+                    # Only images are rendered in place; anything else is a download.
+                    as_attachment=not content_type.startswith('image/'),
+                    download_name=attachment.filename or 'attachment',
+                    conditional=False,
+                    etag=False,
+                )
+        except HTTPException:
+            raise
+        except Exception as e:
+            logging.error(f"Error serving inline attachment {attachment_id}: {str(e)}")
+            abort(500)
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = INLINE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/attachments/<int:attachment_id>/preview')
+def preview_attachment(attachment_id):
+    """Redirect to the preview of this attachment's content."""
+    with session_scope() as session:
+        digest = session.execute(
+            select(Attachment.content_hash).where(Attachment.id == attachment_id)
+        ).scalar()
+    if digest is None:
+        return jsonify({'success': False, 'message': 'No preview available'}), 404
+    return redirect(f"/previews/{digest}")
+
+
+@app.route('/previews/<content_hash>')
+def preview_content(content_hash):
+    """Serve the stored thumbnail or text preview of some content, cached as immutable.
+
+    Keyed by content hash rather than attachment id: ids can be reused on
+    databases created before AUTOINCREMENT, content hashes cannot.
+    """
+    if not CONTENT_HASH_RE.fullmatch(content_hash):
+        abort(404)
+    etag = f"preview-{content_hash}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        with session_scope() as session:
+            preview = session.execute(PREVIEW_STMT, {'content_hash': content_hash}).first()
+        if preview is None or preview.kind not in ('image', 'text'):
+            # Not generated yet, or no preview for this type; not cached.
+            return jsonify({'success': False, 'message': 'No preview available'}), 404
+        response = app.response_class(preview.data, content_type=preview.content_type)
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = INLINE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
 @app.route('/list-attachments/<int:email_id>')
 @ensure_json_response
 def list_attachments(email_id):
     try:
         with session_scope() as session:
-            email_record = session.get(Email, email_id)
-            if not email_record:
-                return {'attachments': []}
-
             attachments = []
-            for attachment in email_record.attachments:
+            for attachment in session.execute(LIST_ATTACHMENTS_STMT, {'email_id': email_id}):
+                has_preview = attachment.preview_kind in ('image', 'text')
                 attachments.append({
                     'filename': attachment.filename,
                     'path': f"/attachments/{attachment.id}/download",
-                    'size': attachment.size or (len(attachment.data) if attachment.data else 0),
+                    'size': attachment.size or 0,
+                    'preview': f"/previews/{attachment.content_hash}" if has_preview else None,
+                    'preview_kind': attachment.preview_kind if has_preview else None,
                 })
             logging.debug(f"Found {len(attachments)} attachments for email {email_id}")
             return {'attachments': attachments}
@@ -571,32 +1079,80 @@ def list_attachments(email_id):
         logging.error(f"Error listing attachments: {str(e)}")
         return json_response(success=False, message=f"Error listing attachments: {str(e)}", status_code=500)
 
+@app.route('/metrics/pool')
+@ensure_json_response
+def pool_metrics():
+    return {'pools': get_pool_metrics(), 'waitress_threads': WAITRESS_THREADS}
+
+@app.route('/accounts')
+@ensure_json_response
+def list_accounts():
+    with session_scope() as session:
+        counts = session.execute(
+            select(Email.account_id, func.count(Email.id)).group_by(Email.account_id).order_by(Email.account_id)
+        ).all()
+    return {'accounts': [{'id': account_id, 'email_count': count} for account_id, count in counts]}
+
+@app.route('/metrics/cache')
+@ensure_json_response
+def cache_metrics():
+    return {'app': app_cache.stats(), 'settings': SETTINGS_CACHE.stats(), 'compression': response_compressor.stats()}
+
+@app.route('/metrics/throttle')
+@ensure_json_response
+def throttle_metrics_view():
+    return {'accounts': throttle_metrics()}
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+@admin_required
+@ensure_json_response
+def admin_profiling():
+    """Show or arm profiling; POST {"endpoint": "search", "count": 3, "mode": "cprofile"}."""
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        endpoint = payload.get('endpoint')
+        if endpoint not in app.view_functions:
+            return {'success': False, 'message': f"Unknown endpoint: {endpoint}"}, 400
+        try:
+            armed = request_profiler.arm(endpoint, int(payload.get('count', 1)), payload.get('mode', 'cprofile'))
+        except ValueError as e:
+            return {'success': False, 'message': str(e)}, 400
+    else:
+        armed = request_profiler.armed_endpoints()
+    return {'armed': armed, 'slow_ms': request_profiler.slow_ms, 'profile_dir': str(request_profiler.profile_dir)}
+
+@app.route('/admin/profiles')
+@admin_required
+@ensure_json_response
+def admin_profiles():
+    return {'profiles': request_profiler.list_profiles()}
+
+@app.route('/admin/profiles/<filename>')
+@admin_required
+def admin_profile_file(filename):
+    path = request_profiler.profile_path(filename)
+    if path is None:
+        return jsonify({'success': False, 'message': 'Profile not found'}), 404
+    return send_file(path.resolve(), as_attachment=True, download_name=filename)
+
 @app.route('/check-emails', methods=['POST'])
 @ensure_json_response
 def check_emails():
     try:
-        account, output_dir, time_frame = setup_exchange_connection()
-        Path(output_dir).mkdir(parents=True, exist_ok=True)
-
-        processed_sent = 0
-        processed_inbox = 0
-
-        with session_scope() as session:
-            logging.info("Processing sent emails...")
-            for created in process_email(account, account.sent, session, time_frame):
-                if created:
-                    processed_sent += 1
-
-            logging.info("Processing inbox emails...")
-            for created in process_email(account, account.inbox, session, time_frame):
-                if created:
-                    processed_inbox += 1
-
-        return json_response(
-            success=True,
-            message=f"Emails checked successfully. Processed {processed_sent} sent and {processed_inbox} inbox emails.",
-            data={"sent": processed_sent, "inbox": processed_inbox}
-        )
+        results = get_account_scheduler().run_once()
+        start_attachment_extraction()
+
+        created = sum(result.get('created', 0) for result in results.values())
+        failed = sorted(account_id for account_id, result in results.items() if 'error' in result)
+        if failed and len(failed) == len(results):
+            errors = '; '.join(f"{account_id}: {results[account_id]['error']}" for account_id in failed)
+            return json_response(success=False, message=f"Failed to check emails: {errors}",
+                                 data=results, status_code=500)
+
+        message = f"Emails checked successfully. Stored {created} new emails from {len(results)} account(s)."
+        if failed:
+            message += f" Failed: {', '.join(failed)}."
+        return json_response(success=True, message=message, data=results)
     except JSONDecodeError as e:
         logging.error(f"JSON decode error: {str(e)}")
         return json_response(success=False, message=f"JSON decode error: {str(e)}", status_code=500)
@@ -604,43 +1160,457 @@ def check_emails():
         logging.error(f"Failed to check emails: {str(e)}")
         return json_response(success=False, message=f"Failed to check emails: {str(e)}", status_code=500)
 
-@app.route('/download-all-emails')
-def download_all_emails():
-    """Create and serve a zip file containing all emails and attachments."""
+
+# Ids below the last exported one that incremental exports check again,
+# deduplicated, on databases other than SQLite; see export_id_overlap().
+EXPORT_ID_OVERLAP = int(os.getenv('EXPORT_ID_OVERLAP', '1000'))
+EXPORT_CHUNK_STMT = (
+    select(
+        Email.id,
+        Email.created_at,
+        Email.subject,
+        Email.sender,
+        Email.recipients,
+        Email.datetime_received,
+        Email.body,
+    )
+    .order_by(Email.id)
+    .execution_options(yield_per=RENDER_CHUNK_SIZE)
+)
+EXPORT_ATTACHMENTS_STMT = (
+    select(Attachment.email_id, Attachment.filename, Attachment.content_type, Attachment.data,
+           Attachment.content_id, Attachment.is_inline)
+    .where(Attachment.email_id.in_(bindparam('email_ids', expanding=True)))
+    .order_by(Attachment.email_id, Attachment.id)
+)
+
+
+def parse_export_datetime(value, name):
     try:
-        buffer = io.BytesIO()
-        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            with session_scope() as session:
-                emails = session.query(Email).options(selectinload(Email.attachments)).all()
-                for email_record in emails:
-                    recipient_display = (email_record.recipients or 'Unknown').split(',')[0].strip() or 'Unknown'
-                    subject_display = sanitize_filename(email_record.subject or 'No_Subject')
-                    if email_record.datetime_received:
-                        date_str = format_datetime(email_record.datetime_received).replace('/', '-').replace(' ', '_').replace(':', '-')
-                    else:
-                        date_str = 'Unknown_Date'
-                    base_name = sanitize_filename(f"to_{recipient_display} - {subject_display} - {date_str}")
-
-                    zipf.writestr(f"{base_name}.html", build_email_html(email_record))
-
-                    for attachment in email_record.attachments:
-                        filename = sanitize_filename(attachment.filename or 'attachment')
-                        attachment_path = f"{base_name}_attachments/{filename}"
-                        zipf.writestr(attachment_path, attachment.data or b'')
-
-        buffer.seek(0)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        zip_filename = f"all_emails_{timestamp}.zip"
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=zip_filename,
-            mimetype='application/zip'
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, description=f"Invalid {name} date: {value}")
+    if parsed.tzinfo is None:
+        parsed = get_timezone(TIMEZONE).localize(parsed)
+    return parsed
+
+
+def parse_export_filters(args):
+    """Read the date range, account, sender, recipient and folder filters of an export request."""
+    filters = {}
+    for name in ('start', 'end'):
+        if args.get(name):
+            filters[name] = parse_export_datetime(args[name], name)
+    for name in ('account', 'sender', 'recipient', 'folder'):
+        value = (args.get(name) or '').strip()
+        if value:
+            filters[name] = value
+    return filters
+
+
+def build_export_statement(filters, watermark=None, after_id=None, exclude_ids=()):
+    statement = EXPORT_CHUNK_STMT
+    if 'start' in filters:
+        statement = statement.where(Email.datetime_received >= filters['start'])
+    if 'end' in filters:
+        statement = statement.where(Email.datetime_received < filters['end'])
+    if 'account' in filters:
+        statement = statement.where(Email.account_id == filters['account'])
+    if 'sender' in filters:
+        statement = statement.where(Email.sender.ilike(f"%{filters['sender']}%"))
+    if 'recipient' in filters:
+        statement = statement.where(Email.recipients.ilike(f"%{filters['recipient']}%"))
+    if 'folder' in filters:
+        statement = statement.where(func.lower(Email.folder) == filters['folder'].lower())
+    if after_id is not None:
+        statement = statement.where(Email.id > after_id)
+        if exclude_ids:
+            statement = statement.where(Email.id.not_in(exclude_ids))
+    elif watermark is not None:
+        # Runs recorded before last_email_id existed.
+        statement = statement.where(Email.created_at > watermark)
+    return statement
+
+
+def get_export_watermark(session, name):
+    """Return (last email id, created_at watermark) of the last completed export with this name."""
+    row = session.execute(
+        select(ExportRun.last_email_id, ExportRun.watermark)
+        .where(ExportRun.name == name, ExportRun.completed_at.isnot(None),
+               or_(ExportRun.last_email_id.isnot(None), ExportRun.watermark.isnot(None)))
+        .order_by(ExportRun.completed_at.desc(), ExportRun.id.desc())
+        .limit(1)
+    ).first()
+    return (row.last_email_id, row.watermark) if row is not None else (None, None)
+
+
+def export_id_overlap():
+    """How far below the last exported id an incremental export looks again.
+
+    SQLite has one writer at a time, so ids are committed in order. Other
+    databases hand out ids when rows are inserted, and a transaction that
+    commits late can add a row below an id already exported.
+    """
+    return 0 if engine.dialect.name == 'sqlite' else EXPORT_ID_OVERLAP
+
+
+def get_exported_ids(session, name, after_id):
+    """Ids above after_id that completed exports with this name already contain."""
+    exported = set()
+    manifests = session.execute(
+        select(ExportRun.manifest)
+        .where(ExportRun.name == name, ExportRun.completed_at.isnot(None), ExportRun.last_email_id > after_id)
+    ).scalars()
+    for manifest in manifests:
+        exported.update(email_id for email_id, _ in json.loads(manifest or '[]') if email_id > after_id)
+    return exported
+
+
+def iter_export_chunks(session, statement=EXPORT_CHUNK_STMT):
+    """Yield ((email id, created_at) keys, row tuples) chunks for the bulk renderer."""
+    for partition in session.execute(statement).partitions(RENDER_CHUNK_SIZE):
+        yield [(row[0], row[1]) for row in partition], [tuple(row[2:]) for row in partition]
+
+
+def iter_rendered_export(sink, session, chunks, max_workers=RENDER_WORKERS):
+    """Render exported emails in a process pool and write them to a ZipSink in order.
+
+    Yields the (email id, created_at, entry name) triples written for each chunk.
+    """
+    for keys, rendered in iter_rendered_chunks(chunks, TIMEZONE, max_workers):
+        email_ids = [email_id for email_id, _ in keys]
+        attachments_by_email = {}
+        for attachment in session.execute(EXPORT_ATTACHMENTS_STMT, {'email_ids': email_ids}):
+            attachments_by_email.setdefault(attachment.email_id, []).append(attachment)
+        entries = []
+        for (email_id, created_at), (base_name, html) in zip(keys, rendered):
+            written = sink.write_rendered(base_name, html, attachments_by_email.get(email_id, ()))
+            entries.append((email_id, created_at, written))
+        yield entries
+
+
+def iter_mime_export(sink, session, statement):
+    """Write exported emails as MIME messages to an EmlZipSink or MboxSink, a chunk at a time.
+
+    Yields the (email id, created_at, entry name) triples written for each chunk.
+    """
+    statement = statement.add_columns(Email.message_id)
+    for partition in session.execute(statement).partitions(RENDER_CHUNK_SIZE):
+        attachments_by_email = {}
+        for attachment in session.execute(EXPORT_ATTACHMENTS_STMT, {'email_ids': [row[0] for row in partition]}):
+            attachments_by_email.setdefault(attachment.email_id, []).append(attachment)
+        entries = []
+        for email_id, created_at, subject, sender, recipients, received, body, message_id in partition:
+            message = ExportMessage(message_id, subject, sender, recipients, received, body,
+                                    attachments_by_email.get(email_id, ()))
+            if isinstance(sink, MboxSink):
+                sink.write_message(message, message.attachments)
+                written = message_id
+            else:
+                written = sink.write_message(zip_entry_name(message, TIMEZONE), message, message.attachments)
+            entries.append((email_id, created_at, written))
+        yield entries
+
+
+EXPORT_FORMATS = {
+    # format: (file extension, mimetype)
+    'html': ('zip', 'application/zip'),
+    'eml': ('zip', 'application/zip'),
+    'mbox': ('mbox', 'application/mbox'),
+}
+
+
+# Completed runs are recorded by one background writer, so a busy writer
+# connection never stalls or breaks a response whose body is already sent.
+EXPORT_RUN_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export-runs')
+_pending_export_runs = set()
+
+
+def start_export_run(export_name, filters):
+    """Record an export as started, before any of it is streamed; returns the run id."""
+    with session_scope(write=True) as session:
+        run = ExportRun(
+            name=export_name,
+            filters=json.dumps({key: str(value) for key, value in filters.items()}),
+            started_at=datetime.now(pytz.UTC),
         )
+        session.add(run)
+        session.flush()
+        return run.id
+
+
+def complete_export_run(run_id, watermark, last_email_id, manifest):
+    try:
+        with session_scope(write=True) as session:
+            run = session.get(ExportRun, run_id)
+            run.watermark = watermark
+            run.last_email_id = last_email_id
+            run.email_count = len(manifest)
+            run.manifest = json.dumps(manifest)
+            run.completed_at = datetime.now(pytz.UTC)
+    except Exception as e:
+        # The run stays incomplete, so an incremental export repeats its emails.
+        logging.error(f"Error recording export run {run_id}: {str(e)}")
+        raise
+
+
+def finish_export_run(run_id, watermark, last_email_id, manifest):
+    future = EXPORT_RUN_WRITER.submit(complete_export_run, run_id, watermark, last_email_id, manifest)
+    _pending_export_runs.add(future)
+    future.add_done_callback(_pending_export_runs.discard)
+    return future
+
+
+def wait_for_export_runs():
+    """Wait until runs finished in this process are recorded."""
+    wait(list(_pending_export_runs), timeout=SQLITE_WRITER_TIMEOUT)
+
 
+def generate_export(run_id, filters, export_name, incremental, export_format='html'):
+    """Stream an export and record its manifest and watermark once complete.
+
+    html renders every email to a page in a ZIP; eml writes one MIME file per
+    email into a ZIP and mbox a single mbox file, both importable by mail
+    clients and much cheaper to produce.
+    """
+    stream = ZipStream()
+    manifest = []
+    try:
+        with session_scope() as session:
+            last_email_id, watermark = get_export_watermark(session, export_name) if incremental else (None, None)
+            after_id, exclude_ids = None, ()
+            if last_email_id is not None:
+                after_id = max(0, last_email_id - export_id_overlap())
+                if after_id < last_email_id:
+                    exclude_ids = get_exported_ids(session, export_name, after_id)
+            statement = build_export_statement(filters, watermark, after_id, exclude_ids)
+            if export_format == 'mbox':
+                sink = MboxSink(stream)
+                batches = iter_mime_export(sink, session, statement)
+            elif export_format == 'eml':
+                sink = EmlZipSink(stream)
+                batches = iter_mime_export(sink, session, statement)
+            else:
+                sink = ZipSink(stream)
+                batches = iter_rendered_export(sink, session, iter_export_chunks(session, statement))
+            with sink:
+                for entries in batches:
+                    for email_id, created_at, entry_name in entries:
+                        manifest.append([email_id, entry_name])
+                        if created_at is not None and (watermark is None or created_at > watermark):
+                            watermark = created_at
+                        if last_email_id is None or email_id > last_email_id:
+                            last_email_id = email_id
+                    yield stream.drain()
+        yield stream.drain()
     except Exception as e:
+        # Headers are already sent, so the client just sees a truncated archive;
+        # the watermark is not advanced.
         logging.error(f"Error creating zip file: {str(e)}")
-        abort(500)
+        raise
+
+    finish_export_run(run_id, watermark, last_email_id, manifest)
+    logging.info(f"Export '{export_name}' finished with {len(manifest)} emails")
+
+
+@app.route('/download-all-emails')
+def download_all_emails():
+    """Stream a zip file of emails and attachments.
+
+    Optional query parameters: start/end (ISO dates, on datetime_received),
+    sender, recipient and folder (substring or exact folder name), and
+    since=last to export only emails stored after the last completed export
+    with the same name (name defaults to "default"). format=eml or
+    format=mbox exports standard MIME messages instead of HTML pages.
+    """
+    filters = parse_export_filters(request.args)
+    export_name = request.args.get('name', 'default')
+    incremental = request.args.get('since') == 'last'
+    export_format = request.args.get('format', 'html')
+    if export_format not in EXPORT_FORMATS:
+        abort(400, description=f"Unknown export format: {export_format}")
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    prefix = 'new_emails' if incremental else 'all_emails'
+    extension, mimetype = EXPORT_FORMATS[export_format]
+    suffix = '' if export_format == 'html' else f'_{export_format}'
+    if incremental:
+        wait_for_export_runs()
+    try:
+        run_id = start_export_run(export_name, filters)
+    except Exception as e:
+        logging.error(f"Error starting export '{export_name}': {str(e)}")
+        abort(503)
+    response = Response(generate_export(run_id, filters, export_name, incremental, export_format), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{prefix}_{timestamp}{suffix}.{extension}"'
+    return response
+
+
+@app.route('/exports')
+@ensure_json_response
+def list_exports():
+    """List recent exports with their filters and watermarks; unfinished runs have no completed_at."""
+    wait_for_export_runs()
+    with session_scope() as session:
+        runs = session.execute(
+            select(ExportRun.id, ExportRun.name, ExportRun.filters, ExportRun.watermark,
+                   ExportRun.email_count, ExportRun.completed_at)
+            .order_by(ExportRun.id.desc())
+            .limit(50)
+        ).all()
+    return {'exports': [
+        {
+            'id': run.id,
+            'name': run.name,
+            'filters': json.loads(run.filters or '{}'),
+            'watermark': run.watermark.isoformat() if run.watermark else None,
+            'email_count': run.email_count,
+            'completed_at': run.completed_at.isoformat() if run.completed_at else None,
+        }
+        for run in runs
+    ]}
+
+
+API_STREAM_CHUNK = int(os.getenv('API_STREAM_CHUNK', '1000'))
+API_EMAIL_COLUMNS = {
+    'id': Email.id,
+    'message_id': Email.message_id,
+    'account_id': Email.account_id,
+    'subject': Email.subject,
+    'sender': Email.sender,
+    'recipients': Email.recipients,
+    'datetime_received': Email.datetime_received,
+    'folder': Email.folder,
+    'attachment_count': Email.attachment_count,
+    'attachment_total_bytes': Email.attachment_total_bytes,
+    'created_at': Email.created_at,
+    'body': Email.body,
+}
+API_DEFAULT_FIELDS = tuple(name for name in API_EMAIL_COLUMNS if name != 'body')
+API_DATE_FILTERS = {
+    'created_after': (Email.created_at, operator.ge),
+    'created_before': (Email.created_at, operator.lt),
+    'received_after': (Email.datetime_received, operator.ge),
+    'received_before': (Email.datetime_received, operator.lt),
+}
+API_ATTACHMENTS_STMT = (
+    select(Attachment.email_id, Attachment.id, Attachment.filename, Attachment.content_type, Attachment.size,
+           Attachment.content_hash, Attachment.is_inline)
+    .where(Attachment.email_id.in_(bindparam('email_ids', expanding=True)))
+    .order_by(Attachment.email_id, Attachment.id)
+)
+
+
+def parse_api_fields(value):
+    """Selected field names; "attachments" adds each email's attachment metadata."""
+    if not value:
+        return API_DEFAULT_FIELDS, False
+    fields = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in API_EMAIL_COLUMNS and name != 'attachments']
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return tuple(name for name in fields if name != 'attachments'), 'attachments' in fields
+
+
+def build_api_emails_statement(args, fields):
+    """Keyset-ordered SELECT of the requested columns; id always comes first."""
+    statement = select(Email.id, *(API_EMAIL_COLUMNS[name] for name in fields if name != 'id'))
+    for name, (column, compare) in API_DATE_FILTERS.items():
+        if args.get(name):
+            try:
+                value = datetime.fromisoformat(args[name])
+            except ValueError:
+                raise ValueError(f"Invalid {name} date: {args[name]}")
+            if value.tzinfo is None:
+                value = get_timezone(TIMEZONE).localize(value)
+            statement = statement.where(compare(column, value))
+    account = (args.get('account') or '').strip()
+    if account:
+        statement = statement.where(Email.account_id == account)
+    if args.get('after_id'):
+        try:
+            statement = statement.where(Email.id > int(args['after_id']))
+        except ValueError:
+            raise ValueError("after_id must be an integer")
+    if args.get('limit'):
+        try:
+            statement = statement.limit(max(0, int(args['limit'])))
+        except ValueError:
+            raise ValueError("limit must be an integer")
+    # yield_per streams from a server-side cursor where the driver has one.
+    return statement.order_by(Email.id).execution_options(yield_per=API_STREAM_CHUNK)
+
+
+def api_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def iter_api_emails(statement, fields, with_attachments):
+    """Yield NDJSON text, one chunk of lines per partition of rows."""
+    try:
+        with session_scope() as session:
+            for partition in session.execute(statement).partitions():
+                attachments = {}
+                if with_attachments:
+                    email_ids = [row[0] for row in partition]
+                    for row in session.execute(API_ATTACHMENTS_STMT, {'email_ids': email_ids}):
+                        attachments.setdefault(row.email_id, []).append({
+                            'id': row.id, 'filename': row.filename, 'content_type': row.content_type,
+                            'size': row.size or 0, 'content_hash': row.content_hash,
+                            'is_inline': bool(row.is_inline),
+                        })
+                lines = []
+                for row in partition:
+                    record = {'id': row[0]}
+                    record.update(zip((name for name in fields if name != 'id'), map(api_value, row[1:])))
+                    if with_attachments:
+                        record['attachments'] = attachments.get(row[0], [])
+                    lines.append(json.dumps(record))
+                lines.append('')
+                yield '\n'.join(lines)
+    except Exception as e:
+        # The status line is already sent; end the stream with an error record.
+        logging.error(f"Error streaming emails: {str(e)}")
+        yield json.dumps({'error': str(e)}) + '\n'
+
+
+@app.route('/api/emails')
+@ensure_json_response
+def api_emails():
+    """Stream email metadata as newline-delimited JSON, ordered by id.
+
+    Query parameters: fields (comma separated, add "attachments" for
+    attachment metadata, "body" for bodies), created_after/created_before and
+    received_after/received_before (ISO dates), account, after_id (resume
+    after the last id received) and limit.
+    """
+    try:
+        fields, with_attachments = parse_api_fields(request.args.get('fields'))
+        statement = build_api_emails_statement(request.args, fields)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return Response(iter_api_emails(statement, fields, with_attachments), mimetype='application/x-ndjson')
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create tables and upgrade a legacy schema."""
+    initialize_database(force=True)
+    print("Database initialized.")
+
+
+def create_app(init_db=False):
+    """Return the configured application.
+
+    Importing this module does no database work: tables are created and
+    legacy schemas upgraded on first use, by `flask --app app init-db`, or
+    here when init_db is true. exchangelib is only imported by the sync path.
+    The /suggest index starts loading in a background thread.
+    """
+    if init_db:
+        initialize_database()
+    start_suggest_index_build()
+    return app
 
 
 if __name__ == '__main__':
@@ -648,18 +1618,16 @@ if __name__ == '__main__':
     # Uncomment the following lines if you want to process emails on startup
     
     try:
-        account, output_dir, time_frame = setup_exchange_connection()
-        Path(output_dir).mkdir(parents=True, exist_ok=True)
-        with session_scope() as session:
-            logging.info("Processing sent emails...")
-            for _ in process_email(account, account.sent, session, time_frame):
-                pass
-            logging.info("Processing inbox emails...")
-            for _ in process_email(account, account.inbox, session, time_frame):
-                pass
+        get_account_scheduler().run_once()
+        start_attachment_extraction()
     except Exception as e:
         logging.error(f"Failed to setup Exchange connection or process emails: {str(e)}")
+    if SYNC_INTERVAL > 0:
+        start_account_sync_loop()
+    if env_flag('LISTEN_FOR_MAIL', 'false'):
+        start_mail_listeners()
     
+    create_app()
     print()
     # app.run(debug=True)
-    serve(app, host='127.0.0.1', port=8080)
+    serve(app, host='127.0.0.1', port=8080, threads=WAITRESS_THREADS)
@@ -0,0 +1,158 @@
+# attachment_preview.py
+"""
+Small previews of stored attachments, so users can judge an attachment
+without downloading it.
+
+Images get a thumbnail of at most PREVIEW_SIZE pixels a side (JPEG, or PNG
+when the image has transparency). This needs Pillow; without it images are
+left pending and picked up once it is installed. PDFs, text, HTML, DOCX and
+XLSX get a plain text preview: the first PREVIEW_TEXT_CHARS characters of the
+text attachment_text extracts (roughly the first page of a PDF), reusing text
+already cached for search. PDFs likewise wait for pypdf.
+
+Previews are stored in attachment_previews keyed by content hash, so every
+copy of the same file shares one preview, and served by /previews/<hash>,
+cached as immutable since the hash names the content. Run directly to process everything pending:
+
+    python attachment_preview.py
+"""
+import logging
+import os
+from io import BytesIO
+
+from sqlalchemy import select
+
+from attachment_text import (
+    classify,
+    extract_text,
+    hash_pending_attachments,
+    pdf_supported,
+    pending_hashes,
+    run_in_pool,
+    store_by_hash,
+)
+from models import Attachment, AttachmentPreview, AttachmentText
+
+PREVIEW_SIZE = int(os.getenv('PREVIEW_SIZE', '256'))
+PREVIEW_TEXT_CHARS = int(os.getenv('PREVIEW_TEXT_CHARS', '2000'))
+PREVIEW_WORKERS = int(os.getenv('PREVIEW_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+PREVIEW_BATCH_SIZE = int(os.getenv('PREVIEW_BATCH_SIZE', '50'))
+# Larger images are not decoded at all (decompression bombs).
+PREVIEW_MAX_PIXELS = int(os.getenv('PREVIEW_MAX_PIXELS', str(50_000_000)))
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff'}
+
+
+def preview_kind(filename, content_type):
+    """'image', 'text' or None for attachments without a preview."""
+    extension = os.path.splitext(filename or '')[1].lower()
+    if (content_type or '').lower().startswith('image/') or extension in IMAGE_EXTENSIONS:
+        return 'image'
+    if classify(filename, content_type) is not None:
+        return 'text'
+    return None
+
+
+def pillow_available():
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def render_thumbnail(data, size=PREVIEW_SIZE):
+    """Return (content type, thumbnail bytes, width, height) for image data."""
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = PREVIEW_MAX_PIXELS
+    with Image.open(BytesIO(data)) as image:
+        # Lets the JPEG decoder downscale while decoding.
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+        output = BytesIO()
+        if has_alpha:
+            image.save(output, 'PNG', optimize=True)
+            content_type = 'image/png'
+        else:
+            image.convert('RGB').save(output, 'JPEG', quality=80, optimize=True)
+            content_type = 'image/jpeg'
+        return content_type, output.getvalue(), image.width, image.height
+
+
+def build_preview(kind, filename, content_type, data, cached_text=None):
+    """Return (kind, content type, data, width, height); errors give kind 'failed'."""
+    try:
+        if kind == 'image':
+            return ('image',) + render_thumbnail(data or b'')
+        text = cached_text if cached_text is not None else extract_text(classify(filename, content_type), data)
+        return 'text', 'text/plain; charset=utf-8', text[:PREVIEW_TEXT_CHARS].encode('utf-8'), None, None
+    except Exception as e:
+        logging.warning(f"Preview of {filename} failed: {str(e)}")
+        return 'failed', None, None, None, None
+
+
+def generate_pending(read_session, write_session, batch_size=PREVIEW_BATCH_SIZE, max_workers=PREVIEW_WORKERS):
+    """Build previews for every distinct attachment hash that has none yet.
+
+    Like attachment_text.extract_pending(), rows are read in a read session,
+    previews are rendered with no session open (at most max_workers at a
+    time in the shared process pool) and each batch is written in its own
+    short transaction. Returns the number of previews stored.
+    """
+    hash_pending_attachments(read_session, write_session, batch_size)
+    pending = pending_hashes(read_session, AttachmentPreview, Attachment.data.isnot(None))
+
+    can_thumbnail = pillow_available()
+    can_read_pdf = pdf_supported()
+    stored = 0
+    for offset in range(0, len(pending), batch_size):
+        with read_session() as session:
+            rows = session.execute(
+                select(Attachment.content_hash, Attachment.filename, Attachment.content_type, Attachment.data,
+                       AttachmentText.text)
+                .outerjoin(AttachmentText, AttachmentText.content_hash == Attachment.content_hash)
+                .where(Attachment.id.in_(pending[offset:offset + batch_size]))
+            ).all()
+
+        previews = {}
+        heavy = []
+        for digest, filename, content_type, data, cached_text in rows:
+            kind = preview_kind(filename, content_type)
+            if kind is None:
+                previews[digest] = ('unsupported', None, None, None, None)
+            elif kind == 'image' and not can_thumbnail:
+                continue
+            elif (cached_text is None and not can_read_pdf and kind == 'text'
+                  and classify(filename, content_type) == 'pdf'):
+                continue
+            elif kind == 'image' or cached_text is None:
+                heavy.append((digest, (kind, filename, content_type, data, cached_text)))
+            else:
+                previews[digest] = build_preview(kind, filename, content_type, data, cached_text)
+        results = run_in_pool(build_preview, [job for _, job in heavy], max_workers)
+        for (digest, _), result in zip(heavy, results):
+            previews[digest] = result
+
+        stored += store_by_hash(write_session, AttachmentPreview, [
+            AttachmentPreview(content_hash=digest, kind=kind, content_type=preview_type,
+                              data=preview_data, width=width, height=height)
+            for digest, (kind, preview_type, preview_data, width, height) in previews.items()
+        ])
+
+    if stored:
+        logging.info(f"Built previews for {stored} attachment(s)")
+    return stored
+
+
+def main():
+    from app import session_scope
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    generate_pending(session_scope, lambda: session_scope(write=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+# attachment_text.py
+"""
+Text extraction for stored attachments so /search can match their contents.
+
+Plain text, CSV and HTML are decoded directly, DOCX and XLSX are read from
+their XML parts, and PDFs go through pypdf, which handles compressed
+streams, font encodings and ToUnicode maps (the CID fonts Word and Outlook
+embed). Without pypdf installed, PDFs are left pending rather than cached
+as empty. PDF, DOCX and XLSX parsing is CPU heavy and runs in the process
+pool shared with export rendering, at most EXTRACT_WORKERS documents at a
+time; with EXTRACT_WORKERS=1 it runs in the calling process.
+
+Results are cached in the attachment_texts table keyed by the attachment's
+sha256 content hash, so identical attachments (the same PDF forwarded around
+a thread, a logo in every signature) are only processed once.
+
+Run directly to process everything pending:
+
+    python attachment_text.py
+"""
+import hashlib
+import logging
+import os
+import re
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+from html import unescape
+from io import BytesIO
+from xml.etree import ElementTree
+
+from sqlalchemy import func, select, update
+
+from ingestion import get_process_pool
+from models import Attachment, AttachmentText
+
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+EXTRACT_BATCH_SIZE = int(os.getenv('EXTRACT_BATCH_SIZE', '50'))
+# Extracted text is only used for matching and snippets; cap what is stored.
+MAX_TEXT_CHARS = int(os.getenv('EXTRACT_MAX_CHARS', '1000000'))
+
+TEXT_EXTENSIONS = {'.txt', '.csv', '.tsv', '.log', '.md', '.json', '.xml', '.eml'}
+HTML_EXTENSIONS = {'.html', '.htm'}
+# Document types worth shipping to a worker process.
+HEAVY_EXTRACTORS = {'pdf', 'docx', 'xlsx'}
+
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+
+def content_hash(data):
+    return hashlib.sha256(data or b'').hexdigest()
+
+
+def classify(filename, content_type):
+    """Pick the extractor name for an attachment, or None when unsupported."""
+    extension = os.path.splitext(filename or '')[1].lower()
+    content_type = (content_type or '').lower()
+    if extension == '.pdf' or content_type == 'application/pdf':
+        return 'pdf'
+    if extension == '.docx' or 'wordprocessingml' in content_type:
+        return 'docx'
+    if extension == '.xlsx' or 'spreadsheetml' in content_type:
+        return 'xlsx'
+    if extension in HTML_EXTENSIONS or content_type == 'text/html':
+        return 'html'
+    if extension in TEXT_EXTENSIONS or content_type.startswith('text/'):
+        return 'text'
+    return None
+
+
+def decode_text(data):
+    if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        try:
+            return data.decode('utf-16')
+        except UnicodeDecodeError:
+            pass
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def extract_html(data):
+    html = decode_text(data)
+    html = re.sub(r'(?is)<(script|style)\b.*?</\1>', ' ', html)
+    return unescape(re.sub(r'<[^>]+>', ' ', html))
+
+
+def extract_docx(data):
+    with zipfile.ZipFile(BytesIO(data)) as archive:
+        parts = [name for name in archive.namelist()
+                 if name == 'word/document.xml' or re.match(r'word/(header|footer)\d*\.xml$', name)]
+        paragraphs = []
+        for name in parts:
+            root = ElementTree.fromstring(archive.read(name))
+            for paragraph in root.iter(f'{WORD_NS}p'):
+                pieces = []
+                for node in paragraph.iter():
+                    if node.tag == f'{WORD_NS}t' and node.text:
+                        pieces.append(node.text)
+                    elif node.tag == f'{WORD_NS}tab':
+                        pieces.append('\t')
+                if pieces:
+                    paragraphs.append(''.join(pieces))
+    return '\n'.join(paragraphs)
+
+
+def extract_xlsx(data):
+    with zipfile.ZipFile(BytesIO(data)) as archive:
+        names = archive.namelist()
+        shared_strings = []
+        if 'xl/sharedStrings.xml' in names:
+            root = ElementTree.fromstring(archive.read('xl/sharedStrings.xml'))
+            for item in root.iter(f'{SHEET_NS}si'):
+                shared_strings.append(''.join(t.text or '' for t in item.iter(f'{SHEET_NS}t')))
+
+        rows = []
+        sheets = sorted(name for name in names if re.match(r'xl/worksheets/sheet\d+\.xml$', name))
+        for name in sheets:
+            root = ElementTree.fromstring(archive.read(name))
+            for row in root.iter(f'{SHEET_NS}row'):
+                cells = []
+                for cell in row.iter(f'{SHEET_NS}c'):
+                    cell_type = cell.get('t')
+                    if cell_type == 'inlineStr':
+                        cells.append(''.join(t.text or '' for t in cell.iter(f'{SHEET_NS}t')))
+                        continue
+                    value = cell.find(f'{SHEET_NS}v')
+                    if value is None or value.text is None:
+                        continue
+                    if cell_type == 's':
+                        index = int(value.text)
+                        cells.append(shared_strings[index] if index < len(shared_strings) else '')
+                    else:
+                        cells.append(value.text)
+                if cells:
+                    rows.append('\t'.join(cells))
+    return '\n'.join(rows)
+
+
+def pdf_supported():
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def extract_pdf(data):
+    from pypdf import PdfReader
+
+    reader = PdfReader(BytesIO(data))
+    if reader.is_encrypted:
+        # Many mailed PDFs are "encrypted" with an empty user password.
+        reader.decrypt('')
+    return '\n'.join(page.extract_text() or '' for page in reader.pages)
+
+
+EXTRACTORS = {
+    'text': decode_text,
+    'html': extract_html,
+    'docx': extract_docx,
+    'xlsx': extract_xlsx,
+    'pdf': extract_pdf,
+}
+
+
+def extract_text(extractor, data):
+    """Run one extractor; errors are logged and produce empty text."""
+    try:
+        text = EXTRACTORS[extractor](data or b'')
+    except Exception as e:
+        logging.warning(f"Text extraction ({extractor}) failed: {str(e)}")
+        return ''
+    text = re.sub(r'[ \t\r\f\v]+', ' ', text.replace('\x00', ''))
+    return text.strip()[:MAX_TEXT_CHARS]
+
+
+def run_in_pool(function, jobs, max_workers=EXTRACT_WORKERS):
+    """Return [function(*job) for job in jobs], computed in the shared process pool.
+
+    At most max_workers jobs are in flight at once, so one pass cannot queue
+    a whole batch of documents ahead of export rendering. With max_workers
+    of 1 the jobs run here instead.
+    """
+    if max_workers <= 1:
+        return [function(*job) for job in jobs]
+    pool = get_process_pool()
+    results = [None] * len(jobs)
+    in_flight = {}
+    for index, job in enumerate(jobs):
+        if len(in_flight) >= max_workers:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[in_flight.pop(future)] = future.result()
+        in_flight[pool.submit(function, *job)] = index
+    for future, index in in_flight.items():
+        results[index] = future.result()
+    return results
+
+
+def hash_pending_attachments(read_session, write_session, batch_size=EXTRACT_BATCH_SIZE):
+    """Fill in content_hash for attachments stored before hashing existed."""
+    hashed = 0
+    while True:
+        with read_session() as session:
+            rows = session.execute(
+                select(Attachment.id, Attachment.data)
+                .where(Attachment.content_hash.is_(None))
+                .limit(batch_size)
+            ).all()
+        if not rows:
+            return hashed
+        digests = [(attachment_id, content_hash(data)) for attachment_id, data in rows]
+        with write_session() as session:
+            for attachment_id, digest in digests:
+                session.execute(
+                    update(Attachment)
+                    .where(Attachment.id == attachment_id)
+                    .values(content_hash=digest)
+                )
+            session.commit()
+        hashed += len(rows)
+
+
+def pending_hashes(read_session, cache_model, *conditions):
+    """One attachment id for every content hash with no cache_model row yet."""
+    with read_session() as session:
+        return session.execute(
+            select(func.min(Attachment.id))
+            .outerjoin(cache_model, cache_model.content_hash == Attachment.content_hash)
+            .where(cache_model.content_hash.is_(None), Attachment.content_hash.isnot(None), *conditions)
+            .group_by(Attachment.content_hash)
+        ).scalars().all()
+
+
+def store_by_hash(write_session, cache_model, rows):
+    """Add cache_model rows, skipping hashes another pass stored meanwhile; returns how many were added."""
+    if not rows:
+        return 0
+    with write_session() as session:
+        stored = set(session.scalars(
+            select(cache_model.content_hash).where(cache_model.content_hash.in_([row.content_hash for row in rows]))
+        ))
+        added = [row for row in rows if row.content_hash not in stored]
+        session.add_all(added)
+        session.commit()
+    return len(added)
+
+
+def extract_pending(read_session, write_session, batch_size=EXTRACT_BATCH_SIZE, max_workers=EXTRACT_WORKERS):
+    """Extract text for every distinct attachment hash not yet in the cache.
+
+    read_session and write_session are session factories. Content is read a
+    batch at a time and extracted with no session open, and each batch is
+    written in its own short transaction, so the writer connection is never
+    held while documents are parsed. Returns the number of newly cached hashes.
+    """
+    hash_pending_attachments(read_session, write_session, batch_size)
+    pending = pending_hashes(read_session, AttachmentText)
+
+    extracted = 0
+    skipped_pdfs = 0
+    can_read_pdf = pdf_supported()
+    for offset in range(0, len(pending), batch_size):
+        with read_session() as session:
+            rows = session.execute(
+                select(Attachment.content_hash, Attachment.filename, Attachment.content_type, Attachment.data)
+                .where(Attachment.id.in_(pending[offset:offset + batch_size]))
+            ).all()
+
+        texts = {}
+        heavy = []
+        for digest, filename, content_type, data in rows:
+            extractor = classify(filename, content_type)
+            if extractor is None:
+                texts[digest] = ('unsupported', '')
+            elif extractor == 'pdf' and not can_read_pdf:
+                skipped_pdfs += 1
+            elif extractor in HEAVY_EXTRACTORS:
+                heavy.append((digest, extractor, data))
+            else:
+                texts[digest] = (extractor, extract_text(extractor, data))
+        results = run_in_pool(extract_text, [(extractor, data) for _, extractor, data in heavy], max_workers)
+        for (digest, extractor, _), text in zip(heavy, results):
+            texts[digest] = (extractor, text)
+
+        extracted += store_by_hash(write_session, AttachmentText, [
+            AttachmentText(content_hash=digest, extractor=extractor, text=text)
+            for digest, (extractor, text) in texts.items()
+        ])
+
+    if skipped_pdfs:
+        logging.warning(f"pypdf is not installed; {skipped_pdfs} PDF attachment(s) left for later")
+    if extracted:
+        logging.info(f"Extracted text for {extracted} attachment(s)")
+    return extracted
+
+
+def main():
+    from app import session_scope
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    extract_pending(session_scope, lambda: session_scope(write=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# benchmarks/bench_export.py
+"""
+Compare the /download-all-emails formats on a synthetic mailbox.
+
+Writes the same emails as the HTML ZIP (rendered pages, DEFLATE), the .eml
+ZIP and the mbox export, single process, and prints throughput and output
+size for each:
+
+    python benchmarks/bench_export.py --emails 5000 --body-kb 30 --attachment-kb 200
+"""
+import argparse
+import os
+import sys
+import time
+import zipfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytz
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from ingestion import (
+    EmlZipSink,
+    ExportMessage,
+    MboxSink,
+    ZipSink,
+    ZipStream,
+    render_chunk,
+    zip_entry_name,
+)
+
+
+def synthetic_messages(count, body_kb, attachment_kb):
+    paragraph = '<p>Quote Q-12345 for 40 units of <b>chlorine tablets</b>, delivery next week.</p>\n'
+    body = paragraph * max(1, body_kb * 1024 // len(paragraph))
+    # Random bytes stand in for PDFs and JPEGs: they do not compress further.
+    pdf = SimpleNamespace(filename='quote.pdf', content_type='application/pdf',
+                          data=os.urandom(attachment_kb * 1024), content_id=None, is_inline=False)
+    logo = SimpleNamespace(filename='logo.png', content_type='image/png', data=os.urandom(8 * 1024),
+                           content_id='logo@example', is_inline=True)
+    start = datetime(2024, 1, 1, tzinfo=pytz.UTC)
+    return [
+        ExportMessage(f'<order-{index}@example.com>', f'Order {index}', 'sales@example.com',
+                      'buyer@example.com, ops@example.com', start + timedelta(minutes=index), body,
+                      [pdf, logo] if attachment_kb else [])
+        for index in range(count)
+    ]
+
+
+def export_html(messages, stream, timezone_name):
+    # The HTML path: rendered pages are deflated, already-compressed attachments stored.
+    with ZipSink(stream) as sink:
+        rows = [(m.subject, m.sender, m.recipients, m.datetime_received, m.body) for m in messages]
+        for message, (base_name, html) in zip(messages, render_chunk(rows, timezone_name)):
+            sink.write_rendered(base_name, html, message.attachments)
+            yield stream.drain()
+    yield stream.drain()
+
+
+def export_html_deflate_all(messages, stream, timezone_name):
+    # The original ZIP path, which deflated already-compressed attachments too.
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        rows = [(m.subject, m.sender, m.recipients, m.datetime_received, m.body) for m in messages]
+        for message, (base_name, html) in zip(messages, render_chunk(rows, timezone_name)):
+            zipf.writestr(f'{base_name}.html', html)
+            for attachment in message.attachments:
+                zipf.writestr(f'{base_name}_attachments/{attachment.filename}', attachment.data)
+            yield stream.drain()
+    yield stream.drain()
+
+
+def export_eml(messages, stream, timezone_name):
+    with EmlZipSink(stream) as sink:
+        for message in messages:
+            sink.write_message(zip_entry_name(message, timezone_name), message, message.attachments)
+            yield stream.drain()
+    yield stream.drain()
+
+
+def export_mbox(messages, stream, timezone_name):
+    sink = MboxSink(stream)
+    for message in messages:
+        sink.write_message(message, message.attachments)
+        yield stream.drain()
+
+
+EXPORTS = {
+    'html (deflate all)': export_html_deflate_all,
+    'html': export_html,
+    'eml': export_eml,
+    'mbox': export_mbox,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=2000)
+    parser.add_argument('--body-kb', type=int, default=20)
+    parser.add_argument('--attachment-kb', type=int, default=200)
+    parser.add_argument('--timezone', default='US/Eastern')
+    args = parser.parse_args()
+
+    messages = synthetic_messages(args.emails, args.body_kb, args.attachment_kb)
+    attachments = f"{args.attachment_kb} KB PDF + 8 KB PNG each" if args.attachment_kb else "no attachments"
+    print(f"{args.emails} emails, {args.body_kb} KB bodies, {attachments}")
+    print(f"{'format':>20} {'seconds':>9} {'emails/s':>10} {'MB out':>8} {'MB/s out':>9} {'speedup':>8}")
+    baseline = None
+    for name, export in EXPORTS.items():
+        started = time.perf_counter()
+        written = sum(len(chunk) for chunk in export(messages, ZipStream(), args.timezone))
+        elapsed = time.perf_counter() - started
+        baseline = baseline or elapsed
+        megabytes = written / 1024 / 1024
+        print(f"{name:>20} {elapsed:>9.2f} {args.emails / elapsed:>10.0f} {megabytes:>8.1f} "
+              f"{megabytes / elapsed:>9.1f} {baseline / elapsed:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# benchmarks/bench_render.py
+"""
+Measure how bulk HTML rendering for /download-all-emails scales with cores.
+
+Renders a synthetic mailbox with iter_rendered_chunks() at increasing worker
+counts and prints messages per second and the speedup over one process:
+
+    python benchmarks/bench_render.py --emails 20000 --body-kb 40
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytz
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from ingestion import RENDER_CHUNK_SIZE, iter_rendered_chunks
+
+
+def synthetic_rows(count, body_kb):
+    paragraph = '<p>Quote Q-12345 for 40 units of <b>chlorine tablets</b>, delivery next week.</p>\n'
+    body = paragraph * max(1, body_kb * 1024 // len(paragraph))
+    start = datetime(2024, 1, 1, tzinfo=pytz.UTC)
+    return [
+        (f'Order {index}', 'sales@example.com', 'buyer@example.com, ops@example.com',
+         start + timedelta(minutes=index), body)
+        for index in range(count)
+    ]
+
+
+def chunked(rows, chunk_size):
+    for offset in range(0, len(rows), chunk_size):
+        yield offset, rows[offset:offset + chunk_size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=10000)
+    parser.add_argument('--body-kb', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=RENDER_CHUNK_SIZE)
+    parser.add_argument('--timezone', default='US/Eastern')
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.emails, args.body_kb)
+    cpu_count = os.cpu_count() or 1
+    worker_counts = sorted({1, 2, 4, 8, cpu_count} & set(range(1, cpu_count + 1)))
+
+    print(f"{args.emails} emails, {args.body_kb} KB bodies, chunks of {args.chunk_size}, {cpu_count} CPUs")
+    print(f"{'workers':>8} {'seconds':>9} {'emails/s':>10} {'speedup':>8}")
+    baseline = None
+    for workers in worker_counts:
+        started = time.perf_counter()
+        rendered = 0
+        for _, chunk in iter_rendered_chunks(chunked(rows, args.chunk_size), args.timezone, workers):
+            rendered += len(chunk)
+        elapsed = time.perf_counter() - started
+        baseline = baseline or elapsed
+        print(f"{workers:>8} {elapsed:>9.2f} {rendered / elapsed:>10.0f} {baseline / elapsed:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+# bulk_import.py
+"""
+Offline bulk import of .eml files, .msg files and mbox archives.
+
+Paths are walked in a stable order and cut into tasks: batches of
+IMPORT_BATCH_FILES .eml/.msg files, and byte ranges of roughly
+IMPORT_CHUNK_BYTES within each mbox file (aligned on "From " separator
+lines). Tasks are parsed in a process pool and written from the main process,
+one transaction per task. Each transaction also records the task in
+imported_sources, so an interrupted import resumes with the first unfinished
+task; messages already stored for the account (by Message-ID) are skipped.
+
+.msg files need the optional extract_msg package and are skipped without it.
+
+    python bulk_import.py ~/export/*.mbox ~/eml --account archive --defer-indexes
+"""
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from email import policy
+from email.parser import BytesParser
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+import pytz
+from sqlalchemy import select
+
+from ingestion import normalize_content_id, sanitize_filename
+from models import DEFAULT_ACCOUNT_ID, Attachment, Email, ImportedSource
+
+IMPORT_WORKERS = int(os.getenv('IMPORT_WORKERS', str(os.cpu_count() or 1)))
+IMPORT_BATCH_FILES = int(os.getenv('IMPORT_BATCH_FILES', '200'))
+IMPORT_CHUNK_BYTES = int(os.getenv('IMPORT_CHUNK_BYTES', str(32 * 1024 * 1024)))
+IMPORT_PROGRESS_SECONDS = float(os.getenv('IMPORT_PROGRESS_SECONDS', '10'))
+
+EML_SUFFIXES = ('.eml',)
+MSG_SUFFIXES = ('.msg',)
+MBOX_SUFFIXES = ('.mbox', '.mbx')
+# Message-IDs are matched in chunks to stay under SQL parameter limits.
+ID_LOOKUP_CHUNK = 500
+MBOX_SEPARATOR = re.compile(rb'^From ', re.MULTILINE)
+MBOX_QUOTED_FROM = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+
+class ImportTask:
+    """A unit of parsing work: a batch of files or a byte range of an mbox."""
+
+    __slots__ = ('kind', 'path', 'files', 'start', 'end', 'key', 'source')
+
+    def __init__(self, kind, path=None, files=(), start=0, end=0):
+        self.kind = kind
+        self.path = path
+        self.files = tuple(files)
+        self.start = start
+        self.end = end
+        if kind == 'mbox':
+            stat = os.stat(path)
+            self.source = f'{path}:{start}-{end}'
+            fingerprint = f'{self.source}:{stat.st_size}:{stat.st_mtime_ns}'
+        else:
+            self.source = f'{self.files[0]} (+{len(self.files) - 1} files)'
+            fingerprint = '\n'.join(
+                f'{name}:{os.stat(name).st_size}:{os.stat(name).st_mtime_ns}' for name in self.files
+            )
+        self.key = hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
+def find_mbox_boundary(handle, offset):
+    """Return the offset of the first "From " line at or after offset."""
+    handle.seek(offset)
+    if offset:
+        # Start from the next full line.
+        handle.readline()
+    while True:
+        position = handle.tell()
+        line = handle.readline()
+        if not line:
+            return position
+        if line.startswith(b'From '):
+            return position
+
+
+def mbox_ranges(path, chunk_bytes=IMPORT_CHUNK_BYTES):
+    """Split an mbox file into (start, end) byte ranges on message boundaries."""
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as handle:
+        start = find_mbox_boundary(handle, 0)
+        while start < size:
+            end = find_mbox_boundary(handle, start + chunk_bytes) if start + chunk_bytes < size else size
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def discover_tasks(paths, batch_files=IMPORT_BATCH_FILES, chunk_bytes=IMPORT_CHUNK_BYTES):
+    """Yield ImportTasks for every importable file under paths, in a stable order."""
+    files = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files.extend(sorted(p for p in path.rglob('*') if p.is_file()))
+        else:
+            files.append(path)
+
+    batch = []
+    for path in files:
+        suffix = path.suffix.lower()
+        if suffix in MBOX_SUFFIXES or (suffix == '' and path.name.lower() == 'mbox'):
+            for start, end in mbox_ranges(str(path), chunk_bytes):
+                yield ImportTask('mbox', str(path), start=start, end=end)
+        elif suffix in EML_SUFFIXES + MSG_SUFFIXES:
+            batch.append(str(path))
+            if len(batch) >= batch_files:
+                yield ImportTask('files', files=batch)
+                batch = []
+    if batch:
+        yield ImportTask('files', files=batch)
+
+
+def parse_received(value):
+    if not value:
+        return None
+    try:
+        received = parsedate_to_datetime(str(value))
+    except (TypeError, ValueError, IndexError):
+        return None
+    if received.tzinfo is None:
+        received = pytz.UTC.localize(received)
+    return received.astimezone(pytz.UTC)
+
+
+def header_addresses(message, name):
+    try:
+        header = message[name]
+        addresses = header.addresses if header is not None else ()
+    except Exception:
+        return []
+    return [address.addr_spec or address.display_name for address in addresses
+            if address.addr_spec or address.display_name]
+
+
+def iter_message_parts(part, body_part):
+    """Yield the leaf parts of a message except the chosen body; attached emails stay whole."""
+    if part is body_part:
+        return
+    if part.get_content_type() == 'message/rfc822':
+        yield part
+    elif part.is_multipart():
+        for child in part.iter_parts():
+            yield from iter_message_parts(child, body_part)
+    else:
+        yield part
+
+
+def part_attachment(part):
+    """Return an attachment tuple for a MIME part, or None for alternative body text."""
+    filename = part.get_filename()
+    content_id = normalize_content_id(part['Content-ID'])
+    disposition = part.get_content_disposition()
+    content_type = part.get_content_type()
+    if content_type == 'message/rfc822':
+        inner = part.get_payload()
+        data = inner[0].as_bytes() if isinstance(inner, list) and inner else b''
+        filename = filename or f"{(inner[0]['Subject'] if inner else None) or 'attached_email'}.eml"
+    else:
+        if not (filename or content_id or disposition == 'attachment'):
+            return None
+        data = part.get_payload(decode=True) or b''
+    return (sanitize_filename(filename or 'attachment'), content_type, data, content_id, disposition == 'inline')
+
+
+def parse_message_bytes(raw, folder=None):
+    """Parse an RFC 822 message into a record tuple for store_records()."""
+    message = BytesParser(policy=policy.default).parsebytes(raw)
+    message_id = (str(message['Message-ID'] or '').strip()
+                  or 'sha256:' + hashlib.sha256(raw).hexdigest())
+
+    body_part = message.get_body(preferencelist=('html', 'plain'))
+    body = None
+    if body_part is not None:
+        try:
+            body = body_part.get_content()
+        except (LookupError, ValueError):
+            body = (body_part.get_payload(decode=True) or b'').decode('utf-8', 'replace')
+
+    attachments = [
+        attachment for attachment in map(part_attachment, iter_message_parts(message, body_part))
+        if attachment is not None
+    ]
+    senders = header_addresses(message, 'From')
+    return (
+        message_id[:255],
+        str(message['Subject'] or '') or None,
+        senders[0] if senders else None,
+        ', '.join(header_addresses(message, 'To')),
+        parse_received(message['Date']),
+        body,
+        folder,
+        attachments,
+    )
+
+
+def parse_msg_file(path, folder=None):
+    """Parse an Outlook .msg file; requires the optional extract_msg package."""
+    import extract_msg
+
+    message = extract_msg.Message(path)
+    try:
+        body = message.htmlBody
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        body = body or message.body
+        received = message.date
+        if isinstance(received, datetime):
+            received = pytz.UTC.localize(received) if received.tzinfo is None else received.astimezone(pytz.UTC)
+        else:
+            received = parse_received(received)
+        attachments = []
+        for attachment in message.attachments:
+            data = attachment.data
+            if not isinstance(data, bytes):
+                continue
+            filename = getattr(attachment, 'longFilename', None) or getattr(attachment, 'shortFilename', None)
+            attachments.append((
+                sanitize_filename(filename or 'attachment'),
+                getattr(attachment, 'mimetype', None),
+                data,
+                normalize_content_id(getattr(attachment, 'cid', None)),
+                False,
+            ))
+        message_id = (message.messageId or '').strip()
+        if not message_id:
+            with open(path, 'rb') as handle:
+                message_id = 'sha256:' + hashlib.sha256(handle.read()).hexdigest()
+        return (message_id[:255], message.subject, message.sender, message.to or '', received, body, folder,
+                attachments)
+    finally:
+        message.close()
+
+
+def iter_mbox_messages(path, start, end):
+    with open(path, 'rb') as handle:
+        handle.seek(start)
+        data = handle.read(end - start)
+    offsets = [match.start() for match in MBOX_SEPARATOR.finditer(data)] + [len(data)]
+    for begin, finish in zip(offsets, offsets[1:]):
+        chunk = data[begin:finish]
+        # Drop the "From " envelope line and undo mboxrd ">From " quoting.
+        yield MBOX_QUOTED_FROM.sub(rb'\1', chunk[chunk.find(b'\n') + 1:])
+
+
+def parse_task(task):
+    """Parse one ImportTask into (records, failed). Runs in worker processes."""
+    records = []
+    failed = 0
+    if task.kind == 'mbox':
+        folder = Path(task.path).stem
+        for raw in iter_mbox_messages(task.path, task.start, task.end):
+            try:
+                records.append(parse_message_bytes(raw, folder))
+            except Exception as e:
+                failed += 1
+                logging.error(f"Could not parse message in {task.path}: {str(e)}")
+        return records, failed
+
+    for name in task.files:
+        folder = Path(name).parent.name or None
+        try:
+            if name.lower().endswith(MSG_SUFFIXES):
+                records.append(parse_msg_file(name, folder))
+            else:
+                with open(name, 'rb') as handle:
+                    records.append(parse_message_bytes(handle.read(), folder))
+        except ImportError:
+            failed += 1
+            logging.warning(f"Skipping {name}: install extract_msg to import .msg files")
+        except Exception as e:
+            failed += 1
+            logging.error(f"Could not parse {name}: {str(e)}")
+    return records, failed
+
+
+def iter_parsed_tasks(tasks, max_workers=IMPORT_WORKERS):
+    """Parse tasks across a process pool, yielding (task, (records, failed)) in order."""
+    if max_workers <= 1:
+        for task in tasks:
+            yield task, parse_task(task)
+        return
+
+    context = multiprocessing.get_context(os.getenv('IMPORT_MP_CONTEXT') or None)
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+        in_flight = deque()
+        for task in tasks:
+            in_flight.append((task, pool.submit(parse_task, task)))
+            if len(in_flight) >= max_workers * 2:
+                done_task, future = in_flight.popleft()
+                yield done_task, future.result()
+        while in_flight:
+            done_task, future = in_flight.popleft()
+            yield done_task, future.result()
+
+
+def existing_message_ids(session, account_id, message_ids):
+    message_ids = list(message_ids)
+    existing = set()
+    for offset in range(0, len(message_ids), ID_LOOKUP_CHUNK):
+        chunk = message_ids[offset:offset + ID_LOOKUP_CHUNK]
+        existing.update(session.scalars(
+            select(Email.message_id).where(Email.account_id == account_id, Email.message_id.in_(chunk))
+        ))
+    return existing
+
+
+def store_records(session, records, account_id=DEFAULT_ACCOUNT_ID):
+    """Add parsed records not yet stored for the account; returns how many were added."""
+    seen = existing_message_ids(session, account_id, {record[0] for record in records})
+    emails = []
+    for message_id, subject, sender, recipients, received, body, folder, attachments in records:
+        if message_id in seen:
+            continue
+        seen.add(message_id)
+        email_record = Email(
+            message_id=message_id,
+            account_id=account_id,
+            subject=subject,
+            sender=sender,
+            recipients=recipients,
+            datetime_received=received,
+            body=body,
+            folder=folder,
+        )
+        for filename, content_type, data, content_id, is_inline in attachments:
+            email_record.attachments.append(Attachment(
+                filename=filename,
+                content_type=content_type,
+                data=data,
+                size=len(data),
+                content_id=content_id,
+                is_inline=bool(is_inline),
+                content_hash=hashlib.sha256(data).hexdigest(),
+            ))
+        emails.append(email_record)
+    session.add_all(emails)
+    return len(emails)
+
+
+def completed_task_keys(session):
+    return set(session.scalars(select(ImportedSource.key)))
+
+
+@contextmanager
+def deferred_indexes(bind):
+    """Drop the secondary email/attachment indexes, recreating them on exit.
+
+    The (account_id, message_id) unique index stays: deduplication needs it.
+    """
+    indexes = [
+        index
+        for table in (Email.__table__, Attachment.__table__)
+        for index in table.indexes
+        if not index.unique
+    ]
+    for index in indexes:
+        index.drop(bind, checkfirst=True)
+    try:
+        yield
+    finally:
+        logging.info(f"Rebuilding {len(indexes)} indexes")
+        for index in indexes:
+            index.create(bind, checkfirst=True)
+
+
+def import_paths(paths, session_factory, account_id=DEFAULT_ACCOUNT_ID, max_workers=IMPORT_WORKERS,
+                 batch_files=IMPORT_BATCH_FILES, chunk_bytes=IMPORT_CHUNK_BYTES, clock=time.monotonic):
+    """Import every .eml/.msg/mbox under paths; returns counts and the message rate."""
+    with session_factory() as session:
+        done = completed_task_keys(session)
+
+    stats = {'emails': 0, 'duplicates': 0, 'failed': 0, 'skipped_tasks': 0, 'tasks': 0}
+    pending = []
+    for task in discover_tasks(paths, batch_files, chunk_bytes):
+        if task.key in done:
+            stats['skipped_tasks'] += 1
+        else:
+            pending.append(task)
+
+    started = last_report = clock()
+    for task, (records, failed) in iter_parsed_tasks(pending, max_workers):
+        with session_factory() as session:
+            added = store_records(session, records, account_id)
+            session.add(ImportedSource(key=task.key, source=task.source, email_count=added))
+        stats['tasks'] += 1
+        stats['emails'] += added
+        stats['duplicates'] += len(records) - added
+        stats['failed'] += failed
+
+        now = clock()
+        if now - last_report >= IMPORT_PROGRESS_SECONDS:
+            last_report = now
+            rate = stats['emails'] / max(now - started, 1e-9)
+            logging.info(f"Imported {stats['emails']} emails from {stats['tasks']}/{len(pending)} tasks "
+                         f"({rate:.0f} msgs/sec)")
+
+    elapsed = clock() - started
+    stats['seconds'] = round(elapsed, 3)
+    stats['rate'] = round(stats['emails'] / elapsed, 1) if elapsed > 0 else 0.0
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import .eml, .msg and mbox files into the email database.')
+    parser.add_argument('paths', nargs='+', help='files or directories to import')
+    parser.add_argument('--account', default=DEFAULT_ACCOUNT_ID, help='account id to file the messages under')
+    parser.add_argument('--workers', type=int, default=IMPORT_WORKERS, help='parser processes')
+    parser.add_argument('--batch-files', type=int, default=IMPORT_BATCH_FILES,
+                        help='.eml/.msg files per transaction')
+    parser.add_argument('--chunk-bytes', type=int, default=IMPORT_CHUNK_BYTES,
+                        help='mbox bytes per transaction')
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help='drop secondary indexes during the import and rebuild them at the end')
+    args = parser.parse_args(argv)
+
+    from app import initialize_database, session_scope, writer_engine
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    initialize_database()
+    options = dict(account_id=args.account, max_workers=args.workers, batch_files=args.batch_files,
+                   chunk_bytes=args.chunk_bytes)
+    if args.defer_indexes:
+        with deferred_indexes(writer_engine):
+            stats = import_paths(args.paths, lambda: session_scope(write=True), **options)
+    else:
+        stats = import_paths(args.paths, lambda: session_scope(write=True), **options)
+    logging.info(f"Import finished: {stats}")
+
+
+if __name__ == '__main__':
+    main()
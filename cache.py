@@ -0,0 +1,332 @@
+# cache.py
+"""
+Cache backends shared by the web app and the ingestion helpers.
+
+Every backend implements the same small interface (get/set/delete plus
+integer counters) and keeps hit/miss statistics:
+
+    MemoryCache  in-process LRU bounded by entry count and bytes
+    RedisCache   any Redis-protocol server, shared by every waitress process;
+                 an outage degrades to cache misses
+    DiskCache    a SQLite file, shared by processes on one host and kept
+                 across restarts
+
+create_cache() picks one from a URL such as CACHE_URL=redis://localhost:6379/0,
+sqlite:///cache.db or memory://. Values must be JSON serializable.
+
+ResultCache layers generations on top of a backend: bump() increments a
+counter stored in the backend, which orphans every entry cached under the
+previous generation in all processes at once, and put() ignores values
+computed under an older generation, so a search that raced with an ingest
+never stores a stale answer.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_size(value):
+    """Approximate the memory held by a JSON-serializable value."""
+    return len(json.dumps(value, default=str))
+
+
+class CacheBackend:
+    """Interface shared by the cache backends."""
+
+    name = 'base'
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def incr(self, key):
+        """Atomically increment an integer counter and return the new value."""
+        raise NotImplementedError
+
+    def counter(self, key):
+        raise NotImplementedError
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+class MemoryCache(CacheBackend):
+    name = 'memory'
+
+    def __init__(self, max_entries=256, max_bytes=16 * 1024 * 1024):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size, expires_at)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(entries=len(self._entries), bytes=self._bytes)
+        return stats
+
+
+class RedisCache(CacheBackend):
+    """Backend for any Redis-protocol server; pass client= to reuse one (e.g. fakeredis).
+
+    The server is pinged on construction, so create_cache() can fall back to
+    memory when it is unreachable. Later outages are treated as cache misses
+    (and writes are dropped) rather than failing the request.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url='redis://localhost:6379/0', client=None, prefix='outlook:'):
+        super().__init__()
+        import redis
+
+        if client is None:
+            client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        client.ping()
+        self.client = client
+        self.prefix = prefix
+        self.errors = 0
+        self._error_types = (redis.RedisError, OSError)
+
+    def _call(self, default, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except self._error_types as e:
+            self.errors += 1
+            if self.errors == 1 or self.errors % 1000 == 0:
+                logging.error(f"Redis cache unavailable ({self.errors} errors), serving without it: {str(e)}")
+            return default
+
+    def _get(self, key):
+        raw = self._call(None, self.client.get, self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self._call(None, self.client.set, self.prefix + key, json.dumps(value, default=str), ex=ttl or None)
+
+    def delete(self, key):
+        self._call(None, self.client.delete, self.prefix + key)
+
+    def incr(self, key):
+        return int(self._call(0, self.client.incr, self.prefix + key))
+
+    def counter(self, key):
+        return int(self._call(None, self.client.get, self.prefix + key) or 0)
+
+    def stats(self):
+        stats = super().stats()
+        stats['errors'] = self.errors
+        return stats
+
+
+class DiskCache(CacheBackend):
+    """SQLite-file backend; entries beyond max_entries or max_bytes are pruned oldest first.
+
+    Pruning runs every 100 writes, or sooner once a tenth of max_bytes has
+    been written since the last prune, so the file can briefly overshoot.
+    """
+
+    name = 'disk'
+
+    def __init__(self, path, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        super().__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._written_bytes = 0
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache_entries '
+            '(key TEXT PRIMARY KEY, value TEXT, expires_at REAL, stored_at REAL)'
+        )
+        self._connection.execute('CREATE TABLE IF NOT EXISTS cache_counters (key TEXT PRIMARY KEY, value INTEGER)')
+
+    def _get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value, expires_at FROM cache_entries WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        payload = json.dumps(value, default=str)
+        if len(payload) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO cache_entries (key, value, expires_at, stored_at) VALUES (?, ?, ?, ?)',
+                (key, payload, now + ttl if ttl else None, now),
+            )
+            self._writes += 1
+            self._written_bytes += len(payload)
+            if self._writes % 100 == 0 or self._written_bytes * 10 > self.max_bytes:
+                self._prune(now)
+
+    def _prune(self, now):
+        self._written_bytes = 0
+        self._connection.execute('DELETE FROM cache_entries WHERE expires_at <= ?', (now,))
+        self._connection.execute(
+            'DELETE FROM cache_entries WHERE key IN '
+            '(SELECT key FROM cache_entries ORDER BY stored_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,),
+        )
+        # Newest first: everything past the byte budget goes.
+        self._connection.execute(
+            'DELETE FROM cache_entries WHERE key IN (SELECT key FROM '
+            '(SELECT key, SUM(LENGTH(value)) OVER (ORDER BY stored_at DESC, key) AS total FROM cache_entries) '
+            'WHERE total > ?)',
+            (self.max_bytes,),
+        )
+
+    def delete(self, key):
+        with self._lock:
+            self._connection.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+
+    def incr(self, key):
+        with self._lock:
+            self._connection.execute(
+                'INSERT INTO cache_counters (key, value) VALUES (?, 1) '
+                'ON CONFLICT(key) DO UPDATE SET value = value + 1',
+                (key,),
+            )
+            return self.counter(key)
+
+    def counter(self, key):
+        row = self._connection.execute('SELECT value FROM cache_counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+
+def create_cache(url=None, max_entries=256, max_bytes=16 * 1024 * 1024):
+    """Build a backend from a cache URL; anything unusable falls back to memory."""
+    url = (url or 'memory://').strip()
+    try:
+        if url.startswith(('redis://', 'rediss://', 'unix://')):
+            return RedisCache(url)
+        if url.startswith('sqlite:///'):
+            return DiskCache(url[len('sqlite:///'):], max_entries=max_entries, max_bytes=max_bytes)
+    except Exception as e:
+        logging.error(f"Cache backend {url} unavailable, using memory: {str(e)}")
+    return MemoryCache(max_entries=max_entries, max_bytes=max_bytes)
+
+
+class ResultCache:
+    """Generation-scoped results stored in a cache backend.
+
+    The generation lives in the backend unless generation_source is given:
+    a callable returning the current generation from elsewhere, such as a
+    counter in the database that every writer process bumps.
+    """
+
+    def __init__(self, backend=None, namespace='results', ttl=None, generation_source=None):
+        self.backend = backend if backend is not None else MemoryCache()
+        self.namespace = namespace
+        self.ttl = ttl
+        self.generation_source = generation_source
+
+    @property
+    def generation(self):
+        if self.generation_source is not None:
+            return self.generation_source()
+        return self.backend.counter(f'{self.namespace}:generation')
+
+    def _key(self, key, generation):
+        return f'{self.namespace}:{generation}:{json.dumps(key)}'
+
+    def get(self, key, generation=None):
+        if generation is None:
+            generation = self.generation
+        return self.backend.get(self._key(key, generation))
+
+    def put(self, key, value, generation=None):
+        """Cache value unless it was computed under an older generation."""
+        current = self.generation
+        if generation is not None and generation != current:
+            return
+        self.backend.set(self._key(key, current), value, self.ttl)
+
+    def bump(self):
+        """Start a new generation; entries from older ones are never read again."""
+        return self.backend.incr(f'{self.namespace}:generation')
@@ -0,0 +1,297 @@
+# compression.py
+"""
+Negotiated response compression for the web app.
+
+Responses with a text-like content type (HTML, JSON, NDJSON, CSS, JS, SVG)
+are compressed with brotli when the client accepts it and a brotli binding
+is installed: the brotli package from requirements.txt, or brotlicffi (its
+CFFI build, for PyPy). Without either, gzip is the only encoding offered.
+Already-compressed attachments (PDF, Office, archives, JPEG...) and small
+bodies are sent as they are. Streamed responses, and file responses from
+send_file and static files, are compressed chunk by chunk rather than read
+into memory.
+
+Bodies that are the same on every hit - rendered email views, static assets
+and anything carrying an ETag - are compressed once and the compressed
+variant kept in an in-process LRU bounded by COMPRESS_CACHE_BYTES, keyed by
+path and ETag or by a digest of the body. In-memory bodies are compressed at
+a higher level for the cache; files are cached as they were streamed.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import request
+from werkzeug.http import parse_options_header
+
+from ingestion import is_precompressed
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '500'))
+# Larger in-memory bodies are sent uncompressed.
+COMPRESS_MAX_SIZE = int(os.getenv('COMPRESS_MAX_SIZE', str(8 * 1024 * 1024)))
+COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', '5'))
+# Cached variants are compressed once, so they can afford more effort.
+COMPRESS_CACHED_GZIP_LEVEL = int(os.getenv('COMPRESS_CACHED_GZIP_LEVEL', '9'))
+COMPRESS_CACHED_BROTLI_QUALITY = int(os.getenv('COMPRESS_CACHED_BROTLI_QUALITY', '9'))
+COMPRESS_CACHE_BYTES = int(os.getenv('COMPRESS_CACHE_BYTES', str(32 * 1024 * 1024)))
+# Endpoints whose bodies are worth caching compressed even without an ETag.
+COMPRESS_CACHE_ENDPOINTS = frozenset(
+    os.getenv('COMPRESS_CACHE_ENDPOINTS', 'view,view_archived,index').split(',')
+)
+
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/x-ndjson', 'application/javascript',
+    'application/xml', 'application/xhtml+xml', 'image/svg+xml',
+)
+
+_brotli = None
+
+
+def brotli_module():
+    """The brotli or brotlicffi module, or None when neither is installed."""
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli as module
+        except ImportError:
+            try:
+                import brotlicffi as module
+            except ImportError:
+                module = False
+        _brotli = module
+    return _brotli or None
+
+
+def is_compressible(mimetype):
+    return (mimetype or '').lower().startswith(COMPRESSIBLE_TYPES)
+
+
+def compress_body(data, encoding, cached=False):
+    if encoding == 'br':
+        quality = COMPRESS_CACHED_BROTLI_QUALITY if cached else COMPRESS_BROTLI_QUALITY
+        return brotli_module().compress(data, quality=quality)
+    level = COMPRESS_CACHED_GZIP_LEVEL if cached else COMPRESS_GZIP_LEVEL
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding, flush_chunks=True):
+    """Compress an iterable of byte chunks.
+
+    With flush_chunks the output is flushed after every chunk, so clients see
+    streamed rows promptly; file contents are compressed without the flushes.
+    """
+    if encoding == 'br':
+        compressor = brotli_module().Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        # brotli uses process(); brotlicffi calls it compress().
+        process = getattr(compressor, 'process', None) or compressor.compress
+        flush, finish = compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+        process = compressor.compress
+        flush, finish = (lambda: compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            output = process(chunk) + flush() if flush_chunks else process(chunk)
+            if output:
+                yield output
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class ResponseCompressor:
+    """after_request hook compressing responses and caching compressed variants."""
+
+    def __init__(self, min_size=COMPRESS_MIN_SIZE, max_size=COMPRESS_MAX_SIZE, cache_bytes=COMPRESS_CACHE_BYTES,
+                 cache_endpoints=COMPRESS_CACHE_ENDPOINTS):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.cache_bytes = cache_bytes
+        self.cache_endpoints = cache_endpoints
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def install(self, app):
+        app.after_request(self.compress)
+
+    def encodings(self):
+        return ('br', 'gzip') if brotli_module() else ('gzip',)
+
+    def negotiate(self):
+        """The best encoding the client accepts, or None."""
+        return request.accept_encodings.best_match(self.encodings())
+
+    def compress(self, response):
+        if (response.status_code != 200 or request.method == 'HEAD'
+                or 'Content-Encoding' in response.headers or response.cache_control.no_transform
+                or not is_compressible(response.mimetype)):
+            return response
+        _, options = parse_options_header(response.headers.get('Content-Disposition', ''))
+        if is_precompressed(response.mimetype, options.get('filename')):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+
+        try:
+            if response.direct_passthrough:
+                # A file from send_file or the static folder: compress it as it
+                # is sent instead of reading it into memory.
+                if response.content_length is not None and response.content_length < self.min_size:
+                    return response
+                self._compress_file(response, encoding)
+            elif response.is_streamed:
+                response.response = self._stream(response.response, encoding)
+                response.headers.pop('Content-Length', None)
+            elif not self._compress_body(response, encoding):
+                return response
+        except Exception as e:
+            logging.error(f"Could not compress {request.path}: {str(e)}")
+            return response
+
+        response.headers['Content-Encoding'] = encoding
+        response.headers.pop('Accept-Ranges', None)
+        etag, _ = response.get_etag()
+        if etag:
+            # A different representation of the same resource.
+            response.set_etag(etag, weak=True)
+        return response
+
+    def _compress_file(self, response, encoding):
+        """Serve a cached compressed variant of a file, or compress it as it streams.
+
+        Files with an ETag (static assets) and a known size up to max_size
+        are cached by path, ETag and encoding once fully sent.
+        """
+        key = None
+        if response.content_length is not None and response.content_length <= self.max_size:
+            etag, _ = response.get_etag()
+            key = (f'{request.path}:{etag}', encoding) if etag else None
+        compressed = self.cache_get(key) if key else None
+        response.direct_passthrough = False
+        if compressed is not None:
+            response.close()
+            with self._lock:
+                self.bytes_in += response.content_length
+                self.bytes_out += len(compressed)
+            response.set_data(compressed)
+            return
+        response.response = self._stream(response.response, encoding, flush_chunks=False, cache_key=key)
+        response.headers.pop('Content-Length', None)
+
+    def _stream(self, chunks, encoding, flush_chunks=True, cache_key=None):
+        """compress_stream(), counting bytes and caching the output under cache_key once complete."""
+        sizes = {'in': 0, 'out': 0}
+        output = [] if cache_key else None
+        complete = False
+
+        def counted():
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                sizes['in'] += len(chunk)
+                yield chunk
+
+        try:
+            for data in compress_stream(counted(), encoding, flush_chunks):
+                sizes['out'] += len(data)
+                if output is not None:
+                    output = output if sizes['out'] <= self.cache_bytes else None
+                    if output is not None:
+                        output.append(data)
+                yield data
+            complete = True
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            with self._lock:
+                self.bytes_in += sizes['in']
+                self.bytes_out += sizes['out']
+            if complete and output is not None:
+                self.cache_set(cache_key, b''.join(output))
+
+    def _compress_body(self, response, encoding):
+        data = response.get_data()
+        if len(data) < self.min_size or len(data) > self.max_size:
+            return False
+
+        key = self.cache_key(response, data)
+        compressed = self.cache_get((key, encoding)) if key else None
+        if compressed is None:
+            compressed = compress_body(data, encoding, cached=key is not None)
+            if key:
+                self.cache_set((key, encoding), compressed)
+        if len(compressed) >= len(data):
+            return False
+        with self._lock:
+            self.bytes_in += len(data)
+            self.bytes_out += len(compressed)
+        response.set_data(compressed)
+        return True
+
+    def cache_key(self, response, data):
+        """Key for the compressed variant of this body, or None when it is not cached."""
+        etag, _ = response.get_etag()
+        if etag:
+            return f'{request.path}:{etag}'
+        if request.endpoint in self.cache_endpoints:
+            return hashlib.blake2b(data, digest_size=16).hexdigest()
+        return None
+
+    def cache_get(self, key):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return value
+
+    def cache_set(self, key, value):
+        if len(value) > self.cache_bytes:
+            return
+        with self._lock:
+            previous = self._cache.pop(key, None)
+            if previous is not None:
+                self._cached_bytes -= len(previous)
+            self._cache[key] = value
+            self._cached_bytes += len(value)
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'encodings': list(self.encodings()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'entries': len(self._cache),
+                'bytes': self._cached_bytes,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': round(self.bytes_out / self.bytes_in, 4) if self.bytes_in else None,
+            }
+
+
+response_compressor = ResponseCompressor()
@@ -1,201 +1,120 @@
 # email_processor.py
-EXCHANGE_EMAIL='gpgaskin@autochlor.com'
-EXCHANGE_DOMAIN_USERNAME='autochlor\\gpgaskin'
-EXCHANGE_PASSWORD='redtag19'
-EXCHANGE_SERVER='london.autochlor.net'
-EXCHANGE_VERSION='Exchange2016'
-OUTPUT_DIR='gpg2/'
-TIMEZONE='US/Eastern'
-DAYS_AGO=5
+"""
+Export emails and attachments to the file system.
 
-import os
-import re
+Thin command line wrapper around ingestion.py: messages come from the live
+Exchange mailbox (or the app database with --from-db) and are written by a
+FilesystemSink, or into a ZIP archive with --zip.
+"""
+import argparse
 import logging
-from datetime import datetime, timedelta
-from exchangelib import Credentials, Account, DELEGATE, Message, FileAttachment, ItemAttachment, Configuration
-from exchangelib.errors import ErrorTooManyObjectsOpened
-import pytz
-from pathlib import Path
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-email = EXCHANGE_EMAIL
-domain_username = EXCHANGE_DOMAIN_USERNAME
-password = EXCHANGE_PASSWORD
-server = EXCHANGE_SERVER
-version = EXCHANGE_VERSION
-output_dir = OUTPUT_DIR
-timezone_name = TIMEZONE
-days_ago = DAYS_AGO
-
-def sanitize_filename(filename):
-    """Sanitize the filename by removing or replacing invalid characters."""
-    invalid_chars = r'[<>:"/\\|?*\x00-\x1f]'
-    filename = re.sub(invalid_chars, '_', filename)
-    filename = filename.rstrip('. ')
-    if not filename:
-        filename = 'unnamed'
-    if len(filename) > 245:  
-        filename = filename[:245]
-    return filename
-
-def replace_cid_urls(body, email_out, output_dir):
-    """
-    Replace 'cid:' URLs in the email body with valid HTTP URLs pointing to attachment files.
+import os
+
+from ingestion import (
+    EXPORT_WORKERS,
+    MANIFEST_NAME,
+    ExportEngine,
+    FilesystemSink,
+    ZipSink,
+    connect_account,
+    get_time_frame,
+    ingest,
+    iter_folder_messages,
+    load_settings,
+    replace_cid_urls,
+    sanitize_filename,
+)
+
+__all__ = [
+    'MANIFEST_NAME',
+    'ExportEngine',
+    'export_database',
+    'export_exchange',
+    'main',
+    'replace_cid_urls',
+    'sanitize_filename',
+]
+
+
+def export_database(output_dir, session, engine=None, max_workers=EXPORT_WORKERS, sink=None):
+    """Export every email stored in the app database to output_dir.
+
+    Uses the same file layout and resume manifest as the Exchange export.
+    With sink (a ZipSink for --zip) the messages are written there instead.
+    Returns the number of messages exported in this run.
     """
-    if body is None:
-        return ""
-        
-    try:
-        def cid_replacer(match):
-            cid = match.group(1)
-            # Assuming the cid corresponds to the attachment filename
-            attachment_url = f"/gpg2/{email_out}_attachments/{cid}"
-            return f'src="{attachment_url}"'
-        
-        # Replace all src="cid:filename" with src="/gpg2/.../filename"
-        pattern = r'src=["\']cid:(.*?)["\']'
-        replaced_body = re.sub(pattern, cid_replacer, body, flags=re.IGNORECASE)
-        return replaced_body
-    except Exception as e:
-        logging.error(f"Error replacing CID URLs: {str(e)}")
-        return body if body else ""
-
-def process_email(account, email_folder, output_dir, time_frame):
-    """Process emails in the specified folder."""
-    try:
-        for item in email_folder.filter(datetime_received__gte=time_frame).order_by('-datetime_received'):
-            if isinstance(item, Message):
-                try:
-                    yield process_email_item(account, item, output_dir)
-                except Exception as e:
-                    logging.error(f"Error processing individual email: {str(e)}")
-                    yield f"error_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    except ErrorTooManyObjectsOpened as e:
-        logging.error(f"Too many objects error: {e}")
-    except Exception as e:
-        logging.error(f"Unexpected error in email processing: {str(e)}")
-        yield f"error_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-
-def process_email_item(account, item, output_dir):
-    """Process a single email item."""
-    try:
-        # Defensive programming: validate inputs
-        if not item:
-            logging.error("Received empty item to process")
-            return f"error_empty_item_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-            
-        recipient_name = sanitize_filename(item.to_recipients[0].name) if item.to_recipients else 'Unknown_Recipient'
-        subject = sanitize_filename(item.subject) if item.subject else 'No_Subject'
-        
-        # Ensure datetime_received exists and is valid
-        if not hasattr(item, 'datetime_received') or not item.datetime_received:
-            received_time = datetime.now().strftime('%m-%d-%Y_%I-%M%p')
-            logging.warning(f"Item missing datetime_received, using current time: {received_time}")
-        else:
-            received_time = item.datetime_received.strftime('%m-%d-%Y_%I-%M%p')
-            
-        email_out = f"to_{recipient_name} - {subject} - {received_time}"
-        
-        # Save the email contents to a file named email.html
-        email_filename = f"{output_dir}{email_out}.html"
-        try:
-            with open(email_filename, 'w', encoding='utf-8') as f:
-                f.write(f"<html><body>\n")
-                f.write(f"<h1>Subject: {item.subject}</h1>\n")
-                f.write(f"<p><strong>Received:</strong> {item.datetime_received}</p>\n")
-                
-                # Handle potential null sender
-                sender_email = item.sender.email_address if hasattr(item, 'sender') and item.sender else 'Unknown'
-                f.write(f"<p><strong>Sender:</strong> {sender_email}</p>\n")
-                
-                # Handle recipients
-                if hasattr(item, 'to_recipients') and item.to_recipients:
-                    to_addresses = ', '.join([r.email_address for r in item.to_recipients if hasattr(r, 'email_address')])
-                    f.write(f"<p><strong>To:</strong> {to_addresses}</p>\n")
-                else:
-                    f.write("<p><strong>To:</strong> Unknown Recipients</p>\n")
-                
-                # Handle body content safely
-                body_content = item.body if hasattr(item, 'body') and item.body else ""
-                sanitized_body = replace_cid_urls(body_content, email_out, output_dir)
-                f.write(f"<p><strong>Body:</strong></p>\n")
-                f.write(f"{sanitized_body}\n")
-                f.write(f"</body></html>\n")
-        except Exception as e:
-            logging.error(f"Error writing email file {email_filename}: {str(e)}")
-        
-        # Save attachments
-        attachment_dir = f"{output_dir}{email_out}_attachments/"
-        Path(attachment_dir).mkdir(parents=True, exist_ok=True)
-        for attachment in item.attachments:
-            if isinstance(attachment, FileAttachment):
-                safe_attachment_name = sanitize_filename(attachment.name)
-                attachment_filename = f"{attachment_dir}{safe_attachment_name}"
-                try:
-                    with open(attachment_filename, 'wb') as f:
-                        f.write(attachment.content)
-                except Exception as e:
-                    logging.error(f"Error saving attachment {attachment.name}: {str(e)}")
-            elif isinstance(attachment, ItemAttachment):
-                try:
-                    attached_item = attachment.item
-                    attached_subject = sanitize_filename(attached_item.subject)
-                    attached_received_time = attached_item.datetime_received.strftime('%m-%d-%Y_%I-%M%p')
-                    attached_email_filename = f"{attachment_dir}attached_{attached_subject}_{attached_received_time}.html"
-                    with open(attached_email_filename, 'w', encoding='utf-8') as f:
-                        f.write(f"<html><body>\n")
-                        f.write(f"<h1>Subject: {attached_item.subject}</h1>\n")
-                        f.write(f"<p><strong>Received:</strong> {attached_item.datetime_received}</p>\n")
-                        f.write(f"<p><strong>Sender:</strong> {attached_item.sender.email_address}</p>\n")
-                        f.write(f"<p><strong>Body:</strong></p>\n")
-                        f.write(f"{attached_item.body}\n")
-                        f.write(f"</body></html>\n")
-                except Exception as e:
-                    logging.error(f"Error saving attached email: {str(e)}")
-        
-        return email_out
-    except Exception as e:
-        logging.error(f"Error processing email: {str(e)}")
-        return f"error_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-
-def main():
-    # Load configuration from environment variables
-    email = EXCHANGE_EMAIL
-    domain_username = EXCHANGE_DOMAIN_USERNAME
-    password = EXCHANGE_PASSWORD
-    server = EXCHANGE_SERVER
-    version = EXCHANGE_VERSION
-    output_dir = OUTPUT_DIR
-    timezone_name = TIMEZONE
-    days_ago = DAYS_AGO
-
-    # Setup exchange connection
-    credentials = Credentials(username=domain_username, password=password)
-    config = Configuration(server=server, credentials=credentials)
-    account = Account(
-        primary_smtp_address=email,
-        credentials=credentials,
-        autodiscover=True,
-        access_type=DELEGATE,
-        config=config
+    from sqlalchemy import select
+    from sqlalchemy.orm import selectinload
+
+    from models import Email
+
+    query = (
+        select(Email)
+        .options(selectinload(Email.attachments))
+        .order_by(Email.id)
+        .execution_options(yield_per=200)
+    )
+    if sink is None:
+        sink = FilesystemSink(output_dir, max_workers=max_workers, engine=engine)
+    with sink:
+        return sum(ingest(session.scalars(query), [sink]))
+
+
+def export_exchange(settings, sinks):
+    """Fetch the sent and inbox folders from Exchange into the given sinks."""
+    account = connect_account(
+        settings['EXCHANGE_EMAIL'],
+        settings['EXCHANGE_DOMAIN_USERNAME'],
+        settings['EXCHANGE_PASSWORD'],
+        settings['EXCHANGE_SERVER'],
     )
+    time_frame = get_time_frame(settings['TIMEZONE'], settings['DAYS_AGO'])
+
+    exported = 0
+    for label, folder in (('sent', account.sent), ('inbox', account.inbox)):
+        logging.info(f"Processing {label} emails...")
+        exported += sum(ingest(iter_folder_messages(folder, time_frame), sinks))
+    return exported
+
+
+def main(argv=None, default_days=None):
+    parser = argparse.ArgumentParser(description="Export emails and attachments to the file system.")
+    parser.add_argument('--output-dir', help="Defaults to OUTPUT_DIR from the environment.")
+    parser.add_argument('--days', type=int, default=default_days,
+                        help=f"Defaults to {default_days or 'DAYS_AGO from the environment'}.")
+    parser.add_argument('--workers', type=int,
+                        help=f"Number of threads writing files in parallel (default {EXPORT_WORKERS}).")
+    parser.add_argument('--from-db', action='store_true',
+                        help="Export from the app database instead of the live Exchange mailbox.")
+    parser.add_argument('--zip', metavar='PATH', help="Write a ZIP archive instead of a directory.")
+    args = parser.parse_args(argv)
+    if args.zip and args.workers is not None:
+        parser.error("--workers does not apply to --zip; the archive is written by one thread")
+    workers = args.workers or EXPORT_WORKERS
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    # Calculate time frame
-    local_tz = pytz.timezone(timezone_name)
-    time_frame = local_tz.localize(datetime.now() - timedelta(days=days_ago))
+    if args.from_db:
+        from app import session_scope
 
-    # Ensure output directory exists
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+        with session_scope() as session:
+            output_dir = args.output_dir or os.getenv('OUTPUT_DIR', 'gpg2/').strip("'\"")
+            sink = ZipSink(args.zip) if args.zip else None
+            exported = export_database(output_dir, session, max_workers=workers, sink=sink)
+        logging.info(f"Exported {exported} emails from the database")
+        return
 
-    # Process emails
-    logging.info("Processing sent emails...")
-    for _ in process_email(account, account.sent, output_dir, time_frame):
-        pass
+    settings = load_settings()
+    if args.days is not None:
+        settings['DAYS_AGO'] = args.days
+    if args.zip:
+        sink = ZipSink(args.zip)
+    else:
+        sink = FilesystemSink(args.output_dir or settings['OUTPUT_DIR'], max_workers=workers)
+    with sink:
+        exported = export_exchange(settings, [sink])
+    logging.info(f"Exported {exported} emails")
 
-    logging.info("Processing inbox emails...")
-    for _ in process_email(account, account.inbox, output_dir, time_frame):
-        pass
 
 if __name__ == "__main__":
     main()
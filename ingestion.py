@@ -0,0 +1,1137 @@
+# ingestion.py
+"""
+Shared fetch-and-render core for the web app and the command line exporters.
+
+Messages are read from Exchange (or the app database) and handed to one or
+more sinks: DatabaseSink stores them through the SQLAlchemy models,
+FilesystemSink writes HTML pages and attachment files to a directory, and
+ZipSink writes the same layout into a ZIP archive.
+
+A "message" is anything exposing message_id, subject, sender, recipients,
+datetime_received, body and attachments (each with filename, content_type
+and data). MessageData wraps Exchange items this way, and the Email/Attachment
+models already satisfy it, so every sink accepts both.
+
+Nothing here touches the network or the file system at import time, and
+exchangelib is only imported once an Exchange connection is actually needed.
+"""
+import base64
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+import zipfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from email.header import Header
+from email.utils import encode_rfc2231, format_datetime as format_mime_datetime
+from functools import lru_cache
+from html import escape
+from pathlib import Path
+
+import pytz
+
+from cache import MemoryCache
+from throttle import ThrottleController, is_throttling_error
+
+DEFAULT_ENV_PATH = Path(__file__).resolve().parent / '.env'
+EXCHANGE_SETTINGS = (
+    'EXCHANGE_EMAIL',
+    'EXCHANGE_DOMAIN_USERNAME',
+    'EXCHANGE_PASSWORD',
+    'EXCHANGE_SERVER',
+    'EXCHANGE_VERSION',
+    'OUTPUT_DIR',
+    'TIMEZONE',
+    'DAYS_AGO',
+)
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '8'))
+DB_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '50'))
+# A batch is written early once its attachments reach this many bytes.
+DB_BATCH_BYTES = int(os.getenv('INGEST_BATCH_BYTES', str(32 * 1024 * 1024)))
+MANIFEST_NAME = '.export_manifest.json'
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(os.cpu_count() or 1)))
+RENDER_CHUNK_SIZE = int(os.getenv('RENDER_CHUNK_SIZE', '200'))
+# Smaller exports render in-process; a pool round trip costs more than it saves.
+RENDER_POOL_MIN_ROWS = int(os.getenv('RENDER_POOL_MIN_ROWS', '2000'))
+# Worker processes are never forked from the (multithreaded) web process.
+PROCESS_POOL_CONTEXT = os.getenv(
+    'PROCESS_POOL_CONTEXT',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn',
+)
+EWS_PAGE_SIZE = int(os.getenv('EWS_PAGE_SIZE', '100'))
+
+
+# Settings hold the Exchange password, so they are only cached in-process.
+SETTINGS_CACHE = MemoryCache(max_entries=8)
+
+
+def load_settings(env_path=DEFAULT_ENV_PATH, cache=SETTINGS_CACHE):
+    """Read the Exchange settings from the environment, loading .env once.
+
+    Results are cached until the .env file changes.
+    """
+    from dotenv import load_dotenv
+
+    try:
+        modified = os.stat(env_path).st_mtime_ns
+    except OSError:
+        modified = None
+    cache_key = f'settings:{os.path.abspath(env_path)}:{modified}'
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return dict(cached)
+
+    load_dotenv(env_path, override=True)
+    settings = {}
+    for name in EXCHANGE_SETTINGS:
+        value = os.getenv(name)
+        if value is None:
+            raise ValueError(f"Missing environment variable: {name}")
+        settings[name] = value.strip("'\"")
+    settings['DAYS_AGO'] = int(settings['DAYS_AGO'])
+    if cache is not None:
+        cache.set(cache_key, settings)
+    return dict(settings)
+
+
+def sanitize_filename(filename):
+    """Sanitize the filename by removing or replacing invalid characters."""
+    invalid_chars = r'[<>:"/\\|?*\x00-\x1f]'
+    filename = re.sub(invalid_chars, '_', filename or '')
+    filename = filename.rstrip('. ')
+    if not filename:
+        filename = 'unnamed'
+    if len(filename) > 245:
+        filename = filename[:245]
+    return filename
+
+
+CID_SRC_PATTERN = re.compile(r'src=["\']cid:(.*?)["\']', re.IGNORECASE)
+
+
+def normalize_content_id(content_id):
+    """Strip the angle brackets Exchange sometimes keeps around Content-IDs."""
+    if not content_id:
+        return None
+    return content_id.strip().strip('<>').strip() or None
+
+
+def rewrite_cid_urls(body, url_for_cid):
+    """Rewrite src="cid:..." references using url_for_cid(content_id).
+
+    References for which url_for_cid returns None are left untouched.
+    """
+    if not body:
+        return body or ""
+
+    def cid_replacer(match):
+        url = url_for_cid(normalize_content_id(match.group(1)))
+        if url is None:
+            return match.group(0)
+        return f'src="{url}"'
+
+    return CID_SRC_PATTERN.sub(cid_replacer, body)
+
+
+def replace_cid_urls(body, email_out, output_dir, filenames_by_cid=None):
+    """
+    Replace 'cid:' URLs in the email body with valid HTTP URLs pointing to attachment files.
+
+    filenames_by_cid maps Content-IDs to the exported attachment file name;
+    unknown Content-IDs are assumed to be the attachment file name.
+    """
+    if body is None:
+        return ""
+
+    filenames_by_cid = filenames_by_cid or {}
+    try:
+        return rewrite_cid_urls(
+            body,
+            lambda cid: f"/gpg2/{email_out}_attachments/{filenames_by_cid.get(cid, cid)}",
+        )
+    except Exception as e:
+        logging.error(f"Error replacing CID URLs: {str(e)}")
+        return body if body else ""
+
+
+def build_email_html(message, body=None):
+    """Create an HTML representation of a stored or fetched email."""
+    subject = message.subject or 'No Subject'
+    received = message.datetime_received.isoformat() if message.datetime_received else 'Unknown'
+    sender = message.sender or 'Unknown Sender'
+    recipients = message.recipients or 'Unknown'
+    body = (message.body or '') if body is None else body
+
+    if body.strip():
+        if re.search(r'<[^>]+>', body):
+            body_html = body
+        else:
+            body_html = f"<pre>{escape(body)}</pre>"
+    else:
+        body_html = '<p><em>No body content</em></p>'
+
+    return (
+        "<html><body>\n"
+        f"<h1>Subject: {escape(subject)}</h1>\n"
+        f"<p><strong>Received:</strong> {escape(received)}</p>\n"
+        f"<p><strong>Sender:</strong> {escape(sender)}</p>\n"
+        f"<p><strong>To:</strong> {escape(recipients)}</p>\n"
+        "<p><strong>Body:</strong></p>\n"
+        f"{body_html}\n"
+        "</body></html>\n"
+    )
+
+
+# Attachments of these types gain nothing from another round of DEFLATE.
+PRECOMPRESSED_TYPES = (
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'video/', 'audio/', 'application/pdf',
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-7z-compressed',
+    'application/x-rar-compressed', 'application/vnd.rar', 'application/vnd.openxmlformats-officedocument.',
+)
+PRECOMPRESSED_SUFFIXES = (
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mov', '.pdf', '.zip', '.gz', '.tgz', '.7z',
+    '.rar', '.docx', '.xlsx', '.pptx',
+)
+MBOX_FROM_PATTERN = re.compile(rb'^(>*From )', re.MULTILINE)
+
+
+def is_precompressed(content_type, filename=None):
+    """True for attachment types that are already compressed."""
+    if (content_type or '').lower().startswith(PRECOMPRESSED_TYPES):
+        return True
+    return (filename or '').lower().endswith(PRECOMPRESSED_SUFFIXES)
+
+
+def mime_header(value):
+    """A single-line header value, RFC 2047 encoded when it is not ASCII."""
+    value = ' '.join(str(value).split())
+    if value.isascii():
+        return value
+    return Header(value, 'utf-8').encode()
+
+
+def mime_param(name, value):
+    if value.isascii():
+        quoted = value.replace('\\', '\\\\').replace('"', '\\"')
+        return f'{name}="{quoted}"'
+    return f"{name}*={encode_rfc2231(value, 'utf-8')}"
+
+
+def encode_base64_lines(data):
+    """Base64 in 76-character lines, as base64.encodebytes() but without its per-line loop."""
+    encoded = base64.b64encode(data)
+    return b'\n'.join([encoded[offset:offset + 76] for offset in range(0, len(encoded), 76)]) + b'\n'
+
+
+def build_mime_message(message, attachments=None, quote_from=False):
+    """Serialize a stored or fetched email as RFC 5322 bytes (multipart/mixed with attachments).
+
+    Attachments are base64 encoded as they are, so importing the result
+    gives back the original content. quote_from applies mboxrd ">From "
+    quoting; only the body needs it, as base64 lines never start with "From ".
+    """
+    attachments = message.attachments if attachments is None else attachments
+    headers = []
+    if getattr(message, 'message_id', None):
+        headers.append(f"Message-ID: {mime_header(message.message_id)}")
+    if message.datetime_received:
+        received = message.datetime_received
+        if received.tzinfo is None:
+            received = pytz.UTC.localize(received)
+        headers.append(f"Date: {format_mime_datetime(received)}")
+    if message.sender:
+        headers.append(f"From: {mime_header(message.sender)}")
+    if message.recipients:
+        headers.append(f"To: {mime_header(message.recipients)}")
+    headers.append(f"Subject: {mime_header(message.subject or '')}")
+    headers.append("MIME-Version: 1.0")
+
+    body = message.body or ''
+    subtype = 'html' if re.search(r'<[^>]+>', body) else 'plain'
+    encoded_body = body.encode('utf-8')
+    if any(len(line) > 998 for line in encoded_body.splitlines()):
+        body_part = (f"Content-Type: text/{subtype}; charset=utf-8\nContent-Transfer-Encoding: base64\n\n"
+                     .encode('ascii') + encode_base64_lines(encoded_body))
+    else:
+        if quote_from:
+            encoded_body = MBOX_FROM_PATTERN.sub(rb'>\1', encoded_body)
+        body_part = (f"Content-Type: text/{subtype}; charset=utf-8\nContent-Transfer-Encoding: 8bit\n\n"
+                     .encode('ascii') + encoded_body + b'\n')
+
+    if not attachments:
+        return ('\n'.join(headers) + '\n').encode('ascii') + body_part
+
+    boundary = f'=_{uuid.uuid4().hex}'
+    headers.append(f'Content-Type: multipart/mixed; boundary="{boundary}"')
+    delimiter = f'--{boundary}\n'.encode('ascii')
+    parts = [('\n'.join(headers) + '\n\n').encode('ascii'), delimiter, body_part]
+    for attachment in attachments:
+        filename = sanitize_filename(attachment.filename or 'attachment')
+        content_id = getattr(attachment, 'content_id', None)
+        disposition = 'inline' if getattr(attachment, 'is_inline', False) else 'attachment'
+        part_headers = [
+            f"Content-Type: {attachment.content_type or 'application/octet-stream'}; {mime_param('name', filename)}",
+            f"Content-Disposition: {disposition}; {mime_param('filename', filename)}",
+            "Content-Transfer-Encoding: base64",
+        ]
+        if content_id:
+            part_headers.append(f"Content-ID: <{mime_header(content_id)}>")
+        parts.extend([delimiter, ('\n'.join(part_headers) + '\n\n').encode('ascii'),
+                      encode_base64_lines(attachment.data or b'')])
+    parts.append(f'--{boundary}--\n'.encode('ascii'))
+    return b''.join(parts)
+
+
+def mbox_from_line(message):
+    """The "From " separator line that starts an mbox entry."""
+    sender = (message.sender or '').split()
+    received = message.datetime_received
+    stamp = time.asctime(received.utctimetuple() if received else time.gmtime(0))
+    return f"From {sender[0] if sender else 'MAILER-DAEMON'} {stamp}\n".encode('ascii', 'replace')
+
+
+@lru_cache(maxsize=None)
+def get_timezone(timezone_name):
+    return pytz.timezone(timezone_name)
+
+
+def format_datetime(dt, timezone_name):
+    if not dt:
+        return 'Unknown'
+    try:
+        target_tz = get_timezone(timezone_name)
+        if dt.tzinfo is None:
+            dt = target_tz.localize(dt)
+        else:
+            dt = dt.astimezone(target_tz)
+        return dt.strftime('%m/%d/%Y %I:%M %p')
+    except Exception:
+        return dt.strftime('%m/%d/%Y %I:%M %p') if isinstance(dt, datetime) else str(dt)
+
+
+def zip_entry_name(message, timezone_name):
+    """Name of an email's HTML entry (and attachment folder) in the download ZIP."""
+    recipient_display = (message.recipients or 'Unknown').split(',')[0].strip() or 'Unknown'
+    subject_display = sanitize_filename(message.subject or 'No_Subject')
+    if message.datetime_received:
+        date_str = format_datetime(message.datetime_received, timezone_name)
+        date_str = date_str.replace('/', '-').replace(' ', '_').replace(':', '-')
+    else:
+        date_str = 'Unknown_Date'
+    return sanitize_filename(f"to_{recipient_display} - {subject_display} - {date_str}")
+
+
+class RenderRow:
+    """Picklable stand-in for an Email row carrying only what rendering needs."""
+
+    __slots__ = ('subject', 'sender', 'recipients', 'datetime_received', 'body')
+
+    def __init__(self, subject, sender, recipients, datetime_received, body):
+        self.subject = subject
+        self.sender = sender
+        self.recipients = recipients
+        self.datetime_received = datetime_received
+        self.body = body
+
+
+class ExportMessage:
+    """A database row shaped like a message, with its attachment rows, for the MIME exports."""
+
+    __slots__ = ('message_id', 'subject', 'sender', 'recipients', 'datetime_received', 'body', 'attachments')
+
+    def __init__(self, message_id, subject, sender, recipients, datetime_received, body, attachments=()):
+        self.message_id = message_id
+        self.subject = subject
+        self.sender = sender
+        self.recipients = recipients
+        self.datetime_received = datetime_received
+        self.body = body
+        self.attachments = attachments
+
+
+def render_chunk(rows, timezone_name):
+    """Render (subject, sender, recipients, datetime_received, body) tuples.
+
+    Returns (zip entry name, html) pairs in input order. Runs in worker
+    processes, so it only depends on this module.
+    """
+    rendered = []
+    for row in rows:
+        message = RenderRow(*row)
+        rendered.append((zip_entry_name(message, timezone_name), build_email_html(message)))
+    return rendered
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """The process pool shared by export rendering and attachment text extraction.
+
+    Created on first use with RENDER_WORKERS processes. Workers are started
+    with PROCESS_POOL_CONTEXT (forkserver or spawn), so they never inherit
+    the web process's locks, threads or database connections, and however
+    many exports run at once they share the same workers.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=max(1, RENDER_WORKERS),
+                mp_context=multiprocessing.get_context(PROCESS_POOL_CONTEXT),
+            )
+        return _process_pool
+
+
+def discard_process_pool(pool):
+    """Drop a pool that broke (a worker died) so the next caller starts a new one."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_rendered_chunks(chunks, timezone_name, max_workers=RENDER_WORKERS, min_pool_rows=RENDER_POOL_MIN_ROWS):
+    """Render chunks of row tuples, yielding (key, rendered) pairs in input order.
+
+    chunks is an iterable of (key, rows) pairs. Exports of fewer than
+    min_pool_rows rows, or any export when max_workers is 1, render in this
+    process. Larger ones go to the shared process pool with at most two
+    chunks per worker in flight, so memory stays bounded however many emails
+    are exported.
+    """
+    chunks = iter(chunks)
+    head = []
+    head_rows = 0
+    if max_workers > 1:
+        for key, rows in chunks:
+            head.append((key, rows))
+            head_rows += len(rows)
+            if head_rows >= min_pool_rows:
+                break
+    if max_workers <= 1 or head_rows < min_pool_rows:
+        for key, rows in itertools.chain(head, chunks):
+            yield key, render_chunk(rows, timezone_name)
+        return
+
+    pool = get_process_pool()
+    in_flight = deque()
+    try:
+        for key, rows in itertools.chain(head, chunks):
+            in_flight.append((key, pool.submit(render_chunk, rows, timezone_name)))
+            if len(in_flight) >= max_workers * 2:
+                done_key, future = in_flight.popleft()
+                yield done_key, future.result()
+        while in_flight:
+            done_key, future = in_flight.popleft()
+            yield done_key, future.result()
+    except BrokenProcessPool:
+        discard_process_pool(pool)
+        raise
+    finally:
+        # An abandoned download leaves nothing queued behind it.
+        for _, future in in_flight:
+            future.cancel()
+
+
+def get_message_identifier(item):
+    identifier = getattr(item, 'message_id', None)
+    if identifier:
+        return identifier
+    return getattr(item, 'item_id', None)
+
+
+class AttachmentData:
+    """An attachment fetched from Exchange, shaped like the Attachment model."""
+
+    def __init__(self, filename, content_type, data, content_id=None, is_inline=False):
+        self.filename = filename
+        self.content_type = content_type
+        self.data = data
+        self.size = len(data)
+        self.content_id = normalize_content_id(content_id)
+        self.is_inline = bool(is_inline)
+
+
+class MessageData:
+    """An Exchange message normalized to the fields every sink needs.
+
+    Attachment content is fetched on first access, so sinks that already hold
+    the message never pay for downloading its attachments.
+    """
+
+    def __init__(self, item, folder=None, throttle=None):
+        self.item = item
+        self.folder = folder
+        self.throttle = throttle
+        self.message_id = get_message_identifier(item) or (
+            f"{item.subject}-{item.datetime_received}-{getattr(item, 'sender', '')}"
+        )
+        self.subject = item.subject
+        sender = getattr(item, 'sender', None)
+        self.sender = sender.email_address if sender else None
+        to_recipients = getattr(item, 'to_recipients', None) or []
+        self.recipients = ', '.join([
+            r.email_address or r.name
+            for r in to_recipients
+            if getattr(r, 'email_address', None) or getattr(r, 'name', None)
+        ])
+        self.recipient_name = getattr(to_recipients[0], 'name', None) if to_recipients else None
+        self.datetime_received = getattr(item, 'datetime_received', None)
+        self.body = str(item.body) if getattr(item, 'body', None) is not None else None
+        self._attachments = None
+
+    @property
+    def attachments(self):
+        if self._attachments is None:
+            # Without attachments there is no GetAttachment call to throttle.
+            if self.throttle is None or not getattr(self.item, 'attachments', None):
+                self._attachments = list(iter_item_attachments(self.item))
+            else:
+                self._attachments = self.throttle.call(lambda: list(iter_item_attachments(self.item)))
+        return self._attachments
+
+
+def render_attached_item(attached_item):
+    """Render an attached email item as a standalone HTML attachment."""
+    attached_subject = sanitize_filename(getattr(attached_item, 'subject', None) or 'Attached Email')
+    received = getattr(attached_item, 'datetime_received', None) or datetime.now(pytz.UTC)
+    attached_sender = getattr(attached_item, 'sender', None)
+    attached_sender_email = (
+        attached_sender.email_address if getattr(attached_sender, 'email_address', None) else None
+    )
+    attached_html = (
+        "<html><body>\n"
+        f"<h1>Subject: {escape(getattr(attached_item, 'subject', None) or 'No Subject')}</h1>\n"
+        f"<p><strong>Received:</strong> {escape(received.isoformat())}</p>\n"
+        f"<p><strong>Sender:</strong> {escape(attached_sender_email or 'Unknown')}</p>\n"
+        "<p><strong>Body:</strong></p>\n"
+        f"{getattr(attached_item, 'body', '') or ''}\n"
+        "</body></html>\n"
+    ).encode('utf-8')
+    filename = f"attached_email_{attached_subject}_{received.strftime('%Y%m%d%H%M%S')}.html"
+    return AttachmentData(filename, 'text/html', attached_html)
+
+
+def fetch_file_contents(item):
+    """Content of the item's file attachments, keyed by attachment id.
+
+    All of them come from one non-streaming GetAttachment call. exchangelib
+    reads a streamed attachment before it looks at the HTTP status, so a
+    throttled streamed download fails as an unparseable document; the normal
+    call raises ErrorServerBusy with the server's back-off hint instead.
+    """
+    from exchangelib import FileAttachment
+    from exchangelib.services import GetAttachment
+
+    account = getattr(item, 'account', None)
+    attachment_ids = [
+        attachment.attachment_id for attachment in getattr(item, 'attachments', None) or []
+        if isinstance(attachment, FileAttachment) and attachment.attachment_id is not None
+    ]
+    if account is None or not attachment_ids:
+        return {}
+    contents = {}
+    for fetched in GetAttachment(account=account).call(
+        items=attachment_ids, include_mime_content=False, body_type=None, filter_html_content=None,
+        additional_fields=None,
+    ):
+        if isinstance(fetched, Exception):
+            if is_throttling_error(fetched):
+                raise fetched
+            logging.error(f"Error reading attachment: {fetched}")
+        elif isinstance(fetched, FileAttachment):
+            contents[fetched.attachment_id.id] = fetched.content or b''
+    return contents
+
+
+def iter_item_attachments(item):
+    """Yield AttachmentData for the file and item attachments of an Exchange item."""
+    from exchangelib import FileAttachment, ItemAttachment
+
+    contents = fetch_file_contents(item)
+    for attachment in getattr(item, 'attachments', None) or []:
+        try:
+            if isinstance(attachment, FileAttachment):
+                attachment_id = getattr(attachment.attachment_id, 'id', None)
+                yield AttachmentData(
+                    sanitize_filename(attachment.name),
+                    getattr(attachment, 'content_type', None),
+                    contents[attachment_id] if attachment_id in contents else attachment.content or b'',
+                    content_id=getattr(attachment, 'content_id', None),
+                    is_inline=getattr(attachment, 'is_inline', False),
+                )
+            elif isinstance(attachment, ItemAttachment):
+                yield render_attached_item(attachment.item)
+        except Exception as exc:
+            if is_throttling_error(exc):
+                raise
+            logging.error(f"Error reading attachment: {exc}")
+
+
+def connect_account(email, domain_username, password, server):
+    """Open a delegate Exchange account.
+
+    server is normally a host name, found through autodiscover. A full EWS
+    URL (https://host/EWS/Exchange.asmx, or the loadtest stub's http URL) is
+    used as the endpoint directly, without autodiscover.
+    """
+    from exchangelib import Account, Configuration, Credentials, DELEGATE
+
+    credentials = Credentials(username=domain_username, password=password)
+    if server.startswith(('http://', 'https://')):
+        config = Configuration(service_endpoint=server, credentials=credentials)
+        return Account(primary_smtp_address=email, autodiscover=False, access_type=DELEGATE, config=config)
+    config = Configuration(server=server, credentials=credentials)
+    return Account(
+        primary_smtp_address=email,
+        credentials=credentials,
+        autodiscover=True,
+        access_type=DELEGATE,
+        config=config
+    )
+
+
+def get_time_frame(timezone_name, days_ago):
+    local_tz = pytz.timezone(timezone_name)
+    return local_tz.localize(datetime.now() - timedelta(days=days_ago))
+
+
+def iter_folder_messages(email_folder, time_frame, throttle=None):
+    """Yield MessageData for every message received in the folder since time_frame.
+
+    Items are read a page at a time under the throttle. When Exchange
+    throttles the query, the iteration waits out the back-off and resumes
+    after the last item it yielded instead of abandoning the folder.
+    """
+    from exchangelib import Message
+
+    throttle = throttle or ThrottleController(getattr(email_folder, 'name', None) or 'folder')
+    folder_name = getattr(email_folder, 'name', None)
+    # Newest first: after an interruption, resume at the oldest timestamp
+    # yielded so far, skipping the items already seen at that timestamp.
+    resume_at = None
+    seen_at_resume = set()
+    attempt = 0
+    while True:
+        queryset = email_folder.filter(datetime_received__gte=time_frame)
+        if resume_at is not None:
+            queryset = queryset.filter(datetime_received__lte=resume_at)
+        queryset = queryset.order_by('-datetime_received')
+        if hasattr(queryset, 'page_size'):
+            queryset.page_size = EWS_PAGE_SIZE
+        items = iter(queryset)
+
+        while True:
+            page = []
+            error = None
+            try:
+                with throttle.slot():
+                    page.extend(itertools.islice(items, EWS_PAGE_SIZE))
+            except Exception as e:
+                error = e
+
+            for item in page:
+                item_key = getattr(item, 'id', None) or get_message_identifier(item)
+                received = getattr(item, 'datetime_received', None)
+                if received is not None and received == resume_at and item_key in seen_at_resume:
+                    continue
+                if received is not None:
+                    if received != resume_at:
+                        resume_at = received
+                        seen_at_resume = set()
+                    seen_at_resume.add(item_key)
+                if isinstance(item, Message):
+                    yield MessageData(item, folder=folder_name, throttle=throttle)
+
+            if error is not None:
+                if not is_throttling_error(error):
+                    raise error
+                if not throttle.retry(attempt):
+                    logging.error(f"Giving up on folder {folder_name} after repeated throttling: {error}")
+                    return
+                attempt += 1
+                logging.info(f"Resuming folder {folder_name} after throttling")
+                break
+            if len(page) < EWS_PAGE_SIZE:
+                return
+
+
+def ingest(messages, sinks):
+    """Feed messages into every sink, yielding True when any sink stored it."""
+    for message in messages:
+        created = False
+        for sink in sinks:
+            try:
+                if sink.contains(message):
+                    continue
+                created = sink.add(message) or created
+            except Exception as e:
+                logging.error(f"Error storing email {message.message_id} in {type(sink).__name__}: {str(e)}")
+        yield created
+
+
+class Sink:
+    """Destination for ingested messages."""
+
+    def contains(self, message):
+        """Return True if the message was already stored by this sink."""
+        return False
+
+    def add(self, message):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class DatabaseSink(Sink):
+    """Store messages as Email/Attachment rows, committing in batches.
+
+    Every message is flushed inside its own SAVEPOINT, so a message that
+    fails to store is dropped alone instead of taking its batch with it.
+    stored counts messages only once the batch holding them has committed.
+    """
+
+    def __init__(self, session, batch_size=DB_BATCH_SIZE, account_id=None):
+        from models import DEFAULT_ACCOUNT_ID, Attachment, Email
+
+        self.session = session
+        self.batch_size = batch_size
+        self.account_id = account_id or DEFAULT_ACCOUNT_ID
+        self.email_model = Email
+        self.attachment_model = Attachment
+        self._pending = 0
+        self.stored = 0
+
+    def contains(self, message):
+        return message.message_id in self.existing_ids([message.message_id])
+
+    def existing_ids(self, message_ids):
+        """The subset of message_ids already stored for this account."""
+        from sqlalchemy import select
+
+        Email = self.email_model
+        statement = select(Email.message_id).where(
+            Email.account_id == self.account_id,
+            Email.message_id.in_(set(message_ids)),
+        )
+        return set(self.session.scalars(statement))
+
+    def add(self, message):
+        # Fetch attachment content before touching the session so a network
+        # error cannot leave a half-flushed message behind.
+        attachments = message.attachments
+        email_record = self.email_model(
+            message_id=message.message_id,
+            account_id=self.account_id,
+            subject=message.subject,
+            sender=message.sender,
+            recipients=message.recipients,
+            datetime_received=message.datetime_received,
+            body=message.body,
+            folder=getattr(message, 'folder', None),
+        )
+        for attachment in attachments:
+            data = attachment.data or b''
+            email_record.attachments.append(
+                self.attachment_model(
+                    filename=attachment.filename,
+                    content_type=attachment.content_type,
+                    data=data,
+                    size=len(data),
+                    content_id=getattr(attachment, 'content_id', None),
+                    is_inline=bool(getattr(attachment, 'is_inline', False)),
+                    content_hash=hashlib.sha256(data).hexdigest(),
+                )
+            )
+        # Leaving the block flushes; a failure rolls back to the savepoint
+        # and leaves the rest of the batch intact.
+        with self.session.begin_nested():
+            self.session.add(email_record)
+
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+        return True
+
+    def commit(self):
+        self.session.commit()
+        self.stored += self._pending
+        self._pending = 0
+
+    def close(self):
+        if self._pending:
+            self.commit()
+
+
+def store_messages(messages, session_factory, account_id=None, batch_size=DB_BATCH_SIZE,
+                   batch_bytes=DB_BATCH_BYTES, limit=None):
+    """Store new messages in the database; returns how many were committed.
+
+    Messages are read from Exchange a batch at a time, attachment content
+    included, before a session is taken from session_factory to write them,
+    and that session is closed once the batch commits. The writer connection
+    is never held across EWS calls or throttle back-offs. Stops after limit
+    new messages.
+    """
+    stored = 0
+    seen = set()
+    messages = iter(messages)
+    while limit is None or stored < limit:
+        batch = list(itertools.islice(messages, batch_size))
+        if not batch:
+            break
+        with session_factory() as session:
+            existing = DatabaseSink(session, account_id=account_id).existing_ids(m.message_id for m in batch)
+        ready = []
+        ready_bytes = 0
+        for message in batch:
+            if message.message_id in existing or message.message_id in seen:
+                continue
+            if limit is not None and stored + len(ready) >= limit:
+                break
+            seen.add(message.message_id)
+            try:
+                ready_bytes += sum(len(attachment.data or b'') for attachment in message.attachments)
+            except Exception as e:
+                logging.error(f"Error fetching attachments of {message.message_id}: {str(e)}")
+                continue
+            ready.append(message)
+            if ready_bytes >= batch_bytes:
+                stored += write_messages(ready, session_factory, account_id)
+                ready = []
+                ready_bytes = 0
+        stored += write_messages(ready, session_factory, account_id)
+    return stored
+
+
+def write_messages(messages, session_factory, account_id=None):
+    """Store already-fetched messages in one transaction; returns how many were committed."""
+    if not messages:
+        return 0
+    with session_factory() as session:
+        with DatabaseSink(session, batch_size=len(messages) + 1, account_id=account_id) as sink:
+            existing = sink.existing_ids(message.message_id for message in messages)
+            for message in messages:
+                if message.message_id in existing:
+                    continue
+                try:
+                    sink.add(message)
+                except Exception as e:
+                    logging.error(f"Error storing email {message.message_id}: {str(e)}")
+    return sink.stored
+
+
+def export_name(message):
+    """File name stem used by the file system and ZIP exports."""
+    recipient = message.recipient_name if getattr(message, 'recipient_name', None) else None
+    if not recipient:
+        recipient = (message.recipients or '').split(',')[0].strip() or 'Unknown_Recipient'
+    subject = sanitize_filename(message.subject) if message.subject else 'No_Subject'
+    if message.datetime_received:
+        received_time = message.datetime_received.strftime('%m-%d-%Y_%I-%M%p')
+    else:
+        received_time = 'Unknown_Date'
+    return f"to_{sanitize_filename(recipient)} - {subject} - {received_time}"
+
+
+class ExportEngine:
+    """Write exported messages to disk with parallel attachment writes.
+
+    A JSON manifest in the output directory records every file written (size
+    and sha256) and every message that finished exporting, so an interrupted
+    run can be resumed without rewriting or refetching what is already there.
+    """
+
+    def __init__(self, output_dir, max_workers=EXPORT_WORKERS, checkpoint_every=50):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.output_dir / MANIFEST_NAME
+        self.checkpoint_every = checkpoint_every
+        self.stats = {'written': 0, 'skipped': 0, 'errors': 0, 'messages': 0}
+        self._lock = threading.Lock()
+        self._created_dirs = {self.output_dir}
+        self._pending = []
+        self._since_checkpoint = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export')
+        # Bound the number of queued files so attachment bytes do not pile up
+        # in memory when Exchange delivers faster than the disk writes.
+        self._slots = threading.BoundedSemaphore(max_workers * 4)
+        self._files, self._messages = self._load_manifest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            return manifest.get('files', {}), set(manifest.get('messages', []))
+        except FileNotFoundError:
+            return {}, set()
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable export manifest {self.manifest_path}: {str(e)}")
+            return {}, set()
+
+    def is_exported(self, key):
+        """Return True if the message identified by key finished in an earlier run."""
+        with self._lock:
+            return key in self._messages
+
+    def ensure_dir(self, directory):
+        directory = Path(directory)
+        if directory in self._created_dirs:
+            return
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._created_dirs.add(directory)
+
+    def _is_current(self, relative_path, path, size, digest):
+        try:
+            if path.stat().st_size != size:
+                return False
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            recorded = self._files.get(relative_path)
+        if recorded and recorded.get('size') == size:
+            return recorded.get('sha256') == digest
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest() == digest
+
+    def _write_file(self, relative_path, data):
+        path = self.output_dir / relative_path
+        digest = hashlib.sha256(data).hexdigest()
+        if self._is_current(relative_path, path, len(data), digest):
+            with self._lock:
+                self._files[relative_path] = {'size': len(data), 'sha256': digest}
+                self.stats['skipped'] += 1
+            return False
+
+        self.ensure_dir(path.parent)
+        partial_path = path.with_name(path.name + '.part')
+        with open(partial_path, 'wb') as f:
+            f.write(data)
+        os.replace(partial_path, path)
+        with self._lock:
+            self._files[relative_path] = {'size': len(data), 'sha256': digest}
+            self.stats['written'] += 1
+        return True
+
+    def write_message(self, key, html, attachments=()):
+        """Queue a message's HTML and attachment files; returns the futures.
+
+        attachments is an iterable of (relative_path, bytes) pairs. The message
+        is recorded as exported once every file has been written.
+        """
+        files = [(f"{key}.html", html.encode('utf-8'))]
+        files.extend((relative_path, data or b'') for relative_path, data in attachments)
+        futures = []
+        for relative_path, data in files:
+            self._slots.acquire()
+            future = self._executor.submit(self._write_file, relative_path, data)
+            future.add_done_callback(lambda _: self._slots.release())
+            futures.append(future)
+
+        remaining = [len(futures)]
+        failed = [False]
+
+        def on_done(future):
+            error = future.exception()
+            with self._lock:
+                if error is not None:
+                    failed[0] = True
+                    self.stats['errors'] += 1
+                    logging.error(f"Error writing export file for {key}: {str(error)}")
+                remaining[0] -= 1
+                if remaining[0] or failed[0]:
+                    return
+                self._messages.add(key)
+                self.stats['messages'] += 1
+                self._since_checkpoint += 1
+                due = self._since_checkpoint >= self.checkpoint_every
+            if due:
+                self.checkpoint()
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        with self._lock:
+            self._pending.extend(futures)
+        return futures
+
+    def wait(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        wait(pending)
+
+    def checkpoint(self):
+        """Atomically persist the manifest so a later run can resume."""
+        with self._lock:
+            manifest = {'files': dict(self._files), 'messages': sorted(self._messages)}
+            self._since_checkpoint = 0
+            partial_path = self.manifest_path.with_name(self.manifest_path.name + '.part')
+            with open(partial_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+            os.replace(partial_path, self.manifest_path)
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown(wait=True)
+        self.checkpoint()
+
+
+class FilesystemSink(Sink):
+    """Write each message as an HTML page plus an attachments directory."""
+
+    def __init__(self, output_dir, max_workers=EXPORT_WORKERS, engine=None):
+        self.output_dir = str(output_dir)
+        self.engine = engine or ExportEngine(output_dir, max_workers=max_workers)
+        self._owns_engine = engine is None
+
+    def contains(self, message):
+        return self.engine.is_exported(export_name(message))
+
+    def add(self, message):
+        email_out = export_name(message)
+        attachment_files = []
+        filenames_by_cid = {}
+        for attachment in message.attachments:
+            filename = sanitize_filename(attachment.filename or 'attachment')
+            attachment_files.append((f"{email_out}_attachments/{filename}", attachment.data))
+            content_id = getattr(attachment, 'content_id', None)
+            if content_id:
+                filenames_by_cid[content_id] = filename
+        body = replace_cid_urls(message.body, email_out, self.output_dir, filenames_by_cid)
+        self.engine.write_message(email_out, build_email_html(message, body=body), attachment_files)
+        return True
+
+    def close(self):
+        if self._owns_engine:
+            self.engine.close()
+        else:
+            self.engine.wait()
+
+
+class ZipStream(io.RawIOBase):
+    """Unseekable file object that collects ZIP output for streaming responses.
+
+    zipfile writes data descriptors when it cannot seek, so an archive can be
+    sent while it is being built: write into the stream, then drain() the
+    bytes produced so far.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipSink(Sink):
+    """Write the file system export layout into a ZIP archive."""
+
+    def __init__(self, target, name_for=export_name, compression=zipfile.ZIP_DEFLATED):
+        self.name_for = name_for
+        self.compression = compression
+        self._owns_zip = not isinstance(target, zipfile.ZipFile)
+        self.zipf = zipfile.ZipFile(target, 'w', compression) if self._owns_zip else target
+        self._name_counts = {}
+
+    def add(self, message):
+        self.write_rendered(self.name_for(message), build_email_html(message), message.attachments)
+        return True
+
+    def unique_name(self, base_name):
+        # Emails sharing recipient, subject and minute get a numbered suffix
+        # instead of duplicate ZIP entries.
+        count = self._name_counts.get(base_name, 0) + 1
+        self._name_counts[base_name] = count
+        return f"{base_name} ({count})" if count > 1 else base_name
+
+    def write_rendered(self, base_name, html, attachments):
+        """Write an already rendered message page and its attachments."""
+        base_name = self.unique_name(base_name)
+        self.zipf.writestr(f"{base_name}.html", html)
+        for attachment in attachments:
+            filename = sanitize_filename(attachment.filename or 'attachment')
+            compression = (zipfile.ZIP_STORED if is_precompressed(getattr(attachment, 'content_type', None), filename)
+                           else self.compression)
+            self.zipf.writestr(f"{base_name}_attachments/{filename}", attachment.data or b'',
+                               compress_type=compression)
+        return base_name
+
+    def close(self):
+        if self._owns_zip:
+            self.zipf.close()
+
+
+class EmlZipSink(ZipSink):
+    """Write one RFC 5322 .eml file per message into a ZIP archive.
+
+    Messages whose size is mostly already-compressed attachments are stored
+    rather than deflated.
+    """
+
+    def add(self, message):
+        self.write_message(self.name_for(message), message, message.attachments)
+        return True
+
+    def write_message(self, base_name, message, attachments):
+        base_name = self.unique_name(base_name)
+        data = build_mime_message(message, attachments)
+        precompressed = sum(
+            len(attachment.data or b'') for attachment in attachments
+            if is_precompressed(getattr(attachment, 'content_type', None), attachment.filename)
+        )
+        compression = zipfile.ZIP_STORED if precompressed * 2 > len(data) else self.compression
+        self.zipf.writestr(f"{base_name}.eml", data, compress_type=compression)
+        return base_name
+
+
+class MboxSink(Sink):
+    """Append messages to an mboxrd stream; nothing is compressed."""
+
+    def __init__(self, target):
+        self.target = target
+
+    def add(self, message):
+        self.write_message(message, message.attachments)
+        return True
+
+    def write_message(self, message, attachments):
+        self.target.write(mbox_from_line(message))
+        self.target.write(build_mime_message(message, attachments, quote_from=True))
+        self.target.write(b'\n')
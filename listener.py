@@ -0,0 +1,198 @@
+# listener.py
+"""
+Push-style ingestion from EWS pull subscriptions.
+
+Instead of rescanning a time window, a MailListener subscribes to new-mail
+events on the inbox and sent items, polls the subscription every few seconds
+(LISTEN_POLL_INTERVAL) and fetches only the items the events name. Every
+batch is stored together with the event watermark it reached, so after a
+reconnect or restart the subscription resumes exactly where it stopped. If
+the server no longer accepts the watermark, the listener subscribes afresh
+and calls on_gap so the caller can run a regular window sync to fill the hole.
+
+Pull subscriptions are used rather than streaming ones: they need no
+long-lived HTTP connection and work through the same proxies as the rest of
+the sync, at the cost of up to one poll interval of latency.
+"""
+import logging
+import os
+
+from ingestion import MessageData
+from models import DEFAULT_ACCOUNT_ID, SubscriptionState, utcnow
+from throttle import ThrottleController
+
+LISTEN_POLL_INTERVAL = float(os.getenv('LISTEN_POLL_INTERVAL', '5'))
+LISTEN_MAX_BACKOFF = float(os.getenv('LISTEN_MAX_BACKOFF', '300'))
+# Minutes the server keeps an idle subscription; every poll resets it.
+SUBSCRIPTION_TIMEOUT = int(os.getenv('SUBSCRIPTION_TIMEOUT', '30'))
+
+SUBSCRIBED_EVENTS = ('NewMailEvent', 'CreatedEvent', 'MovedEvent', 'CopiedEvent')
+
+
+class EWSPullClient:
+    """Thin wrapper over the exchangelib pull subscription calls."""
+
+    def __init__(self, account, folders, throttle=None):
+        self.account = account
+        self.folders = list(folders)
+        self.throttle = throttle or ThrottleController('listener')
+        self.folder_names = {folder.id: folder.name for folder in self.folders}
+
+    def subscribe(self, watermark=None):
+        """Return (subscription_id, watermark)."""
+        from exchangelib.folders import FolderCollection
+
+        collection = FolderCollection(account=self.account, folders=self.folders)
+        return self.throttle.call(
+            collection.subscribe_to_pull,
+            event_types=SUBSCRIBED_EVENTS, watermark=watermark, timeout=SUBSCRIPTION_TIMEOUT,
+        )
+
+    def events(self, subscription_id, watermark):
+        return self.throttle.call(lambda: list(self.folders[0].get_events(subscription_id, watermark)))
+
+    def fetch(self, item_ids):
+        from exchangelib import Message
+
+        for item in self.throttle.call(lambda: list(self.account.fetch(ids=item_ids))):
+            if isinstance(item, Message):
+                parent = getattr(item, 'parent_folder_id', None)
+                yield MessageData(item, folder=self.folder_names.get(getattr(parent, 'id', None)),
+                                  throttle=self.throttle)
+
+    def unsubscribe(self, subscription_id):
+        self.throttle.call(self.folders[0].unsubscribe, subscription_id)
+
+
+def item_key(message):
+    """The EWS item id a fetched message came from."""
+    return getattr(getattr(message, 'item', None), 'id', None)
+
+
+def load_watermark(session, account_id):
+    state = session.get(SubscriptionState, account_id)
+    return state.watermark if state else None
+
+
+def save_watermark(session, account_id, watermark):
+    state = session.get(SubscriptionState, account_id)
+    if state is None:
+        session.add(SubscriptionState(account_id=account_id, watermark=watermark))
+    else:
+        state.watermark = watermark
+        state.updated_at = utcnow()
+
+
+class MailListener:
+    """Feed items named by subscription events into handle_item(message, session, account_id)."""
+
+    def __init__(self, client, session_factory, handle_item, account_id=DEFAULT_ACCOUNT_ID,
+                 poll_interval=LISTEN_POLL_INTERVAL, on_gap=None):
+        self.client = client
+        self.session_factory = session_factory
+        self.handle_item = handle_item
+        self.account_id = account_id
+        self.poll_interval = poll_interval
+        self.on_gap = on_gap
+        self.subscription_id = None
+        self.watermark = None
+        self.failures = 0
+
+    def subscribe(self):
+        if self.watermark is None:
+            with self.session_factory() as session:
+                self.watermark = load_watermark(session, self.account_id)
+        try:
+            self.subscription_id, watermark = self.client.subscribe(self.watermark)
+        except Exception as e:
+            if self.watermark is None:
+                raise
+            logging.warning(f"Cannot resume subscription for {self.account_id} from its watermark: {str(e)}")
+            self.subscription_id, self.watermark = self.client.subscribe(None)
+            with self.session_factory() as session:
+                save_watermark(session, self.account_id, self.watermark)
+            if self.on_gap is not None:
+                self.on_gap(self.account_id)
+            return
+        # When resuming, keep polling from our own watermark.
+        self.watermark = self.watermark or watermark
+
+    def poll_once(self):
+        """Process pending events; returns the number of messages stored.
+
+        Messages and their attachments are fetched before a session is
+        opened to store them. The stored watermark only moves past events
+        whose items were stored (or are gone from the mailbox); from the
+        first item that failed on, the events are delivered again next time.
+        """
+        if self.subscription_id is None:
+            self.subscribe()
+
+        events = []
+        for notification in self.client.events(self.subscription_id, self.watermark):
+            for event in notification.events:
+                item_id = getattr(event, 'item_id', None)
+                if type(event).__name__ not in SUBSCRIBED_EVENTS:
+                    item_id = None
+                events.append((getattr(event, 'watermark', None), item_id))
+        if not events:
+            return 0
+
+        item_ids = [item_id for _, item_id in events if item_id is not None]
+        unique_ids = list({(item_id.id, item_id.changekey): item_id for item_id in item_ids}.values())
+        messages = []
+        failed = set()
+        for message in self.client.fetch(unique_ids) if unique_ids else ():
+            try:
+                message.attachments  # fetched now, outside the session
+                messages.append(message)
+            except Exception as e:
+                logging.error(f"Listener could not fetch {message.message_id}: {str(e)}")
+                failed.add(item_key(message))
+
+        stored = 0
+        with self.session_factory() as session:
+            for message in messages:
+                # Commit per message so one bad item cannot roll back the others.
+                try:
+                    if self.handle_item(message, session, self.account_id):
+                        stored += 1
+                    session.commit()
+                except Exception as e:
+                    logging.error(f"Listener could not store {message.message_id}: {str(e)}")
+                    session.rollback()
+                    failed.add(item_key(message))
+
+            watermark = self.watermark
+            for event_watermark, item_id in events:
+                if item_id is not None and item_id.id in failed:
+                    break
+                watermark = event_watermark or watermark
+            if watermark != self.watermark:
+                save_watermark(session, self.account_id, watermark)
+        self.watermark = watermark
+        if stored:
+            logging.info(f"Listener stored {stored} new emails for {self.account_id}")
+        if failed:
+            logging.warning(f"Listener will retry {len(failed)} item(s) for {self.account_id} from {watermark}")
+        return stored
+
+    def run(self, stop_event):
+        """Poll until stop_event is set, resubscribing with backoff after errors."""
+        while not stop_event.is_set():
+            delay = self.poll_interval
+            try:
+                self.poll_once()
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                self.subscription_id = None
+                delay = min(self.poll_interval * 2 ** self.failures, LISTEN_MAX_BACKOFF)
+                logging.error(f"Mail listener for {self.account_id} failed, retrying in {delay:.0f}s: {str(e)}")
+            stop_event.wait(delay)
+
+        if self.subscription_id is not None:
+            try:
+                self.client.unsubscribe(self.subscription_id)
+            except Exception as e:
+                logging.warning(f"Unsubscribe for {self.account_id} failed: {str(e)}")
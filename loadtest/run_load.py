@@ -0,0 +1,305 @@
+# loadtest/run_load.py
+"""
+End-to-end load test: stub EWS server -> sync -> database -> web.
+
+Starts the stub EWS server (stub_ews.py) and the app under waitress in a
+subprocess, with a throwaway SQLite database (or --database-url) and an
+accounts file pointing every mailbox at the stub. After an initial
+/check-emails has filled the database, client threads send a weighted mix
+of /search, /view and /download-all-emails requests for --duration seconds
+while /check-emails keeps ingesting the mail that arrives at the stub.
+
+Reports p50/p95/p99 latency and throughput per endpoint. --save writes the
+results as JSON; --compare fails (exit status 1) when an endpoint's p95 is
+more than --tolerance slower than in a saved baseline, or when it fails more
+requests than it did there:
+
+    python loadtest/run_load.py --messages 2000 --size medium --latency-ms 30 \\
+        --clients 8 --duration 60 --save baseline.json
+    python loadtest/run_load.py ... --compare baseline.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from stub_ews import WORDS, add_profile_arguments, server_from_args
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+ENDPOINTS = ('search', 'view', 'download', 'check-emails')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Recorder:
+    """Latency samples and errors per endpoint, shared by the client threads."""
+
+    def __init__(self):
+        self.samples = {name: [] for name in ENDPOINTS}
+        self.errors = {name: 0 for name in ENDPOINTS}
+        self.bytes = {name: 0 for name in ENDPOINTS}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, ok, size=0):
+        with self._lock:
+            self.samples[name].append(seconds)
+            self.bytes[name] += size
+            if not ok:
+                self.errors[name] += 1
+
+    def summary(self, elapsed):
+        results = {}
+        for name in ENDPOINTS:
+            ordered = sorted(self.samples[name])
+            if not ordered:
+                continue
+            results[name] = {
+                'requests': len(ordered),
+                'errors': self.errors[name],
+                'per_second': round(len(ordered) / elapsed, 2),
+                'mb_per_second': round(self.bytes[name] / elapsed / 1024 / 1024, 2),
+                **{f'p{int(p * 100)}_ms': round(percentile(ordered, p) * 1000, 1) for p in (0.5, 0.95, 0.99)},
+                'max_ms': round(ordered[-1] * 1000, 1),
+            }
+        return results
+
+
+def timed_get(session, recorder, name, url, **kwargs):
+    started = time.perf_counter()
+    size = 0
+    try:
+        with session.get(url, stream=True, timeout=300, **kwargs) as response:
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+            ok = response.status_code < 400
+    except requests.RequestException:
+        ok = False
+    recorder.record(name, time.perf_counter() - started, ok, size)
+
+
+def client_loop(base_url, args, email_ids, recorder, stop, seed):
+    rng = random.Random(seed)
+    names, weights = zip(*args.mix.items())
+    export_start = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(time.time() - args.export_hours * 3600))
+    with requests.Session() as session:
+        session.headers['Accept-Encoding'] = 'gzip'
+        while not stop.is_set():
+            name = rng.choices(names, weights)[0]
+            if name == 'search':
+                timed_get(session, recorder, name, f'{base_url}/search',
+                          params={'query': rng.choice(WORDS), 'limit': args.search_limit})
+            elif name == 'view':
+                timed_get(session, recorder, name, f'{base_url}/view/{rng.choice(email_ids)}')
+            else:
+                timed_get(session, recorder, name, f'{base_url}/download-all-emails',
+                          params={'format': args.export_format, 'start': export_start, 'name': f'load-{seed}'})
+
+
+def check_emails(base_url, recorder=None):
+    """POST /check-emails; returns the number of emails stored."""
+    started = time.perf_counter()
+    try:
+        response = requests.post(f'{base_url}/check-emails', timeout=3600)
+        payload = response.json()
+        ok = response.ok and payload.get('success', False)
+        created = sum(result.get('created', 0) for result in (payload.get('data') or {}).values())
+    except (requests.RequestException, ValueError):
+        ok, created = False, 0
+    if recorder is not None:
+        recorder.record('check-emails', time.perf_counter() - started, ok)
+    return created
+
+
+def ingest_loop(base_url, interval, recorder, stop, totals):
+    while not stop.wait(interval):
+        totals['stored'] += check_emails(base_url, recorder)
+
+
+def write_accounts(path, stub_url, count):
+    accounts = [
+        {'id': f'load{number}', 'email': f'sales{number}@example.com', 'username': 'LOAD\\svc',
+         'password': 'load', 'server': stub_url, 'folders': ['inbox', 'sent']}
+        for number in range(count)
+    ]
+    path.write_text(json.dumps(accounts), encoding='utf-8')
+
+
+def start_app(args, workdir, stub_url, port):
+    accounts_file = workdir / 'accounts.json'
+    write_accounts(accounts_file, stub_url, args.accounts)
+    env = dict(
+        os.environ,
+        DATABASE_URL=args.database_url or f"sqlite:///{workdir / 'loadtest.db'}",
+        ACCOUNTS_FILE=str(accounts_file),
+        PROFILE_DIR=str(workdir / 'profiles'),
+        ARCHIVE_DIR=str(workdir / 'archive'),
+        WAITRESS_THREADS=str(args.threads),
+    )
+    log = open(workdir / 'app.log', 'wb')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'waitress', f'--port={port}', f'--threads={args.threads}', '--call',
+         'app:create_app'],
+        cwd=PROJECT_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup; see {workdir / 'app.log'}")
+        try:
+            if requests.get(f'{base_url}/accounts', timeout=5).ok:
+                return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("App did not start within 60 seconds")
+
+
+def email_ids(base_url, limit=2000):
+    response = requests.get(f'{base_url}/api/emails', params={'fields': 'id', 'limit': limit}, timeout=120)
+    return [json.loads(line)['id'] for line in response.text.splitlines() if line]
+
+
+def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix='outlook-load-'))
+    stub = server_from_args(args, ('127.0.0.1', 0)).start()
+    process = None
+    try:
+        process, base_url = start_app(args, workdir, stub.url, args.app_port or free_port())
+
+        started = time.perf_counter()
+        stored = check_emails(base_url)
+        initial = {'stored': stored, 'seconds': round(time.perf_counter() - started, 2)}
+        initial['per_second'] = round(stored / initial['seconds'], 1) if initial['seconds'] else None
+        print(f"Initial sync: {stored} emails in {initial['seconds']}s ({initial['per_second']} emails/s)")
+        ids = email_ids(base_url)
+        if not ids:
+            raise RuntimeError(f"Initial sync stored nothing; see {workdir / 'app.log'}")
+
+        recorder = Recorder()
+        stop = threading.Event()
+        totals = {'stored': 0}
+        threads = [threading.Thread(target=ingest_loop, args=(base_url, args.check_interval, recorder, stop, totals))]
+        threads += [
+            threading.Thread(target=client_loop, args=(base_url, args, ids, recorder, stop, args.seed + number))
+            for number in range(args.clients)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        stub.shutdown()
+        stub.server_close()
+
+    results = {
+        'config': {name: value for name, value in vars(args).items() if name not in ('save', 'compare')},
+        'initial_sync': initial,
+        'seconds': round(elapsed, 2),
+        'ingested_during_load': totals['stored'],
+        'endpoints': recorder.summary(elapsed),
+        'stub': stub.stats(),
+        'workdir': str(workdir),
+    }
+    return results
+
+
+def print_report(results):
+    print(f"\n{results['seconds']}s under load, {results['ingested_during_load']} emails ingested meanwhile, "
+          f"stub throttled {results['stub']['throttled']} EWS request(s)")
+    print(f"{'endpoint':>14} {'requests':>9} {'errors':>7} {'req/s':>8} {'MB/s':>7} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, row in results['endpoints'].items():
+        print(f"{name:>14} {row['requests']:>9} {row['errors']:>7} {row['per_second']:>8} {row['mb_per_second']:>7} "
+              f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9} {row['max_ms']:>9}")
+
+
+def regressions(results, baseline, tolerance):
+    """Endpoints whose p95 grew by more than tolerance (a fraction), or whose errors grew, over the baseline."""
+    slower = []
+    for name, row in results['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(name)
+        if before and before['p95_ms'] and row['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            slower.append(f"{name}: p95 {row['p95_ms']} ms vs {before['p95_ms']} ms")
+        # A stall shows up as timeouts rather than as slow successes.
+        if row.get('errors', 0) > (before or {}).get('errors', 0):
+            slower.append(f"{name}: {row['errors']} errors vs {(before or {}).get('errors', 0)}")
+    return slower
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('search', 'view', 'download'):
+            raise argparse.ArgumentTypeError(f"Unknown endpoint in mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_profile_arguments(parser)
+    parser.add_argument('--accounts', type=int, default=1, help='mailboxes, each synced from the stub')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds under load')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('search=6,view=3,download=1'))
+    parser.add_argument('--check-interval', type=float, default=5.0, help='seconds between /check-emails')
+    parser.add_argument('--search-limit', type=int, default=50)
+    parser.add_argument('--export-format', choices=('html', 'eml', 'mbox'), default='html')
+    parser.add_argument('--export-hours', type=float, default=6.0, help='exports cover this many recent hours')
+    parser.add_argument('--threads', type=int, default=4, help='waitress threads')
+    parser.add_argument('--app-port', type=int, default=0)
+    parser.add_argument('--database-url', help='defaults to a throwaway SQLite file')
+    parser.add_argument('--save', help='write the results as JSON to this path')
+    parser.add_argument('--compare', help='baseline JSON from an earlier --save')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 growth over the baseline')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    results = run(args)
+    print_report(results)
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2), encoding='utf-8')
+    if args.compare:
+        slower = regressions(results, json.loads(Path(args.compare).read_text(encoding='utf-8')), args.tolerance)
+        for line in slower:
+            print(f"REGRESSION {line}")
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
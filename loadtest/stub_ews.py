@@ -0,0 +1,594 @@
+# loadtest/stub_ews.py
+"""
+A local stand-in for an Exchange server's EWS endpoint.
+
+Serves a synthetic mailbox over SOAP, enough of EWS for exchangelib and the
+sync path: version and auth probing, GetFolder on the distinguished root,
+inbox and sent folders, paged and filtered FindItem, GetItem and
+GetAttachment, and pull subscriptions (Subscribe, GetEvents, Unsubscribe) for
+the mail listener. Messages are generated from their index, so a mailbox of
+any size costs no memory, and new mail keeps arriving at --arrival-rate per
+second while the server runs.
+
+Profiles make the stub behave like a loaded server:
+
+- latency: every response is delayed by --latency-ms plus up to --jitter-ms;
+- throttling: --throttle-rate answers that fraction of requests with
+  ErrorServerBusy, and --max-concurrency answers ErrorServerBusy while more
+  requests than that are in flight;
+- size: --size small|medium|large picks body and attachment sizes.
+
+    python loadtest/stub_ews.py --port 8808 --messages 2000 --size medium --latency-ms 40
+
+Point an account at it with the URL as its server (any username/password):
+"server": "http://127.0.0.1:8808/EWS/Exchange.asmx".
+"""
+import argparse
+import base64
+import bisect
+import itertools
+import logging
+import operator
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+MESSAGES_NS = 'http://schemas.microsoft.com/exchange/services/2006/messages'
+TYPES_NS = 'http://schemas.microsoft.com/exchange/services/2006/types'
+ERRORS_NS = 'http://schemas.microsoft.com/exchange/services/2006/errors'
+
+SERVER_VERSION = ('<h:ServerVersionInfo MajorVersion="15" MinorVersion="1" MajorBuildNumber="2507" '
+                  f'MinorBuildNumber="6" Version="V2017_07_11" xmlns:h="{TYPES_NS}"/>')
+
+SIZE_PROFILES = {
+    # body KB, attachments per message, KB per attachment
+    'small': (2, 0, 0),
+    'medium': (20, 1, 100),
+    'large': (150, 3, 1024),
+}
+FOLDERS = {
+    # distinguished id: (display name, folder class)
+    'root': ('Root', None),
+    'msgfolderroot': ('Top of Information Store', 'IPF.Note'),
+    'inbox': ('Inbox', 'IPF.Note'),
+    'sentitems': ('Sent Items', 'IPF.Note'),
+}
+MAIL_FOLDERS = ('inbox', 'sentitems')
+# exchangelib turns a throttled version probe into a TransportError, so the
+# handshake is never throttled.
+UNTHROTTLED_OPERATIONS = frozenset({'ConvertId'})
+ATTACHMENT_TYPES = (
+    ('quote.pdf', 'application/pdf'),
+    ('photo.jpg', 'image/jpeg'),
+    ('orders.csv', 'text/csv'),
+)
+# Most events GetEvents returns at once; the rest follow with MoreEvents.
+MAX_EVENTS = 50
+WORDS = ('quote', 'order', 'delivery', 'chlorine', 'tablets', 'invoice', 'units', 'pool', 'service', 'schedule',
+         'pump', 'filter', 'warranty', 'account', 'shipment', 'pallet', 'pricing', 'contract', 'renewal', 'visit')
+
+
+def tag(namespace, name):
+    return f'{{{namespace}}}{name}'
+
+
+def ews_datetime(value):
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_ews_datetime(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+class SyntheticMailbox:
+    """A deterministic mailbox: message n of a folder is generated from (seed, folder, n).
+
+    messages already exist when the mailbox is created, spread over the last
+    days; after that arrival_rate new messages per second arrive in each folder.
+    """
+
+    def __init__(self, messages=1000, days=7, size='medium', arrival_rate=0.0, seed=0, clock=time.time):
+        if size not in SIZE_PROFILES:
+            raise ValueError(f"Unknown size profile: {size}")
+        self.initial = messages
+        self.size = size
+        self.arrival_rate = arrival_rate
+        self.seed = seed
+        self.clock = clock
+        self.started = clock()
+        self.spacing = days * 86400 / max(messages, 1)
+        # subscription id -> subscribed mail folders
+        self.subscriptions = {}
+        self._subscription_ids = itertools.count(1)
+
+    def count(self):
+        return self.initial + int((self.clock() - self.started) * self.arrival_rate)
+
+    def received(self, index):
+        if index < self.initial:
+            offset = -(self.initial - index) * self.spacing
+        else:
+            offset = (index - self.initial + 1) / self.arrival_rate
+        return datetime.fromtimestamp(self.started + offset, timezone.utc).replace(microsecond=0)
+
+    def item_id(self, folder, index):
+        return f'{folder}.{index}'
+
+    def parse_item_id(self, item_id):
+        folder, _, index = item_id.partition('.')
+        if folder not in MAIL_FOLDERS or not index.isdigit() or int(index) >= self.count():
+            return None
+        return folder, int(index)
+
+    def find(self, conditions, descending=True):
+        """Indexes of the messages received within the (operator name, bound) conditions.
+
+        Received times grow with the index, so the matches are one range,
+        found by bisection.
+        """
+        def holds(index, lower):
+            received = self.received(index)
+            return all(
+                RESTRICTION_OPERATORS[name][0](received, bound)
+                for name, bound in conditions if RESTRICTION_OPERATORS[name][1 if lower else 2]
+            )
+
+        indexes = range(self.count())
+        start = bisect.bisect_left(indexes, True, key=lambda index: holds(index, lower=True))
+        stop = bisect.bisect_left(indexes, True, key=lambda index: not holds(index, lower=False))
+        matched = range(start, max(start, stop))
+        return matched[::-1] if descending else matched
+
+    def subscribe(self, folders):
+        subscription_id = f'sub-{next(self._subscription_ids)}'
+        self.subscriptions[subscription_id] = folders
+        return subscription_id
+
+    def parse_watermark(self, folders, watermark):
+        """Position of a watermark in the subscription's event stream, or None if it is not one.
+
+        Event n of a subscription is the arrival of message n // len(folders)
+        in folders[n % len(folders)]; a watermark is the number of events
+        before it, so it stays valid across subscriptions on the same folders.
+        """
+        if not watermark.isdigit() or int(watermark) > self.count() * len(folders):
+            return None
+        return int(watermark)
+
+    def events(self, folders, position, limit=MAX_EVENTS):
+        """(folder, index, watermark) of up to limit arrivals after position."""
+        end = min(self.count() * len(folders), position + limit)
+        return [(folders[n % len(folders)], n // len(folders), str(n + 1)) for n in range(position, end)]
+
+    def message(self, folder, index):
+        rng = random.Random(f'{self.seed}:{folder}:{index}')
+        body_kb, attachment_count, attachment_kb = SIZE_PROFILES[self.size]
+        words = ' '.join(rng.choice(WORDS) for _ in range(12))
+        paragraph = f'<p>{words} Q-{rng.randint(10000, 99999)}.</p>\n'
+        customer = f'customer{rng.randint(1, 200)}@example.com'
+        mailbox = 'sales@example.com'
+        return {
+            'subject': f'{rng.choice(WORDS).title()} {rng.choice(WORDS)} #{index}',
+            'sender': mailbox if folder == 'sentitems' else customer,
+            'to': customer if folder == 'sentitems' else mailbox,
+            'received': self.received(index),
+            'body': '<html><body>' + paragraph * max(1, body_kb * 1024 // len(paragraph)) + '</body></html>',
+            'attachments': [
+                (f'{folder}.{index}.{number}',) + ATTACHMENT_TYPES[(index + number) % len(ATTACHMENT_TYPES)]
+                for number in range(attachment_count if index % 2 == 0 else 0)
+            ],
+            'attachment_size': attachment_kb * 1024,
+        }
+
+    def attachment_content(self, attachment_id, size):
+        return random.Random(f'{self.seed}:{attachment_id}').randbytes(size)
+
+
+class StubEWSServer(ThreadingHTTPServer):
+    """Threaded HTTP server answering EWS SOAP requests from a SyntheticMailbox."""
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), mailbox=None, latency_ms=0.0, jitter_ms=0.0, throttle_rate=0.0,
+                 max_concurrency=0, back_off_ms=500, seed=0):
+        super().__init__(address, StubEWSHandler)
+        self.mailbox = mailbox or SyntheticMailbox()
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.max_concurrency = max_concurrency
+        self.back_off_ms = back_off_ms
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.requests = {}
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/EWS/Exchange.asmx'
+
+    def start(self):
+        """Serve in a daemon thread; returns self."""
+        threading.Thread(target=self.serve_forever, name='stub-ews', daemon=True).start()
+        return self
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests), 'throttled': self.throttled, 'messages': self.mailbox.count()}
+
+    def enter(self, operation):
+        """Count the request in; returns False when it should be throttled."""
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            self.in_flight += 1
+            if operation in UNTHROTTLED_OPERATIONS:
+                return True
+            busy = bool(self.max_concurrency) and self.in_flight > self.max_concurrency
+            if busy or (self.throttle_rate and self.random.random() < self.throttle_rate):
+                self.throttled += 1
+                return False
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def delay(self):
+        delay_ms = self.latency_ms + (self.random.uniform(0, self.jitter_ms) if self.jitter_ms else 0)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+
+class StubEWSHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(f"stub EWS: {format % args}")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.headers.get('Authorization'):
+            # exchangelib probes for the auth type before its first real request.
+            self.send_reply(401, b'', {'WWW-Authenticate': 'Basic realm="stub"'})
+            return
+        try:
+            request_body = ElementTree.fromstring(body).find(tag(SOAP_NS, 'Body'))
+            operation = request_body[0]
+        except (ElementTree.ParseError, IndexError, TypeError):
+            self.send_reply(400, b'Bad SOAP request')
+            return
+
+        name = operation.tag.rpartition('}')[2]
+        server = self.server
+        allowed = server.enter(name)
+        try:
+            server.delay()
+            if not allowed:
+                self.send_reply(500, server_busy_fault(server.back_off_ms))
+                return
+            handler = OPERATIONS.get(name)
+            if handler is None:
+                self.send_reply(500, soap_fault('ErrorInvalidRequest', f'{name} is not supported by the stub'))
+                return
+            self.send_reply(200, envelope(f'<m:{name}Response>{handler(server.mailbox, operation)}</m:{name}Response>'))
+        finally:
+            server.leave()
+
+    def send_reply(self, status, payload, headers=None):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def envelope(body):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        f'<s:Envelope xmlns:s="{SOAP_NS}" xmlns:m="{MESSAGES_NS}" xmlns:t="{TYPES_NS}">'
+        f'<s:Header>{SERVER_VERSION}</s:Header><s:Body>{body}</s:Body></s:Envelope>'
+    )
+
+
+def soap_fault(code, message, message_xml=''):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        f'<s:Envelope xmlns:s="{SOAP_NS}"><s:Body><s:Fault>'
+        f'<faultcode>s:Server</faultcode><faultstring>{escape(message)}</faultstring><detail>'
+        f'<e:ResponseCode xmlns:e="{ERRORS_NS}">{code}</e:ResponseCode>'
+        f'<e:Message xmlns:e="{ERRORS_NS}">{escape(message)}</e:Message>{message_xml}'
+        '</detail></s:Fault></s:Body></s:Envelope>'
+    )
+
+
+def server_busy_fault(back_off_ms):
+    return soap_fault(
+        'ErrorServerBusy', 'The server cannot service this request right now. Try again later.',
+        f'<t:MessageXml xmlns:t="{TYPES_NS}"><t:Value Name="BackOffMilliseconds">{back_off_ms}</t:Value></t:MessageXml>',
+    )
+
+
+def response_message(operation, content='', code='NoError'):
+    response_class = 'Success' if code == 'NoError' else 'Error'
+    message = '' if code == 'NoError' else f'<m:MessageText>{code}</m:MessageText>'
+    return (f'<m:{operation}ResponseMessage ResponseClass="{response_class}">{message}'
+            f'<m:ResponseCode>{code}</m:ResponseCode>{content}</m:{operation}ResponseMessage>')
+
+
+def response_messages(messages):
+    return f'<m:ResponseMessages>{"".join(messages)}</m:ResponseMessages>'
+
+
+def folder_xml(folder_id, total=None):
+    name, folder_class = FOLDERS[folder_id]
+    parts = [f'<t:FolderId Id="{folder_id}" ChangeKey="1"/>']
+    if folder_class:
+        parts.append(f'<t:FolderClass>{folder_class}</t:FolderClass>')
+    parts.append(f'<t:DisplayName>{name}</t:DisplayName>')
+    if total is not None:
+        parts.append(f'<t:TotalCount>{total}</t:TotalCount><t:ChildFolderCount>0</t:ChildFolderCount>'
+                     '<t:UnreadCount>0</t:UnreadCount>')
+    return f'<t:Folder>{"".join(parts)}</t:Folder>'
+
+
+def requested_folder_ids(element):
+    return [node.get('Id') for node in element.iter() if node.tag in (
+        tag(TYPES_NS, 'DistinguishedFolderId'), tag(TYPES_NS, 'FolderId'))]
+
+
+def get_folder(mailbox, operation):
+    messages = []
+    for folder_id in requested_folder_ids(operation.find(tag(MESSAGES_NS, 'FolderIds'))):
+        if folder_id not in FOLDERS:
+            messages.append(response_message('GetFolder', code='ErrorFolderNotFound'))
+            continue
+        total = mailbox.count() if folder_id in MAIL_FOLDERS else None
+        messages.append(response_message('GetFolder', f'<m:Folders>{folder_xml(folder_id, total)}</m:Folders>'))
+    return response_messages(messages)
+
+
+RESTRICTION_OPERATORS = {
+    # operator: (comparison, bounds the range from below, from above)
+    'IsGreaterThan': (operator.gt, True, False),
+    'IsGreaterThanOrEqualTo': (operator.ge, True, False),
+    'IsLessThan': (operator.lt, False, True),
+    'IsLessThanOrEqualTo': (operator.le, False, True),
+    'IsEqualTo': (operator.eq, True, True),
+}
+
+
+def restriction_conditions(element):
+    """(operator name, bound) for each DateTimeReceived comparison in a FindItem restriction.
+
+    Comparisons are treated as a conjunction and conditions on other fields
+    are ignored; the stub only filters by date.
+    """
+    conditions = []
+    for node in element.iter() if element is not None else ():
+        name = node.tag.rpartition('}')[2]
+        field = node.find(tag(TYPES_NS, 'FieldURI'))
+        constant = node.find(f'.//{tag(TYPES_NS, "Constant")}')
+        if (name in RESTRICTION_OPERATORS and field is not None and constant is not None
+                and field.get('FieldURI') == 'item:DateTimeReceived'):
+            conditions.append((name, parse_ews_datetime(constant.get('Value'))))
+    return conditions
+
+
+def find_item(mailbox, operation):
+    messages = []
+    view = operation.find(tag(MESSAGES_NS, 'IndexedPageItemView'))
+    limit = int(view.get('MaxEntriesReturned', '100')) if view is not None else 1000
+    offset = int(view.get('Offset', '0')) if view is not None else 0
+    order = operation.find(f'.//{tag(TYPES_NS, "FieldOrder")}')
+    descending = order is None or order.get('Order') == 'Descending'
+    conditions = restriction_conditions(operation.find(tag(MESSAGES_NS, 'Restriction')))
+
+    for folder_id in requested_folder_ids(operation.find(tag(MESSAGES_NS, 'ParentFolderIds'))):
+        if folder_id not in FOLDERS:
+            messages.append(response_message('FindItem', code='ErrorFolderNotFound'))
+            continue
+        indexes = mailbox.find(conditions, descending) if folder_id in MAIL_FOLDERS else range(0)
+        page = indexes[offset:offset + limit]
+        items = ''.join(
+            f'<t:Message><t:ItemId Id="{mailbox.item_id(folder_id, index)}" ChangeKey="1"/>'
+            f'<t:DateTimeReceived>{ews_datetime(mailbox.received(index))}</t:DateTimeReceived></t:Message>'
+            for index in page
+        )
+        last = offset + len(page) >= len(indexes)
+        messages.append(response_message('FindItem', (
+            f'<m:RootFolder IndexedPagingOffset="{offset + len(page)}" TotalItemsInView="{len(indexes)}" '
+            f'IncludesLastItemInRange="{str(last).lower()}"><t:Items>{items}</t:Items></m:RootFolder>'
+        )))
+    return response_messages(messages)
+
+
+def mailbox_xml(address):
+    return (f'<t:Mailbox><t:Name>{escape(address.split("@")[0])}</t:Name><t:EmailAddress>{escape(address)}'
+            '</t:EmailAddress><t:RoutingType>SMTP</t:RoutingType><t:MailboxType>Mailbox</t:MailboxType></t:Mailbox>')
+
+
+def message_xml(mailbox, folder, index):
+    message = mailbox.message(folder, index)
+    item_id = mailbox.item_id(folder, index)
+    attachments = ''.join(
+        f'<t:FileAttachment><t:AttachmentId Id="{attachment_id}"/><t:Name>{escape(name)}</t:Name>'
+        f'<t:ContentType>{content_type}</t:ContentType><t:Size>{message["attachment_size"]}</t:Size>'
+        '<t:IsInline>false</t:IsInline></t:FileAttachment>'
+        for attachment_id, name, content_type in message['attachments']
+    )
+    received = ews_datetime(message['received'])
+    return (
+        f'<t:Message><t:ItemId Id="{item_id}" ChangeKey="1"/><t:ParentFolderId Id="{folder}" ChangeKey="1"/>'
+        f'<t:ItemClass>IPM.Note</t:ItemClass><t:Subject>{escape(message["subject"])}</t:Subject>'
+        f'<t:Body BodyType="HTML">{escape(message["body"])}</t:Body>'
+        + (f'<t:Attachments>{attachments}</t:Attachments>' if attachments else '')
+        + f'<t:DateTimeReceived>{received}</t:DateTimeReceived><t:DateTimeSent>{received}</t:DateTimeSent>'
+        f'<t:DateTimeCreated>{received}</t:DateTimeCreated>'
+        f'<t:HasAttachments>{str(bool(attachments)).lower()}</t:HasAttachments>'
+        f'<t:Sender>{mailbox_xml(message["sender"])}</t:Sender>'
+        f'<t:ToRecipients>{mailbox_xml(message["to"])}</t:ToRecipients>'
+        f'<t:IsRead>false</t:IsRead>'
+        f'<t:InternetMessageId>{escape(f"<{item_id}.{mailbox.seed}@stub.example.com>")}</t:InternetMessageId>'
+        f'<t:From>{mailbox_xml(message["sender"])}</t:From></t:Message>'
+    )
+
+
+def get_item(mailbox, operation):
+    messages = []
+    for node in operation.find(tag(MESSAGES_NS, 'ItemIds')):
+        parsed = mailbox.parse_item_id(node.get('Id', ''))
+        if parsed is None:
+            messages.append(response_message('GetItem', code='ErrorItemNotFound'))
+            continue
+        messages.append(response_message('GetItem', f'<m:Items>{message_xml(mailbox, *parsed)}</m:Items>'))
+    return response_messages(messages)
+
+
+def get_attachment(mailbox, operation):
+    messages = []
+    for node in operation.find(tag(MESSAGES_NS, 'AttachmentIds')):
+        attachment_id = node.get('Id', '')
+        folder_index, _, number = attachment_id.rpartition('.')
+        parsed = mailbox.parse_item_id(folder_index)
+        message = mailbox.message(*parsed) if parsed else None
+        found = [a for a in (message or {}).get('attachments', []) if a[0] == attachment_id]
+        if not found:
+            messages.append(response_message('GetAttachment', code='ErrorItemNotFound'))
+            continue
+        _, name, content_type = found[0]
+        content = base64.b64encode(mailbox.attachment_content(attachment_id, message['attachment_size'])).decode()
+        messages.append(response_message('GetAttachment', (
+            f'<m:Attachments><t:FileAttachment><t:AttachmentId Id={quoteattr(attachment_id)}/>'
+            f'<t:Name>{escape(name)}</t:Name><t:ContentType>{content_type}</t:ContentType>'
+            f'<t:Content>{content}</t:Content></t:FileAttachment></m:Attachments>'
+        )))
+    return response_messages(messages)
+
+
+def subscribe(mailbox, operation):
+    request = operation.find(tag(MESSAGES_NS, 'PullSubscriptionRequest'))
+    if request is None:
+        return response_messages([response_message('Subscribe', code='ErrorInvalidSubscriptionRequest')])
+    folders = [folder_id for folder_id in requested_folder_ids(request.find(tag(TYPES_NS, 'FolderIds')))
+               if folder_id in MAIL_FOLDERS]
+    if not folders:
+        return response_messages([response_message('Subscribe', code='ErrorFolderNotFound')])
+    watermark = request.findtext(tag(MESSAGES_NS, 'Watermark'))
+    if watermark is None:
+        watermark = str(mailbox.count() * len(folders))
+    elif mailbox.parse_watermark(folders, watermark) is None:
+        return response_messages([response_message('Subscribe', code='ErrorInvalidWatermark')])
+    subscription_id = mailbox.subscribe(folders)
+    return response_messages([response_message('Subscribe', (
+        f'<m:SubscriptionId>{subscription_id}</m:SubscriptionId><m:Watermark>{watermark}</m:Watermark>'
+    ))])
+
+
+def get_events(mailbox, operation):
+    subscription_id = operation.findtext(tag(MESSAGES_NS, 'SubscriptionId'), '')
+    watermark = operation.findtext(tag(MESSAGES_NS, 'Watermark'), '')
+    folders = mailbox.subscriptions.get(subscription_id)
+    if folders is None:
+        return response_messages([response_message('GetEvents', code='ErrorSubscriptionNotFound')])
+    position = mailbox.parse_watermark(folders, watermark)
+    if position is None:
+        return response_messages([response_message('GetEvents', code='ErrorInvalidWatermark')])
+
+    events = mailbox.events(folders, position)
+    more = position + len(events) < mailbox.count() * len(folders)
+    if events:
+        body = ''.join(
+            f'<t:NewMailEvent><t:Watermark>{event_watermark}</t:Watermark>'
+            f'<t:TimeStamp>{ews_datetime(mailbox.received(index))}</t:TimeStamp>'
+            f'<t:ItemId Id="{mailbox.item_id(folder, index)}" ChangeKey="1"/>'
+            f'<t:ParentFolderId Id="{folder}" ChangeKey="1"/></t:NewMailEvent>'
+            for folder, index, event_watermark in events
+        )
+    else:
+        body = f'<t:StatusEvent><t:Watermark>{watermark}</t:Watermark></t:StatusEvent>'
+    return response_messages([response_message('GetEvents', (
+        f'<m:Notification><t:SubscriptionId>{escape(subscription_id)}</t:SubscriptionId>'
+        f'<t:PreviousWatermark>{watermark}</t:PreviousWatermark>'
+        f'<t:MoreEvents>{str(more).lower()}</t:MoreEvents>{body}</m:Notification>'
+    ))])
+
+
+def unsubscribe(mailbox, operation):
+    subscription_id = operation.findtext(tag(MESSAGES_NS, 'SubscriptionId'), '')
+    if mailbox.subscriptions.pop(subscription_id, None) is None:
+        return response_messages([response_message('Unsubscribe', code='ErrorSubscriptionNotFound')])
+    return response_messages([response_message('Unsubscribe')])
+
+
+def convert_id(mailbox, operation):
+    # Only used by exchangelib to read the server version from the SOAP header.
+    return response_messages([response_message('ConvertId', code='ErrorInvalidIdMalformed')])
+
+
+OPERATIONS = {
+    'ConvertId': convert_id,
+    'GetFolder': get_folder,
+    'FindItem': find_item,
+    'GetItem': get_item,
+    'GetAttachment': get_attachment,
+    'Subscribe': subscribe,
+    'GetEvents': get_events,
+    'Unsubscribe': unsubscribe,
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8808)
+    add_profile_arguments(parser)
+    return parser
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--messages', type=int, default=1000, help='messages per folder at start')
+    parser.add_argument('--days', type=int, default=7, help='days the initial messages are spread over')
+    parser.add_argument('--size', choices=sorted(SIZE_PROFILES), default='medium')
+    parser.add_argument('--arrival-rate', type=float, default=0.0, help='new messages per second per folder')
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered ServerBusy')
+    parser.add_argument('--max-concurrency', type=int, default=0, help='ServerBusy above this many requests')
+    parser.add_argument('--back-off-ms', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def server_from_args(args, address):
+    mailbox = SyntheticMailbox(args.messages, days=args.days, size=args.size, arrival_rate=args.arrival_rate,
+                               seed=args.seed)
+    return StubEWSServer(address, mailbox, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                         throttle_rate=args.throttle_rate, max_concurrency=args.max_concurrency,
+                         back_off_ms=args.back_off_ms, seed=args.seed)
+
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = server_from_args(args, (args.host, args.port))
+    logging.info(f"Stub EWS serving {args.messages} {args.size} messages per folder at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# models.py
+import hashlib
+from datetime import datetime
+
+import pytz
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    Text,
+)
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session, declarative_base, relationship
+
+Base = declarative_base()
+
+# Account id for the single .env mailbox and for rows stored before accounts existed.
+DEFAULT_ACCOUNT_ID = 'default'
+
+
+def utcnow():
+    return datetime.now(pytz.UTC)
+
+
+class Email(Base):
+    __tablename__ = 'emails'
+
+    id = Column(Integer, primary_key=True)
+    # Unique per account: the same message can sit in several shared mailboxes.
+    message_id = Column(String(255), index=True)
+    account_id = Column(String(255), default=DEFAULT_ACCOUNT_ID)
+    subject = Column(Text)
+    sender = Column(String(255))
+    recipients = Column(Text)
+    datetime_received = Column(DateTime(timezone=True))
+    body = Column(Text)
+    folder = Column(String(255), index=True)
+    # Denormalized so list views can show paperclips without touching attachments.
+    attachment_count = Column(Integer, default=0)
+    attachment_total_bytes = Column(BigInteger, default=0)
+    created_at = Column(DateTime(timezone=True), default=utcnow)
+
+    attachments = relationship('Attachment', back_populates='email', cascade='all, delete-orphan')
+
+    # Lookups and listings lead with account_id so each mailbox is its own
+    # index range and a huge mailbox does not slow queries for the others.
+    __table_args__ = (
+        Index('ux_emails_account_message', 'account_id', 'message_id', unique=True),
+        Index('ix_emails_account_received', 'account_id', 'datetime_received'),
+        # Ids outlive their rows in archives, caches and URLs; never reuse them.
+        {'sqlite_autoincrement': True},
+    )
+
+
+class Attachment(Base):
+    __tablename__ = 'attachments'
+
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, ForeignKey('emails.id', ondelete='CASCADE'), index=True)
+    filename = Column(Text)
+    content_type = Column(String(255))
+    data = Column(LargeBinary)
+    size = Column(Integer)
+    content_id = Column(String(255))
+    is_inline = Column(Boolean, default=False)
+    content_hash = Column(String(64), index=True)
+    created_at = Column(DateTime(timezone=True), default=utcnow)
+
+    email = relationship('Email', back_populates='attachments')
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+def attachment_size(attachment):
+    if attachment.size is not None:
+        return attachment.size
+    return len(attachment.data) if attachment.data else 0
+
+
+@event.listens_for(Attachment, 'before_insert')
+def set_attachment_size(mapper, connection, target):
+    if target.size is None:
+        target.size = attachment_size(target)
+    if target.content_hash is None and target.data is not None:
+        # Names the content in cache keys and ETags, which outlive row ids.
+        target.content_hash = hashlib.sha256(target.data).hexdigest()
+
+
+@event.listens_for(Email, 'before_insert')
+def set_attachment_aggregates(mapper, connection, target):
+    """Fill the attachment aggregates from the attachments inserted with the email."""
+    attachments = target.attachments
+    target.attachment_count = len(attachments)
+    target.attachment_total_bytes = sum(attachment_size(attachment) for attachment in attachments)
+
+
+class ChangeCounter(Base):
+    """A counter bumped in the same transaction as the changes it tracks.
+
+    Every process, including bulk_import.py and retention.py runs, sees the
+    new value as soon as the change commits; the /search cache uses the
+    'search' counter as its generation.
+    """
+
+    __tablename__ = 'change_counters'
+
+    name = Column(String(64), primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+def bump_counter(connection, name):
+    """Increment a ChangeCounter inside the caller's transaction."""
+    table = ChangeCounter.__table__
+    if connection.dialect.name in ('sqlite', 'postgresql'):
+        if connection.dialect.name == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table).values(name=name, value=1)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.name], set_={'value': table.c.value + 1},
+        ))
+    elif not connection.execute(update(table).where(table.c.name == name).values(value=table.c.value + 1)).rowcount:
+        connection.execute(table.insert().values(name=name, value=1))
+
+
+def read_counter(connection, name):
+    table = ChangeCounter.__table__
+    return connection.execute(select(table.c.value).where(table.c.name == name)).scalar() or 0
+
+
+def mark_search_changed(session):
+    """Start a new /search cache generation when the session commits.
+
+    The ORM flush does this automatically for searchable rows; bulk
+    UPDATE/DELETE statements bypass the flush and call it themselves.
+    """
+    bump_counter(session.connection(), 'search')
+
+
+def mark_emails_removed(session):
+    """Start a new /view cache generation when the session commits.
+
+    Databases created before emails used AUTOINCREMENT can hand a deleted
+    email's id to a new one, so pages cached by id must not outlive it.
+    """
+    bump_counter(session.connection(), 'view')
+
+
+class AttachmentText(Base):
+    """Text extracted from attachment content, shared by every identical attachment."""
+
+    __tablename__ = 'attachment_texts'
+
+    content_hash = Column(String(64), primary_key=True)
+    extractor = Column(String(32))
+    text = Column(Text)
+    created_at = Column(DateTime(timezone=True), default=utcnow)
+
+
+class AttachmentPreview(Base):
+    """Thumbnail or text preview of attachment content, shared by every identical attachment."""
+
+    __tablename__ = 'attachment_previews'
+
+    content_hash = Column(String(64), primary_key=True)
+    kind = Column(String(16))
+    content_type = Column(String(64))
+    data = Column(LargeBinary)
+    width = Column(Integer)
+    height = Column(Integer)
+    created_at = Column(DateTime(timezone=True), default=utcnow)
+
+
+class SubscriptionState(Base):
+    """Last EWS notification watermark processed per account, for resuming subscriptions."""
+
+    __tablename__ = 'subscription_states'
+
+    account_id = Column(String(255), primary_key=True)
+    watermark = Column(Text)
+    updated_at = Column(DateTime(timezone=True), default=utcnow)
+
+
+class ImportedSource(Base):
+    """A bulk-import task (an .eml batch or mbox byte range) that has been stored."""
+
+    __tablename__ = 'imported_sources'
+
+    key = Column(String(64), primary_key=True)
+    source = Column(Text)
+    email_count = Column(Integer)
+    completed_at = Column(DateTime(timezone=True), default=utcnow)
+
+
+class ExportRun(Base):
+    """A completed archive export, with the watermark used by incremental exports."""
+
+    __tablename__ = 'export_runs'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), index=True)
+    filters = Column(Text)
+    # Newest created_at exported, for display; incremental exports resume
+    # after last_email_id, since ids (unlike created_at) follow commit order.
+    watermark = Column(DateTime(timezone=True))
+    last_email_id = Column(Integer)
+    email_count = Column(Integer)
+    # JSON list of [email id, archive entry name] pairs.
+    manifest = Column(Text)
+    started_at = Column(DateTime(timezone=True), default=utcnow)
+    completed_at = Column(DateTime(timezone=True))
+
+
+# Rows whose changes can alter a /search answer.
+SEARCHABLE_MODELS = (Email, Attachment, AttachmentText)
+
+
+@event.listens_for(Session, 'after_flush')
+def bump_change_counters(session, flush_context):
+    changed = (*session.new, *session.dirty, *session.deleted)
+    if any(isinstance(instance, SEARCHABLE_MODELS) for instance in changed):
+        # Counted once per flush, inside the flush's transaction (or
+        # savepoint), so a rolled-back change never bumps the generation.
+        mark_search_changed(session)
+    if any(isinstance(instance, Email) for instance in session.deleted):
+        mark_emails_removed(session)
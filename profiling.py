@@ -0,0 +1,317 @@
+# profiling.py
+"""
+On-demand request profiling and slow-request capture.
+
+A capture records where one request spent its time and which SQL it ran:
+
+- cprofile: a deterministic cProfile of the request thread, saved as .prof
+  (open with `python -m pstats`, snakeviz or similar);
+- sample: a stack sampler reading the request thread every
+  PROFILE_SAMPLE_INTERVAL seconds, saved in the collapsed-stack format used by
+  flamegraph.pl and speedscope.
+
+Next to every profile a .json file lists the request, its duration and the SQL
+statements it executed, ranked by total time. SQL is timed with the engine's
+before/after_cursor_execute events.
+
+Captures are taken when an admin asks for one (X-Profile header on a request,
+or POST /admin/profiling to arm the next requests to an endpoint), and for
+every request slower than PROFILE_SLOW_MS when that is set; those are sampled
+rather than cProfiled to keep the overhead low. Streaming responses are timed
+until their body has been sent. Admin access needs the ADMIN_TOKEN value in
+the X-Admin-Token header; without ADMIN_TOKEN the admin endpoints are off.
+"""
+import cProfile
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import wraps
+from pathlib import Path
+
+from flask import jsonify, request
+from sqlalchemy import event
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', '0'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '200'))
+PROFILE_SQL_TOP = int(os.getenv('PROFILE_SQL_TOP', '50'))
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+PROFILE_MODES = ('cprofile', 'sample')
+SAFE_NAME_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_.')
+
+_local = threading.local()
+
+
+def admin_required(f):
+    """Reject requests without the admin token (404 when no token is configured)."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not request_profiler.is_admin():
+            if not request_profiler.admin_token:
+                return jsonify({'success': False, 'message': 'Not found'}), 404
+            return jsonify({'success': False, 'message': 'Admin token required'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+class Capture:
+    """Profile and SQL timings for one request."""
+
+    def __init__(self, name, mode, reason):
+        self.name = name
+        self.mode = mode
+        self.reason = reason
+        self.method = request.method
+        self.path = request.full_path.rstrip('?')
+        self.endpoint = request.endpoint
+        self.thread_id = threading.get_ident()
+        self.sql = {}
+        self.samples = Counter()
+        self.profiler = None
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def record_sql(self, statement, seconds):
+        totals = self.sql.get(statement)
+        if totals is None:
+            totals = self.sql[statement] = [0, 0.0]
+        totals[0] += 1
+        totals[1] += seconds
+
+    def ranked_sql(self, limit=PROFILE_SQL_TOP):
+        ranked = sorted(self.sql.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [
+            {'statement': statement, 'count': count, 'total_ms': round(seconds * 1000, 3)}
+            for statement, (count, seconds) in ranked
+        ]
+
+
+class StackSampler:
+    """Background thread sampling the stacks of the threads being captured."""
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._captures = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, capture):
+        with self._lock:
+            self._captures.add(capture)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def remove(self, capture):
+        with self._lock:
+            self._captures.discard(capture)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                captures = list(self._captures)
+                if not captures:
+                    self._wakeup.clear()
+            if not captures:
+                self._wakeup.wait()
+                continue
+            frames = sys._current_frames()
+            for capture in captures:
+                frame = frames.get(capture.thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                if stack:
+                    capture.samples[';'.join(reversed(stack))] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+class RequestProfiler:
+    """Decides which requests to capture and writes the captures to profile_dir."""
+
+    def __init__(self, profile_dir=PROFILE_DIR, slow_ms=PROFILE_SLOW_MS, keep=PROFILE_KEEP,
+                 admin_token=ADMIN_TOKEN, sampler=None):
+        self.profile_dir = profile_dir
+        self.slow_ms = slow_ms
+        self.keep = keep
+        self.admin_token = admin_token
+        self.sampler = sampler or StackSampler()
+        self.armed = {}
+        self._lock = threading.Lock()
+        # Only one cProfile may run per process on newer Pythons.
+        self._cprofile_lock = threading.Lock()
+
+    def install(self, app, engines):
+        app.before_request(self.begin)
+        app.after_request(self.end)
+        for target_engine in {id(e): e for e in engines}.values():
+            event.listen(target_engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(target_engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def is_admin(self):
+        supplied = request.headers.get('X-Admin-Token', '')
+        return bool(self.admin_token) and hmac.compare_digest(supplied.encode(), self.admin_token.encode())
+
+    def arm(self, endpoint, count=1, mode='cprofile'):
+        """Capture the next count requests to endpoint."""
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        with self._lock:
+            if count > 0:
+                self.armed[endpoint] = [count, mode]
+            else:
+                self.armed.pop(endpoint, None)
+        return self.armed_endpoints()
+
+    def armed_endpoints(self):
+        with self._lock:
+            return {name: {'remaining': remaining, 'mode': mode} for name, (remaining, mode) in self.armed.items()}
+
+    def _take_armed(self, endpoint):
+        with self._lock:
+            armed = self.armed.get(endpoint)
+            if armed is None:
+                return None
+            armed[0] -= 1
+            if armed[0] <= 0:
+                del self.armed[endpoint]
+            return armed[1]
+
+    def begin(self):
+        _local.capture = None
+        requested = request.headers.get('X-Profile')
+        if requested and self.is_admin():
+            mode, reason = (requested if requested in PROFILE_MODES else 'cprofile'), 'requested'
+        else:
+            mode, reason = self._take_armed(request.endpoint), 'armed'
+        if mode is None:
+            if not self.slow_ms:
+                return
+            mode, reason = 'sample', 'slow'
+
+        capture = Capture(f"{time.strftime('%Y%m%dT%H%M%S')}-{request.endpoint or 'unknown'}-{uuid.uuid4().hex[:8]}",
+                          mode, reason)
+        if mode == 'cprofile' and self._cprofile_lock.acquire(blocking=False):
+            capture.profiler = cProfile.Profile()
+            capture.profiler.enable()
+        else:
+            capture.mode = 'sample'
+            self.sampler.add(capture)
+        _local.capture = capture
+
+    def end(self, response):
+        capture = getattr(_local, 'capture', None)
+        if capture is None:
+            return response
+        if capture.reason != 'slow':
+            response.headers['X-Profile-Id'] = capture.name
+        # Runs once the body has been sent, so streamed downloads are timed in full.
+        response.call_on_close(lambda: self.finish(capture))
+        return response
+
+    def finish(self, capture):
+        if getattr(_local, 'capture', None) is capture:
+            _local.capture = None
+        capture.duration = time.perf_counter() - capture.started
+        if capture.profiler is not None:
+            capture.profiler.disable()
+            self._cprofile_lock.release()
+        else:
+            self.sampler.remove(capture)
+        if capture.reason == 'slow' and capture.duration * 1000 < self.slow_ms:
+            return
+        try:
+            self.save(capture)
+        except Exception as e:
+            logging.error(f"Could not save profile {capture.name}: {str(e)}")
+
+    def save(self, capture):
+        directory = Path(self.profile_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+        if capture.profiler is not None:
+            profile_file = f'{capture.name}.prof'
+            capture.profiler.dump_stats(directory / profile_file)
+        else:
+            profile_file = f'{capture.name}.collapsed'
+            with open(directory / profile_file, 'w', encoding='utf-8') as handle:
+                for stack, count in capture.samples.most_common():
+                    handle.write(f'{stack} {count}\n')
+        summary = {
+            'name': capture.name,
+            'profile': profile_file,
+            'mode': capture.mode,
+            'reason': capture.reason,
+            'method': capture.method,
+            'path': capture.path,
+            'endpoint': capture.endpoint,
+            'duration_ms': round(capture.duration * 1000, 3),
+            'sql_count': sum(count for count, _ in capture.sql.values()),
+            'sql_ms': round(sum(seconds for _, seconds in capture.sql.values()) * 1000, 3),
+            'sql': capture.ranked_sql(),
+        }
+        with open(directory / f'{capture.name}.json', 'w', encoding='utf-8') as handle:
+            json.dump(summary, handle, indent=2)
+        logging.info(f"Saved {capture.mode} profile of {capture.path} ({summary['duration_ms']:.0f} ms) "
+                     f"to {directory / profile_file}")
+        self.prune(directory)
+
+    def prune(self, directory):
+        summaries = sorted(directory.glob('*.json'))
+        for summary in summaries[:max(0, len(summaries) - self.keep)]:
+            for path in directory.glob(f'{summary.stem}.*'):
+                path.unlink(missing_ok=True)
+
+    def list_profiles(self):
+        """Summaries of the saved captures, newest first, without the SQL lists."""
+        directory = Path(self.profile_dir)
+        if not directory.is_dir():
+            return []
+        profiles = []
+        for path in sorted(directory.glob('*.json'), reverse=True):
+            try:
+                with open(path, encoding='utf-8') as handle:
+                    summary = json.load(handle)
+            except (OSError, ValueError):
+                continue
+            summary.pop('sql', None)
+            profiles.append(summary)
+        return profiles
+
+    def profile_path(self, filename):
+        """Path of a saved capture file, or None for names outside profile_dir."""
+        if not filename or not set(filename) <= SAFE_NAME_CHARS or filename.startswith('.'):
+            return None
+        path = Path(self.profile_dir) / filename
+        return path if path.is_file() else None
+
+    @staticmethod
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if getattr(_local, 'capture', None) is not None:
+            conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+    @staticmethod
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        capture = getattr(_local, 'capture', None)
+        starts = conn.info.get('profile_query_start')
+        if capture is not None and starts:
+            capture.record_sql(statement, time.perf_counter() - starts.pop())
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,318 @@
+# retention.py
+"""
+Retention policies: archival tiering for old emails and attachment purging.
+
+Emails received more than RETENTION_HOT_DAYS ago are moved out of the main
+database into per-month SQLite files (ARCHIVE_DIR/emails-YYYY-MM.db). Bodies
+and attachment content are zlib-compressed there; /search only reads the
+archive when asked to (include_archive=1), decompressing bodies on the fly.
+
+Attachment content older than ATTACHMENT_PURGE_DAYS, or larger than
+ATTACHMENT_PURGE_BYTES, is deleted in batches. The attachment rows stay so
+emails still list their filenames and sizes; downloads answer 410 Gone.
+
+Every policy is off (0) by default. Run directly to apply them:
+
+    python retention.py
+"""
+import logging
+import os
+import re
+import sqlite3
+import zlib
+from collections import defaultdict
+from contextlib import closing
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytz
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.orm import selectinload
+
+from models import (
+    Attachment,
+    AttachmentPreview,
+    AttachmentText,
+    Email,
+    mark_emails_removed,
+    mark_search_changed,
+)
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+RETENTION_HOT_DAYS = int(os.getenv('RETENTION_HOT_DAYS', '0'))
+ATTACHMENT_PURGE_DAYS = int(os.getenv('ATTACHMENT_PURGE_DAYS', '0'))
+ATTACHMENT_PURGE_BYTES = int(os.getenv('ATTACHMENT_PURGE_BYTES', '0'))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '200'))
+
+ARCHIVE_NAME_RE = re.compile(r'^emails-(\d{4}-\d{2})\.db$')
+# Archive rows get their own ids: original_id keeps the email's id in the
+# main database, which older databases may have reused since.
+ARCHIVE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS emails ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, original_id INTEGER, message_id TEXT, account_id TEXT, subject TEXT, sender TEXT, "
+    "recipients TEXT, datetime_received TEXT, folder TEXT, attachment_count INTEGER, "
+    "attachment_total_bytes INTEGER, created_at TEXT, body_z BLOB)",
+    "CREATE TABLE IF NOT EXISTS attachments ("
+    "id INTEGER PRIMARY KEY, email_id INTEGER, filename TEXT, content_type TEXT, size INTEGER, "
+    "content_id TEXT, is_inline INTEGER, content_hash TEXT, created_at TEXT, data_z BLOB)",
+    "CREATE INDEX IF NOT EXISTS ix_archive_emails_received ON emails (datetime_received)",
+    "CREATE INDEX IF NOT EXISTS ix_archive_attachments_email ON attachments (email_id)",
+)
+ARCHIVE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_archive_emails_original ON emails (original_id)",
+)
+ARCHIVE_EMAIL_COLUMNS = (
+    'original_id, message_id, account_id, subject, sender, recipients, datetime_received, folder, '
+    'attachment_count, attachment_total_bytes, created_at, body_z'
+)
+ARCHIVE_ATTACHMENT_COLUMNS = (
+    'email_id, filename, content_type, size, content_id, is_inline, content_hash, created_at, data_z'
+)
+ARCHIVE_RESULT_COLUMNS = (
+    'id, account_id, subject, sender, datetime_received, attachment_count, attachment_total_bytes'
+)
+
+
+def compress(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return zlib.compress(value)
+
+
+def inflate_text(value):
+    return zlib.decompress(value).decode('utf-8') if value is not None else None
+
+
+def iso(value):
+    return value.isoformat() if value is not None else None
+
+
+def archive_path(archive_dir, month):
+    return Path(archive_dir) / f'emails-{month}.db'
+
+
+def list_archives(archive_dir=ARCHIVE_DIR):
+    """Months with an archive file, newest first."""
+    directory = Path(archive_dir)
+    if not directory.is_dir():
+        return []
+    months = [match.group(1) for match in map(ARCHIVE_NAME_RE.match, os.listdir(directory)) if match]
+    return sorted(months, reverse=True)
+
+
+def open_archive(path):
+    connection = sqlite3.connect(path, timeout=30)
+    for statement in ARCHIVE_SCHEMA:
+        connection.execute(statement)
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(emails)")}
+    if 'original_id' not in columns:
+        # Files written before archive rows had their own ids.
+        with connection:
+            connection.execute("ALTER TABLE emails ADD COLUMN original_id INTEGER")
+            connection.execute("UPDATE emails SET original_id = id")
+    for statement in ARCHIVE_INDEXES:
+        connection.execute(statement)
+    connection.create_function('inflate', 1, inflate_text, deterministic=True)
+    return connection
+
+
+def write_archive_batch(path, emails):
+    """Copy emails and their attachments into one archive file.
+
+    An email already archived under the same original id and message id
+    (an interrupted batch being rerun) is replaced, so reruns are harmless.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with closing(open_archive(path)) as connection, connection:
+        for email in emails:
+            stale = [row[0] for row in connection.execute(
+                "SELECT id FROM emails WHERE original_id = ? AND message_id IS ?", (email.id, email.message_id),
+            )]
+            for archive_id in stale:
+                connection.execute("DELETE FROM attachments WHERE email_id = ?", (archive_id,))
+                connection.execute("DELETE FROM emails WHERE id = ?", (archive_id,))
+            archive_id = connection.execute(
+                f"INSERT INTO emails ({ARCHIVE_EMAIL_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (email.id, email.message_id, email.account_id, email.subject, email.sender, email.recipients,
+                 iso(email.datetime_received), email.folder, email.attachment_count,
+                 email.attachment_total_bytes, iso(email.created_at), compress(email.body)),
+            ).lastrowid
+            connection.executemany(
+                f"INSERT INTO attachments ({ARCHIVE_ATTACHMENT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (archive_id, attachment.filename, attachment.content_type, attachment.size,
+                     attachment.content_id, int(bool(attachment.is_inline)), attachment.content_hash,
+                     iso(attachment.created_at), compress(attachment.data))
+                    for attachment in email.attachments
+                ],
+            )
+
+
+def delete_orphan_texts(session):
+    """Drop extracted text and previews no stored attachment refers to any more."""
+    stored_hashes = select(Attachment.content_hash).where(Attachment.content_hash.isnot(None))
+    result = session.execute(delete(AttachmentText).where(AttachmentText.content_hash.not_in(stored_hashes)))
+    session.execute(delete(AttachmentPreview).where(AttachmentPreview.content_hash.not_in(stored_hashes)))
+    return result.rowcount
+
+
+def archive_emails(session, cutoff, archive_dir=ARCHIVE_DIR, batch_size=RETENTION_BATCH_SIZE):
+    """Move emails received before cutoff into the monthly archive files.
+
+    Each batch is written to the archive before it is deleted from the
+    database. Returns the number of emails archived.
+    """
+    received = func.coalesce(Email.datetime_received, Email.created_at)
+    statement = (
+        select(Email)
+        .options(selectinload(Email.attachments))
+        .where(received < cutoff)
+        .order_by(Email.id)
+        .limit(batch_size)
+    )
+    archived = 0
+    while True:
+        emails = session.scalars(statement).all()
+        if not emails:
+            break
+
+        by_month = defaultdict(list)
+        for email in emails:
+            when = email.datetime_received or email.created_at
+            by_month[when.strftime('%Y-%m')].append(email)
+        for month, batch in by_month.items():
+            write_archive_batch(archive_path(archive_dir, month), batch)
+
+        ids = [email.id for email in emails]
+        session.expunge_all()
+        session.execute(delete(Attachment).where(Attachment.email_id.in_(ids)))
+        session.execute(delete(Email).where(Email.id.in_(ids)))
+        mark_search_changed(session)
+        mark_emails_removed(session)
+        session.commit()
+        archived += len(ids)
+
+    if archived:
+        delete_orphan_texts(session)
+        session.commit()
+        logging.info(f"Archived {archived} emails to {archive_dir}")
+    return archived
+
+
+def purge_attachments(session, older_than=None, min_bytes=None, batch_size=RETENTION_BATCH_SIZE):
+    """Delete attachment content created before older_than or at least min_bytes long.
+
+    Rows are kept with data set to NULL. Returns the number purged.
+    """
+    conditions = []
+    if older_than is not None:
+        conditions.append(Attachment.created_at < older_than)
+    if min_bytes:
+        conditions.append(Attachment.size >= min_bytes)
+    if not conditions:
+        return 0
+
+    statement = select(Attachment.id).where(Attachment.data.isnot(None), or_(*conditions)).limit(batch_size)
+    purged = 0
+    while True:
+        ids = session.scalars(statement).all()
+        if not ids:
+            break
+        session.execute(update(Attachment).where(Attachment.id.in_(ids)).values(data=None))
+        mark_search_changed(session)
+        session.commit()
+        purged += len(ids)
+
+    if purged:
+        logging.info(f"Purged content of {purged} attachments")
+    return purged
+
+
+def run_retention(session, now=None, hot_days=RETENTION_HOT_DAYS, purge_days=ATTACHMENT_PURGE_DAYS,
+                  purge_bytes=ATTACHMENT_PURGE_BYTES, archive_dir=ARCHIVE_DIR):
+    """Apply every configured policy; a value of 0 disables that policy."""
+    now = now or datetime.now(pytz.UTC)
+    results = {'archived': 0, 'purged': 0}
+    if hot_days:
+        results['archived'] = archive_emails(session, now - timedelta(days=hot_days), archive_dir)
+    if purge_days or purge_bytes:
+        results['purged'] = purge_attachments(
+            session,
+            older_than=now - timedelta(days=purge_days) if purge_days else None,
+            min_bytes=purge_bytes or None,
+        )
+    return results
+
+
+def parse_archived(row):
+    email_id, account_id, subject, sender, received, attachment_count, attachment_total_bytes = row[:7]
+    return {
+        'id': email_id,
+        'account_id': account_id,
+        'subject': subject,
+        'sender': sender,
+        'datetime_received': datetime.fromisoformat(received) if received else None,
+        'attachment_count': attachment_count or 0,
+        'attachment_total_bytes': attachment_total_bytes or 0,
+    }
+
+
+def search_archives(query, archive_dir=ARCHIVE_DIR, account=None, limit=None):
+    """Search the archive files, newest month first.
+
+    Returns (month, email dict, plain body) tuples.
+    """
+    pattern = f'%{query}%'
+    sql = (
+        f"SELECT {ARCHIVE_RESULT_COLUMNS}, inflate(body_z) FROM emails "
+        "WHERE (subject LIKE ? OR sender LIKE ? OR recipients LIKE ? OR inflate(body_z) LIKE ?)"
+    )
+    params = [pattern] * 4
+    if account is not None:
+        sql += " AND account_id = ?"
+        params.append(account)
+    sql += " ORDER BY datetime_received DESC"
+
+    results = []
+    for month in list_archives(archive_dir):
+        with closing(open_archive(archive_path(archive_dir, month))) as connection:
+            for row in connection.execute(sql, params):
+                results.append((month, parse_archived(row), row[7] or ''))
+                if limit is not None and len(results) >= limit:
+                    return results
+    return results
+
+
+def get_archived_email(month, email_id, archive_dir=ARCHIVE_DIR):
+    """Return (email dict with body and recipients, attachments) or None."""
+    path = archive_path(archive_dir, month)
+    if not re.fullmatch(r'\d{4}-\d{2}', month) or not path.exists():
+        return None
+    with closing(open_archive(path)) as connection:
+        row = connection.execute(
+            f"SELECT {ARCHIVE_RESULT_COLUMNS}, recipients, inflate(body_z) FROM emails WHERE id = ?",
+            (email_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        attachments = connection.execute(
+            "SELECT filename, size FROM attachments WHERE email_id = ? ORDER BY id", (email_id,)
+        ).fetchall()
+    email = parse_archived(row)
+    email.update(recipients=row[7], body=row[8])
+    return email, [{'filename': filename, 'size': size or 0} for filename, size in attachments]
+
+
+def main():
+    from app import session_scope
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    with session_scope(write=True) as session:
+        results = run_retention(session)
+    logging.info(f"Retention finished: {results}")
+
+
+if __name__ == '__main__':
+    main()
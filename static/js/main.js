@@ -7,17 +7,19 @@ $(document).ready(function () {
         $('#results').removeClass('d-none');
         $('.recent-emails').addClass('d-none');
         let query = $('#search-query').val().trim();
+        let includeArchive = $('#include-archive').is(':checked');
 
         if (query === '') {
             alert('Please enter a search query.');
             return;
         }
 
-        if (query === lastQuery) {
+        let searchKey = query + (includeArchive ? ' [archive]' : '');
+        if (searchKey === lastQuery) {
             return; // Prevent duplicate searches
         }
 
-        lastQuery = query;
+        lastQuery = searchKey;
 
         $('#results').html('<p class="text-center"><i>Searching...</i></p>');
         $('#email-content').html('<p>Select an email from the search results to view its content.</p>');
@@ -25,7 +27,7 @@ $(document).ready(function () {
         $.ajax({
             url: '/search',
             method: 'GET',
-            data: { query: query },
+            data: { query: query, include_archive: includeArchive ? 1 : 0 },
             success: function (response) {
                 console.log('Search response:', response); // Debug log
                 $('#results').empty(); // Clear previous results or "Searching..." message
@@ -36,18 +38,29 @@ $(document).ready(function () {
                     return;
                 }
 
-                if (!response.results || response.results.length === 0) {
+                let results = (response.results || []).concat(response.archived_results || []);
+                if (results.length === 0) {
                     $('#results').html('<p class="text-center">No results found.</p>');
                     return;
                 }
 
                 // Update search results display using the new fields
-                response.results.forEach(function (item) {
+                results.forEach(function (item) {
+                    let attachmentHtml = '';
+                    if (item.attachment_count) {
+                        attachmentHtml = `
+                            <small class="text-muted ms-2" title="${item.attachment_count} attachment(s)">
+                                <i class="bi bi-paperclip"></i>${item.attachment_count} (${formatBytes(item.attachment_total_bytes)})
+                            </small>
+                        `;
+                    }
+                    let archiveBadge = item.archive ? `<span class="badge bg-secondary ms-1">Archived ${item.archive}</span>` : '';
                     let resultHtml = `
-                        <div class="list-group-item result-item" data-email-id="${item.id}">
-                            <h5 class="mb-1">${item.subject}</h5>
+                        <div class="list-group-item result-item" data-email-id="${item.id}" data-view-url="${item.view_url || ''}">
+                            <h5 class="mb-1">${item.subject}${archiveBadge}</h5>
                             <p class="mb-1"><strong>From:</strong> ${item.sender}</p>
                             <small class="text-muted">${item.datetime_received}</small>
+                            ${attachmentHtml}
                         </div>
                     `;
                     $('#results').append(resultHtml);
@@ -71,22 +84,55 @@ $(document).ready(function () {
         });
     });
 
+    // Typeahead: ask /suggest for senders, recipients and subject words as the user types.
+    let suggestTimer = null;
+    let suggestRequest = null;
+    $('#search-query').on('input', function () {
+        let prefix = $(this).val().trim();
+        clearTimeout(suggestTimer);
+        if (prefix.length < 2) {
+            $('#search-suggestions').empty();
+            return;
+        }
+        suggestTimer = setTimeout(function () {
+            if (suggestRequest) {
+                suggestRequest.abort();
+            }
+            suggestRequest = $.ajax({
+                url: '/suggest',
+                method: 'GET',
+                data: { q: prefix },
+                success: function (response) {
+                    let $list = $('#search-suggestions').empty();
+                    (response.suggestions || []).forEach(function (suggestion) {
+                        $('<option>').val(suggestion.value).attr('label', suggestion.kind).appendTo($list);
+                    });
+                }
+            });
+        }, 150);
+    });
+
     // Delegate event handler for result items (works for dynamically added elements)
     $(document).on('click', '.result-item', function () {
         let $clickedItem = $(this);
         let emailId = $(this).data('emailId');
+        let viewUrl = $(this).data('viewUrl');
         $('#email-content').html('<p class="text-center"><i>Loading...</i></p>');
         $('#attachment-list').html('<p class="text-center"><i>Loading attachments...</i></p>');
         // Load email content
         $.ajax({
-            url: '/view/' + emailId,
+            url: viewUrl || '/view/' + emailId,
             method: 'GET',
             success: function (data) {
                 $('#email-content').html(data);
                 $('.result-item').removeClass('active'); // Ensure active class is managed correctly
                 $clickedItem.addClass('active');
                 // Load attachments after email content is loaded
-                displayAttachments(emailId);
+                if (viewUrl) {
+                    $('#attachment-list').html('<p class="text-muted">Attachments of archived emails are kept in the archive.</p>');
+                } else {
+                    displayAttachments(emailId);
+                }
             },
             error: function (xhr, status, error) {
                 console.error('Error loading email:', error);
@@ -107,12 +153,21 @@ $(document).ready(function () {
             success: function (response) {
                 if (response.attachments && response.attachments.length > 0) {
                     let attachmentsHtml = response.attachments.map(function (attachment) {
+                        let previewHtml = '';
+                        if (attachment.preview_kind === 'image') {
+                            previewHtml = `<img src="${attachment.preview}" class="attachment-thumbnail ms-2" alt="" loading="lazy">`;
+                        } else if (attachment.preview_kind === 'text') {
+                            previewHtml = `<a href="${attachment.preview}" class="ms-2 small" target="_blank" rel="noopener">Preview</a>`;
+                        }
                         return `
-                            <a href="${attachment.path}" class="attachment-item" download>
-                                <i class="bi bi-file-earmark"></i>
-                                <span class="ms-2">${attachment.filename}</span>
-                                <small class="text-muted ms-2">(${formatBytes(attachment.size)})</small>
-                            </a>
+                            <div class="attachment-row">
+                                <a href="${attachment.path}" class="attachment-item" download>
+                                    <i class="bi bi-file-earmark"></i>
+                                    <span class="ms-2">${attachment.filename}</span>
+                                    <small class="text-muted ms-2">(${formatBytes(attachment.size)})</small>
+                                </a>
+                                ${previewHtml}
+                            </div>
                         `;
                     }).join('');
                     $('#attachment-list').html(attachmentsHtml);
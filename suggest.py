@@ -0,0 +1,187 @@
+# suggest.py
+"""
+In-memory prefix index backing the /suggest typeahead endpoint.
+
+Entries are (key, display) pairs kept in parallel sorted arrays, so a lookup
+is one bisect plus a short forward scan. Keys are lowercased tokens: whole
+addresses and their name/domain parts for senders and recipients, and words
+from subjects. Displays are the values offered to the user (the full address,
+or the subject word). All strings are interned, so an address that appears in
+thousands of emails, or a token shared by many addresses, is stored once.
+
+New entries are buffered and merged into the arrays in batches by add(),
+which keeps ingest cheap; lookups search the small buffer alongside the
+arrays and never merge. When the index grows past max_terms, the least used
+subject words and then addresses are dropped.
+"""
+import bisect
+import re
+import sys
+import threading
+from array import array
+
+KIND_SUBJECT = 0
+KIND_RECIPIENT = 1
+KIND_SENDER = 2
+KIND_NAMES = {KIND_SUBJECT: 'subject', KIND_RECIPIENT: 'recipient', KIND_SENDER: 'sender'}
+
+ADDRESS_SPLIT_RE = re.compile(r'[@._+\-\s<>"]+')
+WORD_RE = re.compile(r'[^\W_][\w\-]{2,}', re.UNICODE)
+MAX_KEY_LENGTH = 64
+
+
+def address_keys(address):
+    """Keys under which an address is found: the address and its parts."""
+    address = address.strip().lower()
+    if not address:
+        return []
+    keys = {address[:MAX_KEY_LENGTH]}
+    keys.update(part for part in ADDRESS_SPLIT_RE.split(address) if len(part) >= 2)
+    return keys
+
+
+def subject_words(subject):
+    return {word.lower()[:MAX_KEY_LENGTH] for word in WORD_RE.findall(subject or '')}
+
+
+class PrefixIndex:
+    """Sorted-array prefix index with interned strings and bounded size."""
+
+    def __init__(self, max_terms=1_000_000, merge_threshold=5000, scan_limit=500):
+        self.max_terms = max_terms
+        self.merge_threshold = merge_threshold
+        self.scan_limit = scan_limit
+        self._keys = []
+        self._displays = []
+        # Weight packs the use count and kind: count * 4 + kind.
+        self._weights = array('Q')
+        self._pending = {}
+        # The pending entries in sorted order, so lookups can bisect them too.
+        self._pending_order = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys) + sum(1 for entry in self._pending if self._find(entry) is None)
+
+    def _find(self, entry):
+        """Index of a (key, display) entry in the sorted arrays, or None."""
+        keys, displays = self._keys, self._displays
+        index = bisect.bisect_left(range(len(keys)), entry, key=lambda position: (keys[position], displays[position]))
+        if index < len(keys) and (keys[index], displays[index]) == entry:
+            return index
+        return None
+
+    def add(self, kind, display, keys, count=1):
+        """Record that display (of the given kind) is reachable under keys."""
+        if not display:
+            return
+        display = sys.intern(display)
+        with self._lock:
+            for key in keys:
+                if not key:
+                    continue
+                entry = (sys.intern(key), display)
+                current = self._pending.get(entry)
+                if current is None:
+                    self._pending[entry] = [kind, count]
+                    bisect.insort(self._pending_order, entry)
+                else:
+                    current[0] = max(current[0], kind)
+                    current[1] += count
+            if (len(self._pending) >= self.merge_threshold
+                    or len(self._keys) + len(self._pending) > self.max_terms):
+                self._merge()
+
+    def add_email(self, sender, recipients, subject):
+        if sender:
+            self.add(KIND_SENDER, sender.strip(), address_keys(sender))
+        for recipient in (recipients or '').split(','):
+            recipient = recipient.strip()
+            if recipient:
+                self.add(KIND_RECIPIENT, recipient, address_keys(recipient))
+        for word in subject_words(subject):
+            self.add(KIND_SUBJECT, word, (word,))
+
+    def _merge(self):
+        """Merge buffered entries into the sorted arrays (caller holds the lock)."""
+        if not self._pending:
+            return
+        pending = [(entry, self._pending[entry]) for entry in self._pending_order]
+        self._pending = {}
+        self._pending_order = []
+
+        keys, displays, weights = [], [], array('Q')
+        old_keys, old_displays, old_weights = self._keys, self._displays, self._weights
+        i = j = 0
+        while i < len(old_keys) or j < len(pending):
+            if j < len(pending):
+                (new_key, new_display), (new_kind, new_count) = pending[j]
+            if i < len(old_keys) and (j >= len(pending) or (old_keys[i], old_displays[i]) < (new_key, new_display)):
+                keys.append(old_keys[i])
+                displays.append(old_displays[i])
+                weights.append(old_weights[i])
+                i += 1
+                continue
+            weight = new_count * 4 + new_kind
+            if i < len(old_keys) and (old_keys[i], old_displays[i]) == (new_key, new_display):
+                old_count, old_kind = divmod(old_weights[i], 4)
+                weight = (old_count + new_count) * 4 + max(old_kind, new_kind)
+                i += 1
+            keys.append(new_key)
+            displays.append(new_display)
+            weights.append(weight)
+            j += 1
+
+        self._keys, self._displays, self._weights = keys, displays, weights
+        if len(self._keys) > self.max_terms:
+            self._prune()
+
+    def _prune(self):
+        """Drop the lowest ranked entries until the index fits in max_terms."""
+        # Prune to 90% so steady growth does not re-sort on every merge.
+        keep = self.max_terms * 9 // 10
+        ranked = sorted(range(len(self._keys)), key=lambda index: self._rank(self._weights[index]))
+        survivors = sorted(ranked[:keep])
+        self._keys = [self._keys[index] for index in survivors]
+        self._displays = [self._displays[index] for index in survivors]
+        self._weights = array('Q', (self._weights[index] for index in survivors))
+
+    @staticmethod
+    def _rank(weight):
+        count, kind = divmod(weight, 4)
+        return (-kind, -count)
+
+    def suggest(self, prefix, limit=10):
+        """Return up to limit (display, kind name) pairs whose keys start with prefix."""
+        prefix = (prefix or '').strip().lower()
+        if not prefix:
+            return []
+        with self._lock:
+            keys, displays, weights = self._keys, self._displays, self._weights
+            start = bisect.bisect_left(keys, prefix)
+            matches = {}
+            for index in range(start, min(len(keys), start + self.scan_limit)):
+                if not keys[index].startswith(prefix):
+                    break
+                matches[keys[index], displays[index]] = weights[index]
+            pending_order = self._pending_order
+            start = bisect.bisect_left(pending_order, (prefix,))
+            for entry in pending_order[start:start + self.scan_limit]:
+                if not entry[0].startswith(prefix):
+                    break
+                kind, count = self._pending[entry]
+                old_count, old_kind = divmod(matches.get(entry, 0), 4)
+                matches[entry] = (old_count + count) * 4 + max(old_kind, kind)
+
+        best = {}
+        for (_, display), weight in matches.items():
+            if display not in best or self._rank(weight) < self._rank(best[display]):
+                best[display] = weight
+
+        ranked = sorted(best.items(), key=lambda item: (self._rank(item[1]), item[0]))
+        return [(display, KIND_NAMES[weight % 4]) for display, weight in ranked[:limit]]
+
+    def stats(self):
+        with self._lock:
+            return {'terms': len(self._keys), 'pending': len(self._pending), 'max_terms': self.max_terms}
@@ -0,0 +1,15 @@
+# tests/conftest.py
+
+import os
+import shutil
+import tempfile
+
+# The app binds its engines to DATABASE_URL at import, before any fixture
+# runs. Unless DATABASE_URL points elsewhere, each test session gets a
+# throwaway database instead of a test.db in the working tree.
+TEST_DATA_DIR = tempfile.mkdtemp(prefix='outlook-tests-')
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(TEST_DATA_DIR, 'test.db')}")
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(TEST_DATA_DIR, ignore_errors=True)
@@ -0,0 +1,169 @@
+# tests/test_accounts.py
+
+import json
+import sys
+import threading
+from contextlib import contextmanager
+from functools import cached_property
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+import accounts
+from accounts import AccountConfig, AccountScheduler, load_accounts, sync_account
+from models import Base, Email
+
+
+def make_config(account_id, **kwargs):
+    return AccountConfig(account_id, f'{account_id}@example.com', 'DOMAIN\\svc', 'secret', 'mail.example.com',
+                         **kwargs)
+
+
+def test_load_accounts_from_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('OPS_PASSWORD', 'from-env')
+    path = tmp_path / 'accounts.json'
+    path.write_text(json.dumps([
+        {'id': 'sales', 'email': 'sales@example.com', 'username': 'svc', 'password': 'x',
+         'server': 'mail', 'max_messages': 10, 'min_interval': 60},
+        {'id': 'ops', 'email': 'ops@example.com', 'username': 'svc', 'password_env': 'OPS_PASSWORD',
+         'server': 'mail', 'folders': ['inbox']},
+    ]))
+
+    sales, ops = load_accounts(str(path))
+    assert (sales.account_id, sales.max_messages, sales.min_interval) == ('sales', 10, 60)
+    assert (ops.password, ops.folders) == ('from-env', ('inbox',))
+
+    path.write_text(json.dumps([{'id': 'broken', 'email': 'b@example.com'}]))
+    with pytest.raises(ValueError):
+        load_accounts(str(path))
+
+
+def test_scheduler_runs_accounts_concurrently_and_honours_min_interval():
+    barrier = threading.Barrier(3, timeout=5)
+    now = [1000.0]
+
+    def sync_one(config):
+        if config.account_id == 'broken':
+            raise RuntimeError('server busy')
+        barrier.wait()
+        return 1
+
+    configs = [make_config('a'), make_config('b', min_interval=300), make_config('c'), make_config('broken')]
+    scheduler = AccountScheduler(configs, sync_one, max_workers=4, clock=lambda: now[0])
+    assert scheduler.run_once() == {
+        'a': {'created': 1}, 'b': {'created': 1}, 'c': {'created': 1}, 'broken': {'error': 'server busy'},
+    }
+
+    now[0] += 60
+    scheduler.sync_one = lambda config: 0
+    results = scheduler.run_once()
+    assert results['b'] == {'skipped': True}
+    assert results['a'] == {'created': 0}
+
+
+def test_scheduler_runs_a_single_account_on_demand():
+    now = [1000.0]
+    synced = []
+    running = threading.Event()
+    release = threading.Event()
+
+    def sync_one(config):
+        synced.append(config.account_id)
+        if config.account_id == 'slow':
+            running.set()
+            release.wait(5)
+        return 3
+
+    configs = [make_config('a', min_interval=300), make_config('b'), make_config('slow')]
+    scheduler = AccountScheduler(configs, sync_one, clock=lambda: now[0])
+    scheduler.run_once()
+    synced.clear()
+
+    # Inside its min_interval, and the other accounts are left alone.
+    assert scheduler.run_account('a') == {'created': 3}
+    assert synced == ['a']
+    assert scheduler.run_account('missing') == {'error': 'Unknown account missing'}
+
+    worker = threading.Thread(target=scheduler.run_account, args=('slow',))
+    worker.start()
+    running.wait(5)
+    assert scheduler.run_account('slow') == {'skipped': True}
+    release.set()
+    worker.join()
+    assert synced == ['a', 'slow']
+
+
+def test_sync_account_applies_budget_and_partitions_by_account(monkeypatch):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+
+    @contextmanager
+    def session_factory():
+        session = Session()
+        try:
+            yield session
+            session.commit()
+        finally:
+            session.close()
+
+    def fake_messages(folder, time_frame, throttle=None):
+        for number in range(5):
+            yield SimpleNamespace(message_id=f'shared-{number}', subject='Hi', sender='a@example.com',
+                                  recipients='b@example.com', datetime_received=None, body='', attachments=[])
+
+    monkeypatch.setattr(accounts, 'iter_folder_messages', fake_messages)
+    connect = lambda *args: SimpleNamespace(inbox=object())
+
+    sales = make_config('sales', folders=['inbox'], max_messages=3)
+    assert sync_account(sales, session_factory, 'UTC', connect=connect) == 3
+    assert sync_account(sales, session_factory, 'UTC', connect=connect) == 2
+    assert sync_account(make_config('ops', folders=['inbox']), session_factory, 'UTC', connect=connect) == 5
+
+    with session_factory() as session:
+        assert session.query(Email).filter_by(account_id='sales').count() == 5
+        assert session.query(Email).filter_by(message_id='shared-0').count() == 2
+
+
+def test_concurrent_syncs_share_one_writer_connection(tmp_path, monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, 'SQLITE_WRITER_TIMEOUT', 1)
+    _, writer = app.create_database_engines(f"sqlite:///{tmp_path / 'sync.db'}")
+    Base.metadata.create_all(writer)
+    Session = sessionmaker(bind=writer)
+
+    @contextmanager
+    def session_factory():
+        session = Session()
+        try:
+            yield session
+            session.commit()
+        finally:
+            session.close()
+
+    class SlowMessage(SimpleNamespace):
+        @cached_property
+        def attachments(self):
+            # A slow GetAttachment; longer than the writer pool timeout.
+            threading.Event().wait(0.6)
+            return []
+
+    def fake_messages(folder, time_frame, throttle=None):
+        for number in range(2):
+            yield SlowMessage(message_id=f'slow-{number}', subject='Hi', sender='a@example.com',
+                              recipients='b@example.com', datetime_received=None, body='')
+
+    monkeypatch.setattr(accounts, 'iter_folder_messages', fake_messages)
+    connect = lambda *args: SimpleNamespace(inbox=object())
+    sync_one = lambda config: sync_account(config, session_factory, 'UTC', connect=connect)
+    scheduler = AccountScheduler([make_config('east', folders=['inbox']), make_config('west', folders=['inbox'])],
+                                 sync_one, max_workers=2)
+
+    assert scheduler.run_once() == {'east': {'created': 2}, 'west': {'created': 2}}
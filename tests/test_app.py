@@ -1,10 +1,16 @@
 # tests/test_app.py
 
+import hashlib
+import io
 import os
+import subprocess
 import sys
-from datetime import datetime
+import threading
+import time
+import uuid
+import zipfile
 from pathlib import Path
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 
 import pytest
 from sqlalchemy import create_engine, inspect, text
@@ -27,12 +33,40 @@ def test_index(client):
     assert b'Email Search' in response.data
 
 def test_check_emails(client):
-    with patch('app.setup_exchange_connection') as mock_setup, patch('app.process_email') as mock_process:
-        mock_setup.return_value = (MagicMock(), 'output', datetime.utcnow())
-        mock_process.return_value = []
+    with patch('app.get_account_scheduler') as mock_scheduler:
+        mock_scheduler.return_value.run_once.return_value = {'default': {'created': 2}, 'ops': {'error': 'busy'}}
         response = client.post('/check-emails')
     assert response.status_code == 200
-    assert b'success' in response.data
+    assert response.get_json()['success'] is True
+    assert 'Failed: ops' in response.get_json()['message']
+
+def test_listener_gap_resyncs_only_its_account():
+    import listener
+    from accounts import AccountConfig
+    from app import start_mail_listeners
+
+    configs = [AccountConfig(name, f'{name}@example.com', 'D\\svc', 'secret', 'mail.example.com')
+               for name in ('east', 'west')]
+    gaps = {}
+
+    class RecordingListener:
+        def __init__(self, client, session_factory, handle_item, account_id, on_gap):
+            gaps[account_id] = on_gap
+
+        def run(self, stop_event):
+            pass
+
+    with patch('app.load_accounts', return_value=configs), \
+            patch('app.connect_account'), \
+            patch('app.get_account_scheduler') as mock_scheduler, \
+            patch.object(listener, 'EWSPullClient'), \
+            patch.object(listener, 'MailListener', RecordingListener):
+        _, workers = start_mail_listeners()
+        for worker in workers:
+            worker.join(5)
+        gaps['west']('west')
+    mock_scheduler.return_value.run_account.assert_called_once_with('west')
+    mock_scheduler.return_value.run_once.assert_not_called()
 
 def test_search(client):
     response = client.get('/search?query=test')
@@ -96,3 +130,464 @@ def test_ensure_database_schema_adds_created_at_columns(tmp_path):
         ).scalar()
 
     assert created_at_value is not None
+
+
+def test_sqlite_reads_continue_during_ingest(tmp_path):
+    from app import Base, create_database_engines
+
+    read_engine, write_engine = create_database_engines(f"sqlite:///{tmp_path / 'concurrency.db'}")
+    assert read_engine is not write_engine
+
+    with write_engine.begin() as connection:
+        Base.metadata.create_all(bind=connection)
+        connection.execute(text("INSERT INTO emails (message_id, subject) VALUES ('seed', 'seed')"))
+
+    with read_engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar().lower() == 'wal'
+
+    ingest_started = threading.Event()
+    release_ingest = threading.Event()
+
+    def ingest():
+        with write_engine.begin() as connection:
+            for index in range(50):
+                connection.execute(
+                    text("INSERT INTO emails (message_id, subject) VALUES (:mid, 'ingest')"),
+                    {'mid': f'ingest-{index}'},
+                )
+            ingest_started.set()
+            release_ingest.wait(5)
+
+    writer = threading.Thread(target=ingest)
+    writer.start()
+    try:
+        assert ingest_started.wait(5)
+        started = time.monotonic()
+        with read_engine.connect() as connection:
+            count = connection.execute(text("SELECT COUNT(*) FROM emails")).scalar()
+        assert count == 1
+        assert time.monotonic() - started < 1
+    finally:
+        release_ingest.set()
+        writer.join()
+
+    with read_engine.connect() as connection:
+        assert connection.execute(text("SELECT COUNT(*) FROM emails")).scalar() == 51
+
+
+def test_session_scope_releases_thread_sessions_outside_requests():
+    from app import SessionLocal, WriterSessionLocal, session_scope
+
+    with session_scope() as session:
+        session.execute(text('SELECT 1'))
+    with session_scope(write=True) as session:
+        session.execute(text('SELECT 1'))
+    assert not SessionLocal.registry.has() and not WriterSessionLocal.registry.has()
+
+    with app.app_context():
+        with session_scope() as session:
+            session.execute(text('SELECT 1'))
+        # Kept for the rest of the request, then dropped at teardown.
+        assert SessionLocal.registry.has()
+    assert not SessionLocal.registry.has()
+
+
+def test_pool_metrics(client):
+    client.get('/')
+    response = client.get('/metrics/pool')
+    assert response.status_code == 200
+    payload = response.get_json()
+    assert payload['pools']['read']['checkouts'] >= 1
+    assert 'checkedout' in payload['pools']['read']
+
+
+def test_view_rewrites_cid_images_to_cached_inline_endpoint(client):
+    from app import Attachment, Email, session_scope
+
+    with session_scope(write=True) as session:
+        email_record = Email(
+            message_id=f'cid-{uuid.uuid4()}',
+            subject='Newsletter',
+            body='<p><img src="cid:logo@example"></p>',
+        )
+        email_record.attachments.append(
+            Attachment(filename='logo.png', content_type='image/png', data=b'\x89PNG', size=4,
+                       content_id='<logo@example>', is_inline=True)
+        )
+        session.add(email_record)
+        session.flush()
+        email_id = email_record.id
+        attachment_id = email_record.attachments[0].id
+
+    page = client.get(f'/view/{email_id}').get_data(as_text=True)
+    digest = hashlib.sha256(b'\x89PNG').hexdigest()
+    inline_url = f'/attachments/{attachment_id}/inline/{digest}'
+    assert f'src="{inline_url}"' in page
+
+    response = client.get(inline_url)
+    assert response.status_code == 200
+    assert response.data == b'\x89PNG'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'attachment' not in response.headers.get('Content-Disposition', '')
+
+    cached = client.get(inline_url, headers={'If-None-Match': response.headers['ETag']})
+    assert cached.status_code == 304
+    # The ETag and URL follow the content, so another row's bytes never match them.
+    assert client.get(f'/attachments/{attachment_id}/inline/{"0" * 64}').status_code == 404
+    redirected = client.get(f'/attachments/{attachment_id}/inline')
+    assert redirected.status_code == 302 and redirected.location.endswith(inline_url)
+
+
+def test_download_all_emails_renders_each_email(client):
+    from app import Attachment, Email, session_scope
+
+    subject = f'Export {uuid.uuid4().hex[:8]}'
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'export-{subject}', subject=subject, recipients='b@example.com', body='hi')
+        email_record.attachments.append(Attachment(filename='a.txt', data=b'alpha', size=5))
+        session.add(email_record)
+
+    response = client.get('/download-all-emails')
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zipf:
+        names = zipf.namelist()
+    assert f'to_b@example.com - {subject} - Unknown_Date.html' in names
+    assert f'to_b@example.com - {subject} - Unknown_Date_attachments/a.txt' in names
+
+
+def zip_names(response):
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zipf:
+        return zipf.namelist()
+
+
+def test_incremental_and_filtered_export(client):
+    from app import Email, session_scope
+
+    tag = uuid.uuid4().hex[:8]
+    export_name = f'daily-{tag}'
+
+    def add_email(subject, sender, folder='Inbox'):
+        with session_scope(write=True) as session:
+            session.add(Email(message_id=f'{tag}-{subject}', subject=subject, sender=sender,
+                              recipients='b@example.com', folder=folder, body='hi'))
+
+    add_email(f'first {tag}', f'alice-{tag}@example.com')
+    add_email(f'sent {tag}', f'bob-{tag}@example.com', folder='Sent Items')
+
+    names = zip_names(client.get(f'/download-all-emails?sender=alice-{tag}'))
+    assert names == [f'to_b@example.com - first {tag} - Unknown_Date.html']
+
+    names = zip_names(client.get(f'/download-all-emails?folder=sent items&sender={tag}'))
+    assert names == [f'to_b@example.com - sent {tag} - Unknown_Date.html']
+
+    first_run = zip_names(client.get(f'/download-all-emails?since=last&name={export_name}&sender={tag}'))
+    assert len(first_run) == 2
+    assert zip_names(client.get(f'/download-all-emails?since=last&name={export_name}&sender={tag}')) == []
+
+    add_email(f'second {tag}', f'alice-{tag}@example.com')
+    names = zip_names(client.get(f'/download-all-emails?since=last&name={export_name}&sender={tag}'))
+    assert names == [f'to_b@example.com - second {tag} - Unknown_Date.html']
+
+    exports = client.get('/exports').get_json()['exports']
+    assert [run['email_count'] for run in exports if run['name'] == export_name] == [1, 0, 2]
+
+
+def test_incremental_export_resumes_by_id_not_created_at(client, monkeypatch):
+    from datetime import datetime, timedelta
+
+    import pytz
+
+    import app as app_module
+    from app import Email, session_scope
+
+    tag = uuid.uuid4().hex[:8]
+    url = f'/download-all-emails?since=last&name=ids-{tag}&sender={tag}'
+
+    def add_email(subject, **fields):
+        with session_scope(write=True) as session:
+            session.add(Email(message_id=f'{tag}-{subject}', subject=subject, sender=f'{tag}@example.com',
+                              recipients='b@example.com', body='hi', **fields))
+
+    add_email('first')
+    assert len(zip_names(client.get(url))) == 1
+    # Committed after the export, but stamped earlier: a created_at watermark skips it.
+    add_email('late', created_at=datetime.now(pytz.UTC) - timedelta(hours=1))
+    assert zip_names(client.get(url)) == ['to_b@example.com - late - Unknown_Date.html']
+
+    # With an overlap window, emails already exported are not exported again.
+    monkeypatch.setattr(app_module, 'export_id_overlap', lambda: 1000)
+    add_email('third')
+    assert zip_names(client.get(url)) == ['to_b@example.com - third - Unknown_Date.html']
+    assert zip_names(client.get(url)) == []
+
+
+def test_export_finishes_while_the_writer_is_busy(client):
+    from app import Email, session_scope
+
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        session.add(Email(message_id=f'busy-{tag}', subject=f'busy {tag}', sender=f'busy-{tag}@example.com'))
+
+    response = client.get(f'/download-all-emails?name=busy-{tag}&sender=busy-{tag}', buffered=False)
+    holding, body_sent = threading.Event(), threading.Event()
+
+    def busy_writer():
+        # Holds the only writer connection until the body is sent.
+        with session_scope(write=True) as session:
+            session.add(Email(message_id=f'busy-{tag}-writer', subject='writer'))
+            session.flush()
+            holding.set()
+            body_sent.wait(30)
+
+    writer = threading.Thread(target=busy_writer)
+    writer.start()
+    assert holding.wait(10)
+    started = time.perf_counter()
+    try:
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as zipf:
+            assert len(zipf.namelist()) == 1
+        assert time.perf_counter() - started < 5
+    finally:
+        body_sent.set()
+        writer.join()
+
+    runs = [run for run in client.get('/exports').get_json()['exports'] if run['name'] == f'busy-{tag}']
+    assert [run['email_count'] for run in runs] == [1] and runs[0]['completed_at']
+
+
+def test_export_rejects_invalid_dates(client):
+    response = client.get('/download-all-emails?start=yesterday')
+    assert response.status_code == 400
+
+
+def test_attachment_aggregates_are_maintained_and_backfilled(client):
+    from app import Attachment, Base, Email, backfill_attachment_aggregates, session_scope
+
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'agg-{tag}', subject=f'Invoice {tag}', body='see attached')
+        email_record.attachments.append(Attachment(filename='a.pdf', data=b'12345'))
+        email_record.attachments.append(Attachment(filename='b.pdf', data=b'123', size=3))
+        session.add(email_record)
+
+    result = client.get(f'/search?query={tag}').get_json()['results'][0]
+    assert result['attachment_count'] == 2
+    assert result['attachment_total_bytes'] == 8
+
+    legacy_engine = create_engine('sqlite://')
+    Base.metadata.create_all(legacy_engine)
+    with legacy_engine.begin() as connection:
+        connection.execute(text("INSERT INTO emails (id, subject) VALUES (1, 'legacy')"))
+        connection.execute(text("INSERT INTO attachments (email_id, data) VALUES (1, x'00112233')"))
+    assert backfill_attachment_aggregates(legacy_engine) == 1
+    with legacy_engine.connect() as connection:
+        row = connection.execute(text("SELECT attachment_count, attachment_total_bytes FROM emails")).one()
+    assert tuple(row) == (1, 4)
+
+
+def test_search_results_are_cached_until_ingest_commits(client):
+    from sqlalchemy import event
+
+    from app import Email, engine, search_cache, session_scope
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        for number in range(3):
+            session.add(Email(message_id=f'cache-{tag}-{number}', subject=f'PO {tag} #{number}'))
+
+    first = client.get(f'/search?query=  {tag.upper()} &limit=2').get_json()
+    assert len(first['results']) == 2
+    assert search_cache.get((tag, None, 2, 0, False)) == first
+
+    statements = []
+    with patch('app.session_scope') as mock_scope:
+        event.listen(engine, 'before_cursor_execute', record_statement)
+        try:
+            assert client.get(f'/search?query={tag}&limit=2').get_json() == first
+        finally:
+            event.remove(engine, 'before_cursor_execute', record_statement)
+    mock_scope.assert_not_called()
+    # The hit costs one lookup of the generation counter and nothing else.
+    assert len(statements) == 1 and 'change_counters' in statements[0]
+    assert len(client.get(f'/search?query={tag}&limit=2&offset=2').get_json()['results']) == 1
+
+    with session_scope(write=True) as session:
+        session.add(Email(message_id=f'cache-{tag}-new', subject=f'PO {tag} #new'))
+    assert search_cache.get((tag, None, 2, 0, False)) is None
+    assert len(client.get(f'/search?query={tag}').get_json()['results']) == 4
+    assert client.get(f'/search?query={tag}&offset=-1').status_code == 400
+
+
+def test_search_cache_sees_writes_from_other_processes(client):
+    from sqlalchemy.orm import sessionmaker
+
+    from app import DATABASE_URL, Email, search_cache
+    from models import mark_search_changed
+
+    tag = uuid.uuid4().hex[:8]
+    # Writers in other processes (bulk_import.py, retention.py, a second
+    # waitress process) never reach this process's cache directly.
+    other_engine = create_engine(DATABASE_URL)
+    OtherSession = sessionmaker(bind=other_engine)
+    assert client.get(f'/search?query={tag}').get_json()['results'] == []
+    assert search_cache.get((tag, None, None, 0, False)) is not None
+
+    script = (
+        "import sys; from sqlalchemy import create_engine; from sqlalchemy.orm import Session; "
+        "from models import Email; "
+        "session = Session(create_engine(sys.argv[1])); "
+        "session.add(Email(message_id='other-' + sys.argv[2], subject='Other ' + sys.argv[2])); "
+        "session.commit()"
+    )
+    subprocess.run([sys.executable, '-c', script, DATABASE_URL, tag], cwd=PROJECT_ROOT, check=True)
+    assert search_cache.get((tag, None, None, 0, False)) is None
+    assert len(client.get(f'/search?query={tag}').get_json()['results']) == 1
+
+    with OtherSession.begin() as session:
+        session.execute(text("UPDATE emails SET subject = 'gone' WHERE message_id = :id"), {'id': f'other-{tag}'})
+        mark_search_changed(session)
+    assert client.get(f'/search?query={tag}').get_json()['results'] == []
+
+    generation = search_cache.generation
+    with OtherSession() as session:
+        session.add(Email(message_id=f'rolled-back-{tag}', subject=f'Other {tag}'))
+        session.flush()
+        session.rollback()
+    assert search_cache.generation == generation
+    other_engine.dispose()
+
+
+def test_cached_pages_work_on_a_database_without_change_counters(client, monkeypatch):
+    import app as app_module
+    from app import Email, session_scope, writer_engine
+
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'legacy-{uuid.uuid4().hex}', subject='Legacy counters')
+        session.add(email_record)
+        session.flush()
+        email_id = email_record.id
+    # A database from before change_counters, opened by a freshly imported app.
+    with writer_engine.begin() as connection:
+        connection.execute(text("DROP TABLE change_counters"))
+    monkeypatch.setattr(app_module, '_db_initialized', False)
+
+    assert client.get('/search?query=legacy counters').status_code == 200
+    assert client.get(f'/view/{email_id}').status_code == 200
+    assert 'change_counters' in inspect(writer_engine).get_table_names()
+
+
+def test_search_is_partitioned_by_account(client):
+    from app import Email, ensure_database_schema, session_scope
+
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        session.add(Email(message_id=f'acct-{tag}', subject=f'Order {tag}'))
+        session.add(Email(message_id=f'acct-{tag}', account_id='sales', subject=f'Order {tag}'))
+
+    assert len(client.get(f'/search?query={tag}').get_json()['results']) == 2
+    results = client.get(f'/search?query={tag}&account=sales').get_json()['results']
+    assert [result['account_id'] for result in results] == ['sales']
+
+    legacy_engine = create_engine('sqlite://')
+    with legacy_engine.begin() as connection:
+        connection.execute(text("CREATE TABLE emails (id INTEGER PRIMARY KEY, message_id VARCHAR(255), subject TEXT)"))
+        connection.execute(text("CREATE UNIQUE INDEX ix_emails_message_id ON emails (message_id)"))
+        connection.execute(text("INSERT INTO emails (message_id) VALUES ('m-1')"))
+    ensure_database_schema(legacy_engine)
+    with legacy_engine.begin() as connection:
+        assert connection.execute(text("SELECT account_id FROM emails")).scalar() == 'default'
+        connection.execute(text("INSERT INTO emails (message_id, account_id) VALUES ('m-1', 'ops')"))
+    assert 'ux_emails_account_message' in {index['name'] for index in inspect(legacy_engine).get_indexes('emails')}
+
+
+# Cumulative `-X importtime` budget for `import app`, in microseconds.
+IMPORT_BUDGET_US = int(os.getenv('IMPORT_BUDGET_US', '1000000'))
+
+
+def test_import_is_lazy_and_within_budget(tmp_path):
+    import subprocess
+
+    script = (
+        "import sys, app\n"
+        "assert 'exchangelib' not in sys.modules, 'exchangelib imported eagerly'\n"
+        "assert not app._db_initialized, 'database initialized at import'\n"
+    )
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', script],
+        cwd=tmp_path,
+        env={**os.environ, 'PYTHONPATH': str(PROJECT_ROOT), 'DATABASE_URL': f'sqlite:///{tmp_path}/cold.db'},
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert list(tmp_path.iterdir()) == []
+
+    app_line = next(line for line in result.stderr.splitlines() if line.rstrip().endswith('| app'))
+    cumulative_us = int(app_line.split('|')[1])
+    assert cumulative_us < IMPORT_BUDGET_US
+
+
+def test_api_emails_streams_ndjson_with_field_selection(client):
+    import json
+
+    from app import Attachment, Email, session_scope
+
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        for number in range(3):
+            email_record = Email(message_id=f'api-{tag}-{number}', account_id=f'api-{tag}',
+                                 subject=f'API {number}', body='secret body')
+            if number == 0:
+                email_record.attachments.append(Attachment(filename='a.txt', data=b'alpha'))
+            session.add(email_record)
+
+    response = client.get(f'/api/emails?account=api-{tag}&fields=subject,attachments')
+    assert response.status_code == 200
+    assert response.is_streamed and response.mimetype == 'application/x-ndjson'
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [record['subject'] for record in records] == ['API 0', 'API 1', 'API 2']
+    assert set(records[0]) == {'id', 'subject', 'attachments'}
+    assert [(a['filename'], a['size']) for a in records[0]['attachments']] == [('a.txt', 5)]
+
+    resumed = client.get(f"/api/emails?account=api-{tag}&after_id={records[0]['id']}&limit=1")
+    lines = resumed.get_data(as_text=True).splitlines()
+    assert len(lines) == 1 and 'body' not in json.loads(lines[0])
+
+    assert client.get(f'/api/emails?account=api-{tag}&created_after=2999-01-01').get_data() == b''
+    assert client.get('/api/emails?fields=password').status_code == 400
+    assert client.get('/api/emails?received_after=yesterday').status_code == 400
+
+
+def test_mbox_and_eml_exports_are_reimportable(client, tmp_path):
+    from app import Attachment, Email, session_scope
+    from bulk_import import iter_mbox_messages, parse_message_bytes
+
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'<mime-{tag}@example.com>', subject=f'Mime {tag}', sender='a@example.com',
+                             recipients='b@example.com', body='<p>Hello</p>\nFrom the warehouse')
+        email_record.attachments.append(Attachment(filename='scan.pdf', content_type='application/pdf',
+                                                   data=b'%PDF-1.4' * 200))
+        session.add(email_record)
+
+    response = client.get('/download-all-emails?format=mbox&sender=a@example.com&recipient=b@example.com')
+    assert response.mimetype == 'application/mbox'
+    data = response.get_data()
+    assert b'\n>From the warehouse' in data
+    (tmp_path / 'export.mbox').write_bytes(data)
+    parsed = [parse_message_bytes(raw) for raw in iter_mbox_messages(str(tmp_path / 'export.mbox'), 0, len(data))]
+    record = next(record for record in parsed if record[0] == f'<mime-{tag}@example.com>')
+    assert record[5].strip() == '<p>Hello</p>\nFrom the warehouse'
+    assert record[7] == [('scan.pdf', 'application/pdf', b'%PDF-1.4' * 200, None, False)]
+
+    response = client.get('/download-all-emails?format=eml&sender=a@example.com&recipient=b@example.com')
+    with zipfile.ZipFile(io.BytesIO(response.data)) as zipf:
+        entry = next(info for info in zipf.infolist() if f'Mime {tag}' in info.filename)
+        assert entry.filename.endswith('.eml') and entry.compress_type == zipfile.ZIP_STORED
+        assert parse_message_bytes(zipf.read(entry))[1] == f'Mime {tag}'
+
+    assert client.get('/download-all-emails?format=pst').status_code == 400
+
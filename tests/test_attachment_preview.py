@@ -0,0 +1,143 @@
+# tests/test_attachment_preview.py
+
+import hashlib
+import io
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+import attachment_preview
+from attachment_preview import generate_pending
+from models import Attachment, AttachmentPreview, AttachmentText, Base, Email
+from test_attachment_text import make_pdf, needs_pypdf
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_sessions():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    return Session, Session()
+
+
+@needs_pypdf
+def test_text_previews_are_built_once_per_hash(monkeypatch):
+    monkeypatch.setattr(attachment_preview, 'PREVIEW_TEXT_CHARS', 10)
+    monkeypatch.setattr(attachment_preview, 'pillow_available', lambda: False)
+    Session, session = make_sessions()
+    pdf = make_pdf(b'BT /F1 12 Tf 72 720 Td (Quote Q-12345 for 40 units) Tj ET')
+    for index in range(2):
+        email_record = Email(message_id=f'p-{index}', subject='Fwd: quote')
+        email_record.attachments.extend([
+            Attachment(filename='quote.pdf', content_type='application/pdf', data=pdf),
+            Attachment(filename='notes.txt', content_type='text/plain', data=b'call back'),
+            Attachment(filename='logo.png', content_type='image/png', data=b'\x89PNG'),
+            Attachment(filename='blob.bin', data=b'\x00\x01'),
+        ])
+        session.add(email_record)
+    # Text already extracted for search is reused rather than extracted again.
+    session.add(AttachmentText(content_hash=sha256(b'call back'), extractor='text', text='cached text'))
+    session.commit()
+
+    assert generate_pending(Session, Session, max_workers=1) == 3
+    previews = {row.kind + ':' + (row.data or b'').decode(): row for row in session.query(AttachmentPreview)}
+    assert set(previews) == {'text:Quote Q-12', 'text:cached tex', 'unsupported:'}
+    # Without Pillow images stay pending until it is installed.
+    monkeypatch.setattr(attachment_preview, 'pillow_available', lambda: True)
+    monkeypatch.setattr(attachment_preview, 'render_thumbnail', lambda data: ('image/png', b'thumb', 1, 1))
+    assert generate_pending(Session, Session, max_workers=1) == 1
+    assert generate_pending(Session, Session, max_workers=1) == 0
+
+
+def test_without_pillow_or_pypdf_previews_wait(monkeypatch):
+    # The imports themselves fail, as on an install without the packages.
+    monkeypatch.setitem(sys.modules, 'PIL', None)
+    monkeypatch.setitem(sys.modules, 'pypdf', None)
+    assert not attachment_preview.pillow_available()
+    Session, session = make_sessions()
+    email_record = Email(message_id='no-pillow', subject='Photos')
+    email_record.attachments.extend([
+        Attachment(filename='site.jpg', content_type='image/jpeg', data=b'\xff\xd8\xff'),
+        Attachment(filename='quote.pdf', content_type='application/pdf', data=b'%PDF-1.4'),
+        Attachment(filename='notes.txt', content_type='text/plain', data=b'call back'),
+    ])
+    session.add(email_record)
+    session.commit()
+
+    assert generate_pending(Session, Session, max_workers=1) == 1
+    assert [row.kind for row in session.query(AttachmentPreview)] == ['text']
+
+
+def test_render_thumbnail_downscales_images():
+    Image = pytest.importorskip('PIL.Image')
+    buffer = io.BytesIO()
+    Image.new('RGB', (1200, 600), 'red').save(buffer, 'PNG')
+
+    content_type, data, width, height = attachment_preview.render_thumbnail(buffer.getvalue(), size=100)
+    assert (content_type, width, height) == ('image/jpeg', 100, 50)
+    assert Image.open(io.BytesIO(data)).size == (100, 50)
+
+
+def test_preview_endpoint_serves_cacheable_previews():
+    from app import app, session_scope
+
+    data = f'preview {uuid.uuid4().hex}'.encode()
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'preview-{uuid.uuid4().hex}', subject='Preview')
+        email_record.attachments.append(Attachment(filename='a.txt', content_type='text/plain', data=data,
+                                                   content_hash=sha256(data)))
+        session.add(email_record)
+        session.flush()
+        attachment_id, email_id = email_record.attachments[0].id, email_record.id
+
+    with app.test_client() as client:
+        preview_url = f'/previews/{sha256(data)}'
+        assert client.get(preview_url).status_code == 404
+        with session_scope(write=True) as session:
+            session.add(AttachmentPreview(content_hash=sha256(data), kind='text',
+                                          content_type='text/plain; charset=utf-8', data=data))
+
+        redirected = client.get(f'/attachments/{attachment_id}/preview')
+        assert redirected.status_code == 302 and redirected.location.endswith(preview_url)
+        response = client.get(preview_url)
+        assert response.status_code == 200 and response.data == data
+        assert response.cache_control.immutable and sha256(data) in response.headers['ETag']
+        cached = client.get(preview_url, headers={'If-None-Match': response.headers['ETag']})
+        assert cached.status_code == 304
+        assert client.get('/previews/not-a-hash').status_code == 404
+
+        listed = client.get(f'/list-attachments/{email_id}').get_json()['attachments']
+        assert listed[0]['preview'] == preview_url
+
+
+def test_previews_are_rendered_without_holding_the_writer(monkeypatch):
+    from app import session_scope, writer_engine
+
+    checked_out = []
+
+    def render(data, size=None):
+        checked_out.append(writer_engine.pool.checkedout())
+        return 'image/png', b'thumb', 1, 1
+
+    monkeypatch.setattr(attachment_preview, 'pillow_available', lambda: True)
+    monkeypatch.setattr(attachment_preview, 'render_thumbnail', render)
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'thumb-{uuid.uuid4().hex}', subject='Photo')
+        email_record.attachments.append(Attachment(filename='site.png', data=uuid.uuid4().bytes))
+        session.add(email_record)
+
+    assert generate_pending(session_scope, lambda: session_scope(write=True), max_workers=1) >= 1
+    assert checked_out and set(checked_out) == {0}
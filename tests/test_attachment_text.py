@@ -0,0 +1,218 @@
+# tests/test_attachment_text.py
+
+import io
+import os
+import sys
+import time
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+import attachment_text
+from attachment_text import classify, decode_text, extract_pending, extract_text, pdf_supported
+from models import Attachment, AttachmentText, Base, Email
+
+
+def make_pdf(content, font=b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>', extra_objects=()):
+    """A one-page PDF drawing content (text operators) with font as /F1."""
+    stream = zlib.compress(content)
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 5 0 R >> >> '
+        b'/Contents 4 0 R >>',
+        b'<< /Length ' + str(len(stream)).encode() + b' /Filter /FlateDecode >>\nstream\n' + stream
+        + b'\nendstream',
+        font,
+        *extra_objects,
+    ]
+    pdf = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(pdf)
+
+
+def make_cid_pdf(text):
+    """A PDF as Word writes it: a Type0 font, glyph ids in hex strings, a ToUnicode map."""
+    glyphs = {char: 3 + index for index, char in enumerate(sorted(set(text)))}
+    cmap = (
+        '/CIDInit /ProcSet findresource begin 12 dict begin begincmap\n'
+        '/CMapName /Adobe-Identity-UCS def /CMapType 2 def\n'
+        '1 begincodespacerange <0000> <FFFF> endcodespacerange\n'
+        f'{len(glyphs)} beginbfchar\n'
+        + ''.join(f'<{glyph:04X}> <{ord(char):04X}>\n' for char, glyph in glyphs.items())
+        + 'endbfchar\nendcmap CMapName currentdict /CMap defineresource pop end end\n'
+    ).encode()
+    shown = ''.join(f'{glyphs[char]:04X}' for char in text).encode()
+    return make_pdf(
+        b'BT /F1 12 Tf 72 720 Td <' + shown + b'> Tj ET',
+        font=b'<< /Type /Font /Subtype /Type0 /BaseFont /Calibri /Encoding /Identity-H '
+             b'/DescendantFonts [6 0 R] /ToUnicode 7 0 R >>',
+        extra_objects=[
+            b'<< /Type /Font /Subtype /CIDFontType2 /BaseFont /Calibri '
+            b'/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> /DW 500 >>',
+            b'<< /Length ' + str(len(cmap)).encode() + b' >>\nstream\n' + cmap + b'\nendstream',
+        ],
+    )
+
+
+def make_docx(paragraphs):
+    body = ''.join(f'<w:p><w:r><w:t>{text}</w:t></w:r></w:p>' for text in paragraphs)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr(
+            'word/document.xml',
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body>{body}</w:body></w:document>',
+        )
+    return buffer.getvalue()
+
+
+def make_xlsx():
+    ns = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('xl/sharedStrings.xml', f'<sst {ns}><si><t>PO-7781</t></si></sst>')
+        archive.writestr(
+            'xl/worksheets/sheet1.xml',
+            f'<worksheet {ns}><sheetData><row r="1">'
+            '<c r="A1" t="s"><v>0</v></c><c r="B1"><v>125.5</v></c>'
+            '</row></sheetData></worksheet>',
+        )
+    return buffer.getvalue()
+
+
+needs_pypdf = pytest.mark.skipif(not pdf_supported(), reason='pypdf is not installed')
+
+
+def slow_upper(text):
+    time.sleep(0.01)
+    return text.upper()
+
+
+@pytest.mark.parametrize('filename, content_type, data, expected', [
+    pytest.param('quote.pdf', 'application/pdf', make_pdf(b'BT /F1 12 Tf 72 720 Td (Quote Q-12345) Tj ET'),
+                 'Quote Q-12345', marks=needs_pypdf),
+    pytest.param('quote.pdf', None, make_cid_pdf('Quote Q-99'), 'Quote Q-99', marks=needs_pypdf),
+    ('letter.docx', None, make_docx(['Dear customer', 'Quote Q-555']), 'Quote Q-555'),
+    ('order.xlsx', None, make_xlsx(), 'PO-7781 125.5'),
+    ('notes.csv', 'text/csv', b'id,quote\n1,Q-42\n', 'Q-42'),
+    ('page.html', 'text/html', b'<p>Quote&nbsp;<b>Q-1</b></p>', 'Q-1'),
+], ids=['pdf', 'pdf-cid-font', 'docx', 'xlsx', 'csv', 'html'])
+def test_extract_text(filename, content_type, data, expected):
+    extractor = classify(filename, content_type)
+    assert expected in extract_text(extractor, data)
+
+
+@needs_pypdf
+def test_extract_pending_processes_each_hash_once():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    pdf = make_pdf(b'BT /F1 12 Tf 72 720 Td (Quote Q-12345) Tj ET')
+    for index in range(3):
+        email_record = Email(message_id=f'm-{index}', subject='Fwd: quote')
+        email_record.attachments.append(Attachment(filename='quote.pdf', content_type='application/pdf', data=pdf))
+        email_record.attachments.append(Attachment(filename='logo.png', content_type='image/png', data=b'\x89PNG'))
+        session.add(email_record)
+    session.commit()
+
+    assert extract_pending(Session, Session, max_workers=2) == 2
+    assert extract_pending(Session, Session) == 0
+    texts = {row.extractor: row.text for row in session.query(AttachmentText)}
+    assert texts == {'pdf': 'Quote Q-12345', 'unsupported': ''}
+
+
+def test_pdfs_stay_pending_without_pypdf(monkeypatch):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    email_record = Email(message_id='no-pypdf', subject='Quote')
+    email_record.attachments.append(Attachment(filename='quote.pdf', data=make_pdf(b'BT (Q-1) Tj ET')))
+    email_record.attachments.append(Attachment(filename='notes.txt', data=b'Q-2'))
+    session.add(email_record)
+    session.commit()
+
+    monkeypatch.setattr(attachment_text, 'pdf_supported', lambda: False)
+    assert extract_pending(Session, Session) == 1
+    assert [row.extractor for row in session.query(AttachmentText)] == ['text']
+
+
+@needs_pypdf
+def test_search_matches_attachment_text():
+    from app import app, session_scope
+
+    quote = f'Q-{uuid.uuid4().hex[:8]}'
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'att-{quote}', subject='Your quote', body='See attached.')
+        email_record.attachments.append(
+            Attachment(filename='quote.pdf', content_type='application/pdf',
+                       data=make_cid_pdf(f'Quote {quote}'))
+        )
+        session.add(email_record)
+    extract_pending(session_scope, lambda: session_scope(write=True), max_workers=1)
+
+    with app.test_client() as client:
+        results = client.get(f'/search?query={quote}').get_json()['results']
+    assert [result['subject'] for result in results] == ['Your quote']
+    assert quote in results[0]['snippet']
+
+
+def test_extraction_does_not_hold_the_writer(monkeypatch):
+    from app import session_scope, writer_engine
+
+    checked_out = []
+
+    def extract_slowly(data):
+        # Another writer (ingest) must be able to get the connection now.
+        checked_out.append(writer_engine.pool.checkedout())
+        return decode_text(data)
+
+    monkeypatch.setitem(attachment_text.EXTRACTORS, 'text', extract_slowly)
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'writer-{uuid.uuid4().hex}', subject='Notes')
+        email_record.attachments.append(Attachment(filename='notes.txt', data=uuid.uuid4().hex.encode()))
+        session.add(email_record)
+
+    assert extract_pending(session_scope, lambda: session_scope(write=True), max_workers=1) >= 1
+    assert checked_out and set(checked_out) == {0}
+
+
+def test_run_in_pool_bounds_jobs_in_flight(monkeypatch):
+    submitted = []
+
+    class RecordingPool:
+        def __init__(self):
+            self.pool = ThreadPoolExecutor(max_workers=4)
+
+        def submit(self, function, *args):
+            submitted.append(sum(not future.done() for future in submitted_futures))
+            future = self.pool.submit(function, *args)
+            submitted_futures.append(future)
+            return future
+
+    submitted_futures = []
+    monkeypatch.setattr(attachment_text, 'get_process_pool', RecordingPool)
+    results = attachment_text.run_in_pool(slow_upper, [(f'doc{index}',) for index in range(8)], max_workers=2)
+    assert results == [f'DOC{index}' for index in range(8)]
+    assert max(submitted) <= 1
@@ -0,0 +1,106 @@
+# tests/test_bulk_import.py
+
+import os
+import sys
+from contextlib import contextmanager
+from email.message import EmailMessage
+from pathlib import Path
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+from bulk_import import deferred_indexes, import_paths, mbox_ranges, parse_message_bytes
+from models import Attachment, Base, Email, ImportedSource
+
+
+def make_message(number, attachment=False):
+    message = EmailMessage()
+    message['Message-ID'] = f'<bulk-{number}@example.com>'
+    message['Subject'] = f'Invoice {number}'
+    message['From'] = 'Billing <billing@example.com>'
+    message['To'] = 'a@example.com, B <b@example.com>'
+    message['Date'] = 'Tue, 02 Jan 2024 10:30:00 +0200'
+    message.set_content(f'Plain {number}')
+    message.add_alternative(f'<p>Invoice {number}</p>', subtype='html')
+    if attachment:
+        message.add_attachment(b'%PDF-1.4', maintype='application', subtype='pdf', filename='invoice.pdf')
+    return message.as_bytes()
+
+
+def make_session_factory():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+
+    @contextmanager
+    def session_factory():
+        session = Session()
+        try:
+            yield session
+            session.commit()
+        finally:
+            session.close()
+
+    return engine, session_factory
+
+
+def write_mbox(path, numbers):
+    with open(path, 'wb') as handle:
+        for number in numbers:
+            handle.write(b'From billing@example.com Tue Jan  2 08:30:00 2024\n')
+            handle.write(make_message(number).replace(b'\r\n', b'\n') + b'\n')
+
+
+def test_parse_message_prefers_html_and_keeps_attachments():
+    message_id, subject, sender, recipients, received, body, folder, attachments = parse_message_bytes(
+        make_message(1, attachment=True), folder='inbox'
+    )
+    assert (message_id, subject, sender) == ('<bulk-1@example.com>', 'Invoice 1', 'billing@example.com')
+    assert recipients == 'a@example.com, b@example.com'
+    assert received.isoformat() == '2024-01-02T08:30:00+00:00'
+    assert body.strip() == '<p>Invoice 1</p>'
+    assert attachments == [('invoice.pdf', 'application/pdf', b'%PDF-1.4', None, False)]
+
+
+def test_mbox_ranges_split_on_message_boundaries(tmp_path):
+    path = tmp_path / 'archive.mbox'
+    write_mbox(path, range(10))
+    ranges = mbox_ranges(str(path), chunk_bytes=700)
+    assert len(ranges) > 1
+    assert ranges[0][0] == 0 and ranges[-1][1] == path.stat().st_size
+    data = path.read_bytes()
+    assert all(data[start:start + 5] == b'From ' for start, _ in ranges)
+
+
+def test_import_is_restartable_and_skips_duplicates(tmp_path):
+    eml_dir = tmp_path / 'Sent Items'
+    eml_dir.mkdir()
+    for number in range(3):
+        (eml_dir / f'{number}.eml').write_bytes(make_message(number, attachment=number == 0))
+    write_mbox(tmp_path / 'Archive.mbox', range(2, 6))
+    (tmp_path / 'notes.txt').write_text('not mail')
+
+    engine, session_factory = make_session_factory()
+    stats = import_paths([tmp_path], session_factory, account_id='legacy', max_workers=1,
+                         batch_files=2, chunk_bytes=1000)
+    # Message 2 is in both the .eml folder and the mbox.
+    assert (stats['emails'], stats['duplicates'], stats['failed']) == (6, 1, 0)
+
+    with session_factory() as session:
+        assert session.query(Email).filter_by(account_id='legacy').count() == 6
+        assert {email.folder for email in session.query(Email)} == {'Sent Items', 'Archive'}
+        assert [a.filename for a in session.query(Attachment)] == ['invoice.pdf']
+        assert session.query(ImportedSource).count() == stats['tasks']
+
+    again = import_paths([tmp_path], session_factory, account_id='legacy', max_workers=1,
+                         batch_files=2, chunk_bytes=1000)
+    assert (again['emails'], again['tasks'], again['skipped_tasks']) == (0, 0, stats['tasks'])
+
+    with deferred_indexes(engine):
+        assert 'ix_emails_folder' not in {index['name'] for index in inspect(engine).get_indexes('emails')}
+    assert 'ix_emails_folder' in {index['name'] for index in inspect(engine).get_indexes('emails')}
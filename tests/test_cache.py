@@ -0,0 +1,109 @@
+# tests/test_cache.py
+
+import sys
+from pathlib import Path
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from cache import DiskCache, MemoryCache, RedisCache, ResultCache, create_cache
+
+
+def make_redis_cache(tmp_path):
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisCache(client=fakeredis.FakeRedis())
+
+
+@pytest.fixture(params=['memory', 'disk', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryCache()
+    if request.param == 'disk':
+        return DiskCache(str(tmp_path / 'cache.db'))
+    return make_redis_cache(tmp_path)
+
+
+def test_backend_round_trip_and_stats(backend):
+    assert backend.get('missing') is None
+    backend.set('view:1', '<html>hi</html>')
+    backend.set('search:q', {'results': [{'id': 1}]}, ttl=60)
+    assert backend.get('view:1') == '<html>hi</html>'
+    assert backend.get('search:q') == {'results': [{'id': 1}]}
+    backend.delete('view:1')
+    assert backend.get('view:1') is None
+    assert (backend.incr('counter'), backend.incr('counter'), backend.counter('counter')) == (1, 2, 2)
+
+    stats = backend.stats()
+    assert (stats['hits'], stats['misses']) == (2, 2)
+
+
+def test_result_cache_generation_is_shared_across_processes(backend):
+    # Two ResultCache objects over one backend stand in for two waitress processes.
+    first, second = ResultCache(backend, 'search'), ResultCache(backend, 'search')
+    generation = first.generation
+    first.put(('query', None, 0), ['old'], generation)
+    assert second.get(('query', None, 0)) == ['old']
+
+    second.bump()
+    assert first.get(('query', None, 0)) is None
+    first.put(('query', None, 0), ['stale'], generation)
+    assert second.get(('query', None, 0)) is None
+    first.put(('query', None, 0), ['fresh'], first.generation)
+    assert second.get(('query', None, 0)) == ['fresh']
+
+
+def test_memory_cache_evicts_by_entries_and_bytes():
+    cache = MemoryCache(max_entries=2, max_bytes=1000)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+
+    big = 'x' * 998
+    cache.set('big', big)
+    assert cache.get('big') == big and len(cache) == 1
+    cache.set('huge', 'x' * 2000)
+    assert cache.get('huge') is None
+
+
+def test_disk_cache_survives_restart(tmp_path):
+    DiskCache(str(tmp_path / 'cache.db')).set('view:7', 'kept')
+    assert DiskCache(str(tmp_path / 'cache.db')).get('view:7') == 'kept'
+
+
+def test_create_cache_falls_back_to_memory(tmp_path):
+    assert isinstance(create_cache('memory://'), MemoryCache)
+    assert isinstance(create_cache(f'sqlite:///{tmp_path}/cache.db'), DiskCache)
+    assert isinstance(create_cache(f'sqlite:///{tmp_path}/missing/dir/cache.db'), MemoryCache)
+    assert isinstance(create_cache('redis://127.0.0.1:1/0'), MemoryCache)
+
+
+def test_redis_outage_is_a_cache_miss():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    cache = RedisCache(client=fakeredis.FakeRedis(server=server))
+    cache.set('view:1', 'cached')
+    results = ResultCache(cache, 'search')
+    results.put(('q',), ['hit'], results.generation)
+
+    server.connected = False
+    assert cache.get('view:1') is None and results.get(('q',)) is None
+    cache.set('view:2', 'dropped')
+    assert results.bump() == 0
+    assert cache.stats()['errors'] == 5
+
+    server.connected = True
+    assert cache.get('view:1') == 'cached'
+
+
+def test_disk_cache_is_bounded_by_bytes(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache.db'), max_bytes=1000)
+    for number in range(10):
+        cache.set(f'view:{number}', 'x' * 200)
+    cache.set('huge', 'x' * 2000)
+    kept = [number for number in range(10) if cache.get(f'view:{number}') is not None]
+    assert cache.get('huge') is None
+    assert kept == [6, 7, 8, 9]
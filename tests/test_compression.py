@@ -0,0 +1,130 @@
+# tests/test_compression.py
+
+import gzip
+import json
+import os
+import sys
+import uuid
+import zlib
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+import compression
+from app import Attachment, Email, app, session_scope
+from compression import response_compressor
+
+GZIP = {'Accept-Encoding': 'gzip, deflate'}
+
+
+@pytest.fixture
+def client():
+    with app.test_client() as client:
+        yield client
+
+
+def add_email(body, attachments=()):
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'gzip-{uuid.uuid4().hex}', account_id='gzip', subject='Compressed',
+                             body=body)
+        email_record.attachments.extend(attachments)
+        session.add(email_record)
+        session.flush()
+        return email_record.id, [attachment.id for attachment in email_record.attachments]
+
+
+def test_views_are_compressed_once_and_served_from_cache(client):
+    email_id, _ = add_email('<table><tr><td>Quote Q-12345</td></tr></table>' * 500)
+    plain = client.get(f'/view/{email_id}')
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.headers['Vary'] == 'Accept-Encoding'
+
+    hits = response_compressor.hits
+    first = client.get(f'/view/{email_id}', headers=GZIP)
+    second = client.get(f'/view/{email_id}', headers=GZIP)
+    assert first.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(first.data) == plain.data
+    assert len(first.data) < len(plain.data) // 10
+    assert second.data == first.data and response_compressor.hits == hits + 1
+
+    identity = client.get(f'/view/{email_id}', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+    assert 'Content-Encoding' not in identity.headers
+
+
+def test_static_assets_keep_revalidating_with_a_weak_etag(client):
+    before = response_compressor.stats()
+    response = client.get('/static/css/style.css', headers=GZIP)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'].startswith('W/')
+    assert 'Accept-Ranges' not in response.headers
+    original = (PROJECT_ROOT / 'static' / 'css' / 'style.css').read_bytes()
+    assert gzip.decompress(response.data) == original
+    response.close()
+
+    # The second request is served from the compressed cache.
+    again = client.get('/static/css/style.css', headers=GZIP)
+    assert gzip.decompress(again.data) == original
+    stats = response_compressor.stats()
+    assert stats['hits'] == before['hits'] + 1
+    assert stats['bytes_in'] == before['bytes_in'] + 2 * len(original)
+    assert stats['bytes_out'] > before['bytes_out']
+
+    cached = client.get('/static/css/style.css', headers={**GZIP, 'If-None-Match': response.headers['ETag']})
+    assert cached.status_code == 304
+
+
+def test_already_compressed_attachments_are_sent_as_is(client):
+    text = b'name,quantity\nchlorine tablets,40\n' * 200
+    _, (csv_id, gz_id, pdf_id) = add_email('body', [
+        Attachment(filename='orders.csv', content_type='text/csv', data=text),
+        Attachment(filename='orders.csv.gz', content_type='text/plain', data=gzip.compress(text)),
+        Attachment(filename='quote.pdf', content_type='application/pdf', data=os.urandom(4096)),
+    ])
+
+    csv = client.get(f'/attachments/{csv_id}/download', headers=GZIP)
+    # send_file responses are compressed as they stream, never buffered.
+    assert csv.is_streamed and 'Content-Length' not in csv.headers
+    assert csv.headers['Content-Encoding'] == 'gzip' and gzip.decompress(csv.data) == text
+    for attachment_id in (gz_id, pdf_id):
+        response = client.get(f'/attachments/{attachment_id}/download', headers=GZIP)
+        assert 'Content-Encoding' not in response.headers
+        response.close()
+
+
+def test_streamed_ndjson_is_compressed_chunk_by_chunk(client):
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        for number in range(5):
+            session.add(Email(message_id=f'gzip-api-{tag}-{number}', account_id=f'gzip-{tag}', subject=f'N {number}'))
+
+    response = client.get(f'/api/emails?account=gzip-{tag}&fields=subject', headers=GZIP)
+    assert response.headers['Content-Encoding'] == 'gzip' and 'Content-Length' not in response.headers
+    lines = gzip.decompress(response.data).decode().splitlines()
+    assert [json.loads(line)['subject'] for line in lines] == [f'N {number}' for number in range(5)]
+
+
+def test_brotli_is_preferred_when_installed(client, monkeypatch):
+    # Stands in for the brotli package; only the negotiation is under test here.
+    fake = SimpleNamespace(compress=lambda data, quality: b'br:' + zlib.compress(data))
+    monkeypatch.setattr(compression, '_brotli', fake)
+    email_id, _ = add_email('<p>brotli</p>' * 500)
+
+    response = client.get(f'/view/{email_id}', headers={'Accept-Encoding': 'gzip, deflate, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert response.data.startswith(b'br:')
+    gzipped = client.get(f'/view/{email_id}', headers={'Accept-Encoding': 'br;q=0.5, gzip'})
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+
+
+def test_real_brotli_streams_decode():
+    brotli = pytest.importorskip('brotli')
+    chunks = [b'{"subject": "Quote Q-%d"}\n' % number for number in range(200)]
+    for flush_chunks in (True, False):
+        encoded = b''.join(compression.compress_stream(iter(chunks), 'br', flush_chunks=flush_chunks))
+        assert brotli.decompress(encoded) == b''.join(chunks)
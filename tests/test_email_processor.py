@@ -0,0 +1,99 @@
+# tests/test_email_processor.py
+
+import json
+import os
+import sys
+import uuid
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+import pytz
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+from email_processor import MANIFEST_NAME, ExportEngine, export_database
+
+
+def test_export_engine_writes_files_and_manifest(tmp_path):
+    with ExportEngine(tmp_path, max_workers=4) as engine:
+        engine.write_message('message-1', '<html></html>', [
+            ('message-1_attachments/a.txt', b'alpha'),
+            ('message-1_attachments/b.bin', b'\x00' * 1024),
+        ])
+
+    assert (tmp_path / 'message-1.html').read_text(encoding='utf-8') == '<html></html>'
+    assert (tmp_path / 'message-1_attachments' / 'a.txt').read_bytes() == b'alpha'
+    assert engine.stats['written'] == 3
+
+    manifest = json.loads((tmp_path / MANIFEST_NAME).read_text(encoding='utf-8'))
+    assert manifest['messages'] == ['message-1']
+    assert manifest['files']['message-1_attachments/a.txt']['size'] == 5
+
+
+def test_export_engine_resumes_and_skips_matching_files(tmp_path):
+    with ExportEngine(tmp_path) as engine:
+        engine.write_message('message-1', '<html>1</html>', [('message-1_attachments/a.txt', b'alpha')])
+
+    with ExportEngine(tmp_path) as resumed:
+        assert resumed.is_exported('message-1')
+        # Same content on disk is skipped, changed content is rewritten.
+        resumed.write_message('message-1', '<html>1</html>', [('message-1_attachments/a.txt', b'ALPHA')])
+
+    assert resumed.stats['skipped'] == 1
+    assert resumed.stats['written'] == 1
+    assert (tmp_path / 'message-1_attachments' / 'a.txt').read_bytes() == b'ALPHA'
+
+
+def test_export_database(tmp_path):
+    from app import Attachment, Base, Email
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    email_record = Email(
+        message_id='db-1',
+        subject='Quote 42',
+        sender='a@example.com',
+        recipients='b@example.com',
+        datetime_received=datetime(2024, 1, 2, 15, 30, tzinfo=pytz.UTC),
+        body='hello',
+    )
+    email_record.attachments.append(Attachment(filename='quote.pdf', data=b'%PDF', size=4))
+    session.add(email_record)
+    session.commit()
+
+    assert export_database(tmp_path, session) == 1
+    exported = sorted(path.name for path in tmp_path.iterdir())
+    assert 'to_b@example.com - Quote 42 - 01-02-2024_03-30PM.html' in exported
+    assert (tmp_path / 'to_b@example.com - Quote 42 - 01-02-2024_03-30PM_attachments' / 'quote.pdf').read_bytes() == b'%PDF'
+
+    assert export_database(tmp_path, session) == 0
+
+
+def test_workers_is_rejected_for_zip_exports(tmp_path, capsys):
+    from email_processor import main
+
+    with pytest.raises(SystemExit):
+        main(['--zip', str(tmp_path / 'out.zip'), '--workers', '2'])
+    assert '--workers does not apply to --zip' in capsys.readouterr().err
+
+
+def test_from_db_export_writes_the_zip(tmp_path):
+    from app import Email, session_scope
+    from email_processor import main
+
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        session.add(Email(message_id=f'zip-{tag}', subject=f'Zipped {tag}', recipients='b@example.com', body='hi'))
+
+    main(['--from-db', '--zip', str(tmp_path / 'out.zip'), '--output-dir', str(tmp_path / 'dir')])
+    with zipfile.ZipFile(tmp_path / 'out.zip') as zipf:
+        assert any(f'Zipped {tag}' in name for name in zipf.namelist())
+    assert not (tmp_path / 'dir').exists()
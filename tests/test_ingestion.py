@@ -0,0 +1,168 @@
+# tests/test_ingestion.py
+
+import io
+import os
+import subprocess
+import sys
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime
+from functools import cached_property
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytz
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from ingestion import (
+    EXCHANGE_SETTINGS,
+    AttachmentData,
+    DatabaseSink,
+    FilesystemSink,
+    ZipSink,
+    ingest,
+    iter_rendered_chunks,
+    load_settings,
+    store_messages,
+)
+import ingestion
+from cache import MemoryCache
+from models import Base, Email
+
+
+def make_message(message_id, subject='Quote 42'):
+    return SimpleNamespace(
+        message_id=message_id,
+        subject=subject,
+        sender='a@example.com',
+        recipients='b@example.com',
+        recipient_name='Bob',
+        datetime_received=datetime(2024, 1, 2, 15, 30, tzinfo=pytz.UTC),
+        body='<p>See <img src="cid:logo.png"></p>',
+        attachments=[AttachmentData('quote.pdf', 'application/pdf', b'%PDF-1.4')],
+    )
+
+
+def test_ingest_fans_out_to_all_sinks(tmp_path):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    archive = io.BytesIO()
+
+    messages = [make_message('m-1'), make_message('m-2', subject='Other')]
+    with DatabaseSink(session, batch_size=1) as db_sink, \
+            FilesystemSink(tmp_path) as fs_sink, \
+            ZipSink(archive) as zip_sink:
+        assert list(ingest(messages, [db_sink, fs_sink, zip_sink])) == [True, True]
+        assert list(ingest([make_message('m-1')], [db_sink])) == [False]
+
+    assert session.query(Email).count() == 2
+    assert session.query(Email).filter_by(message_id='m-1').one().attachments[0].size == 8
+
+    page = (tmp_path / 'to_Bob - Quote 42 - 01-02-2024_03-30PM.html').read_text(encoding='utf-8')
+    assert '/gpg2/to_Bob - Quote 42 - 01-02-2024_03-30PM_attachments/logo.png' in page
+    assert (tmp_path / 'to_Bob - Other - 01-02-2024_03-30PM_attachments' / 'quote.pdf').exists()
+
+    with zipfile.ZipFile(archive) as zipf:
+        assert 'to_Bob - Quote 42 - 01-02-2024_03-30PM_attachments/quote.pdf' in zipf.namelist()
+
+
+class FetchedMessage(SimpleNamespace):
+    """A message whose attachments may only be fetched while no session is open."""
+
+    @cached_property
+    def attachments(self):
+        assert not self.open_sessions, 'attachment fetched while holding a session'
+        return [AttachmentData('a.txt', 'text/plain', b'hello')]
+
+
+def test_store_messages_writes_fetched_batches_in_savepoints(tmp_path):
+    from app import configure_sqlite_engine
+
+    engine = configure_sqlite_engine(create_engine(f"sqlite:///{tmp_path / 'store.db'}"))
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    open_sessions = []
+
+    @contextmanager
+    def session_factory():
+        session = Session()
+        open_sessions.append(session)
+        try:
+            yield session
+            session.commit()
+        finally:
+            session.close()
+            open_sessions.remove(session)
+
+    def message(message_id, body='hi'):
+        return FetchedMessage(message_id=message_id, subject='Quote', sender='a@example.com',
+                              recipients='b@example.com', datetime_received=None, body=body,
+                              open_sessions=open_sessions)
+
+    # The unbindable body fails its flush; only that message is lost.
+    messages = [message('s-1'), message('s-2', body=object()), message('s-3'), message('s-1')]
+    assert store_messages(messages, session_factory, account_id='sales', batch_size=3) == 2
+    assert store_messages([message('s-2'), message('s-3')], session_factory, account_id='sales') == 1
+
+    with session_factory() as session:
+        assert sorted(email.message_id for email in session.query(Email)) == ['s-1', 's-2', 's-3']
+        assert all(email.attachment_count == 1 for email in session.query(Email))
+
+
+def test_cli_modules_import_without_side_effects(tmp_path):
+    script = (
+        "import sys, getmail, email_processor, ingestion\n"
+        "assert 'exchangelib' not in sys.modules, 'exchangelib imported eagerly'\n"
+    )
+    subprocess.run(
+        [sys.executable, '-c', script],
+        cwd=tmp_path,
+        env={**os.environ, 'PYTHONPATH': str(PROJECT_ROOT)},
+        check=True,
+    )
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_iter_rendered_chunks_matches_inline_rendering_in_order():
+    rows = [
+        (f'Subject {index}', 'a@example.com', 'b@example.com',
+         datetime(2024, 1, 2, 15, index % 60, tzinfo=pytz.UTC), f'body {index}')
+        for index in range(25)
+    ]
+    chunks = [(offset, rows[offset:offset + 4]) for offset in range(0, len(rows), 4)]
+
+    inline = list(iter_rendered_chunks(chunks, 'US/Eastern', max_workers=1))
+    small = list(iter_rendered_chunks(chunks, 'US/Eastern', max_workers=2))
+    pooled = list(iter_rendered_chunks(chunks, 'US/Eastern', max_workers=2, min_pool_rows=10))
+    assert ingestion._process_pool is not None
+
+    assert small == inline
+
+    assert pooled == inline
+    assert [key for key, _ in pooled] == [offset for offset, _ in chunks]
+    name, html = pooled[0][1][0]
+    assert name == 'to_b@example.com - Subject 0 - 01-02-2024_10-00_AM'
+    assert '<pre>body 0</pre>' in html
+
+
+def test_load_settings_is_cached_until_env_file_changes(tmp_path, monkeypatch):
+    env_path = tmp_path / '.env'
+    for name in EXCHANGE_SETTINGS:
+        monkeypatch.delenv(name, raising=False)
+    lines = [f"{name}='value'" for name in EXCHANGE_SETTINGS if name != 'DAYS_AGO']
+    env_path.write_text('\n'.join(lines + ['DAYS_AGO=2']))
+    cache = MemoryCache()
+
+    assert load_settings(str(env_path), cache)['DAYS_AGO'] == 2
+    monkeypatch.setenv('DAYS_AGO', '9')
+    assert load_settings(str(env_path), cache)['DAYS_AGO'] == 2
+    assert cache.stats()['hits'] == 1
+
+    env_path.write_text('\n'.join(lines + ['DAYS_AGO=5']))
+    os.utime(env_path, ns=(0, 10**9))
+    assert load_settings(str(env_path), cache)['DAYS_AGO'] == 5
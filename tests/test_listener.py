@@ -0,0 +1,160 @@
+# tests/test_listener.py
+
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+from ingestion import MessageData
+from listener import MailListener, load_watermark
+from models import Base, Email
+
+
+class NewMailEvent:
+    def __init__(self, watermark, item):
+        self.watermark = watermark
+        self.item_id = SimpleNamespace(id=item, changekey='ck')
+
+
+class ModifiedEvent(NewMailEvent):
+    pass
+
+
+class StatusEvent:
+    def __init__(self, watermark):
+        self.watermark = watermark
+
+
+class FakeEWS:
+    """Stands in for EWSPullClient: queued notifications and a message store."""
+
+    def __init__(self):
+        self.queue = []
+        self.subscriptions = []
+        self.fetched = []
+        self.fail_next_poll = False
+        self.reject_watermark = False
+        self.broken = set()
+
+    def subscribe(self, watermark=None):
+        if watermark is not None and self.reject_watermark:
+            raise RuntimeError('ErrorInvalidWatermark')
+        self.subscriptions.append(watermark)
+        return f'sub-{len(self.subscriptions)}', watermark or 'w0'
+
+    def events(self, subscription_id, watermark):
+        if self.fail_next_poll:
+            self.fail_next_poll = False
+            raise ConnectionError('connection reset')
+        events, self.queue = self.queue, []
+        return [SimpleNamespace(events=events, more_events=False)]
+
+    def fetch(self, item_ids):
+        for item_id in item_ids:
+            self.fetched.append(item_id.id)
+            item = SimpleNamespace(
+                id=item_id.id, message_id=f'<{item_id.id}@example>', subject=item_id.id, datetime_received=None, body='',
+                sender=SimpleNamespace(email_address='a@example.com', name='A'),
+                to_recipients=[SimpleNamespace(email_address='b@example.com', name='B')], attachments=[],
+            )
+            message = MessageData(item, folder='inbox')
+            if item_id.id in self.broken:
+                self.broken.discard(item_id.id)
+                message.body = object()
+            yield message
+
+    def unsubscribe(self, subscription_id):
+        pass
+
+
+def make_listener(ews, on_gap=None):
+    from app import process_email_item
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+
+    @contextmanager
+    def session_factory():
+        session = Session()
+        try:
+            yield session
+            session.commit()
+        finally:
+            session.close()
+
+    return MailListener(ews, session_factory, process_email_item, account_id='sales', on_gap=on_gap), Session
+
+
+def test_listener_stores_only_new_items_and_resumes_from_watermark():
+    ews = FakeEWS()
+    listener, Session = make_listener(ews)
+
+    ews.queue = [NewMailEvent('w1', 'a'), ModifiedEvent('w2', 'old'), NewMailEvent('w3', 'b'), NewMailEvent('w3', 'b')]
+    assert listener.poll_once() == 2
+    assert ews.fetched == ['a', 'b']
+    assert load_watermark(Session(), 'sales') == 'w3'
+
+    ews.queue = [StatusEvent('w4')]
+    assert listener.poll_once() == 0
+    assert load_watermark(Session(), 'sales') == 'w4'
+
+    # A dropped connection makes run() resubscribe from the stored watermark.
+    ews.fail_next_poll = True
+    ews.queue = [NewMailEvent('w5', 'c')]
+    stop = threading.Event()
+    listener.poll_interval = 0.01
+    original_poll = listener.poll_once
+
+    def poll_then_stop():
+        stored = original_poll()
+        if 'c' in ews.fetched:
+            stop.set()
+        return stored
+
+    listener.poll_once = poll_then_stop
+    listener.run(stop)
+    assert ews.subscriptions == [None, 'w4']
+    assert [email.account_id for email in Session().query(Email)] == ['sales'] * 3
+
+
+def test_listener_falls_back_when_watermark_is_rejected():
+    ews = FakeEWS()
+    gaps = []
+    listener, Session = make_listener(ews, on_gap=gaps.append)
+    ews.queue = [NewMailEvent('w1', 'a')]
+    listener.poll_once()
+
+    ews.reject_watermark = True
+    restarted = MailListener(ews, listener.session_factory, listener.handle_item, account_id='sales',
+                             on_gap=gaps.append)
+    restarted.poll_once()
+    assert ews.subscriptions == [None, None]
+    assert gaps == ['sales']
+    assert load_watermark(Session(), 'sales') == 'w0'
+
+
+def test_listener_watermark_stops_before_items_that_failed_to_store():
+    ews = FakeEWS()
+    listener, Session = make_listener(ews)
+
+    # 'bad' cannot be stored the first time; 'c' after it still is.
+    ews.broken = {'bad'}
+    ews.queue = [NewMailEvent('w1', 'a'), NewMailEvent('w2', 'bad'), NewMailEvent('w3', 'c')]
+    assert listener.poll_once() == 2
+    assert load_watermark(Session(), 'sales') == 'w1'
+
+    ews.queue = [NewMailEvent('w2', 'bad'), NewMailEvent('w3', 'c')]
+    assert listener.poll_once() == 1
+    assert load_watermark(Session(), 'sales') == 'w3'
+    assert sorted(email.subject for email in Session().query(Email)) == ['a', 'bad', 'c']
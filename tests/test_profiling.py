@@ -0,0 +1,79 @@
+# tests/test_profiling.py
+
+import json
+import os
+import pstats
+import sys
+from pathlib import Path
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+from app import app
+from profiling import request_profiler
+
+ADMIN = {'X-Admin-Token': 'secret'}
+
+
+@pytest.fixture
+def profiler(tmp_path, monkeypatch):
+    monkeypatch.setattr(request_profiler, 'profile_dir', str(tmp_path))
+    monkeypatch.setattr(request_profiler, 'admin_token', 'secret')
+    monkeypatch.setattr(request_profiler, 'slow_ms', 0)
+    monkeypatch.setattr(request_profiler, 'armed', {})
+    return request_profiler
+
+
+def get(client, url, **kwargs):
+    response = client.get(url, **kwargs)
+    response.get_data()
+    response.close()
+    return response
+
+
+def test_admin_endpoints_need_the_token(profiler, monkeypatch):
+    with app.test_client() as client:
+        assert client.get('/admin/profiles').status_code == 403
+        assert client.get('/admin/profiles', headers=ADMIN).get_json() == {'profiles': []}
+        monkeypatch.setattr(profiler, 'admin_token', None)
+        assert client.get('/admin/profiles', headers=ADMIN).status_code == 404
+
+
+def test_requested_profile_is_saved_with_ranked_sql(profiler, tmp_path):
+    with app.test_client() as client:
+        # Without the admin token the header is ignored.
+        assert 'X-Profile-Id' not in get(client, '/accounts', headers={'X-Profile': 'cprofile'}).headers
+
+        response = get(client, '/accounts', headers={**ADMIN, 'X-Profile': 'cprofile'})
+        name = response.headers['X-Profile-Id']
+        summary = json.loads((tmp_path / f'{name}.json').read_text())
+        assert (summary['endpoint'], summary['mode'], summary['reason']) == ('list_accounts', 'cprofile', 'requested')
+        assert summary['sql_count'] >= 1
+        assert 'FROM emails' in summary['sql'][0]['statement']
+        assert pstats.Stats(str(tmp_path / f'{name}.prof')).total_calls > 0
+
+        listed = client.get('/admin/profiles', headers=ADMIN).get_json()['profiles']
+        assert [profile['name'] for profile in listed] == [name]
+        assert client.get(f'/admin/profiles/{name}.prof', headers=ADMIN).status_code == 200
+        assert client.get('/admin/profiles/..%2Fapp.py', headers=ADMIN).status_code == 404
+
+
+def test_armed_endpoint_and_slow_requests_are_captured(profiler, tmp_path, monkeypatch):
+    with app.test_client() as client:
+        armed = client.post('/admin/profiling', headers=ADMIN,
+                            json={'endpoint': 'list_accounts', 'count': 1, 'mode': 'sample'}).get_json()
+        assert armed['armed'] == {'list_accounts': {'remaining': 1, 'mode': 'sample'}}
+        assert client.post('/admin/profiling', headers=ADMIN, json={'endpoint': 'nope'}).status_code == 400
+
+        assert 'X-Profile-Id' in get(client, '/accounts').headers
+        assert 'X-Profile-Id' not in get(client, '/accounts').headers
+        assert len(list(tmp_path.glob('*.collapsed'))) == 1
+
+        monkeypatch.setattr(profiler, 'slow_ms', 1e-6)
+        get(client, '/metrics/pool')
+        slow = [json.loads(path.read_text()) for path in tmp_path.glob('*.json')]
+        assert sorted(summary['reason'] for summary in slow) == ['armed', 'slow']
@@ -0,0 +1,200 @@
+# tests/test_retention.py
+
+import os
+import sqlite3
+import sys
+import uuid
+import zlib
+from contextlib import closing
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytz
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import sessionmaker
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+from models import Attachment, AttachmentText, Base, Email
+from retention import (
+    archive_emails,
+    archive_path,
+    get_archived_email,
+    list_archives,
+    open_archive,
+    purge_attachments,
+    search_archives,
+    write_archive_batch,
+)
+
+
+def make_session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def make_email(message_id, received, subject='Quarterly report', body='<p>Numbers for PO-7781</p>'):
+    email_record = Email(message_id=message_id, subject=subject, sender='a@example.com',
+                         recipients='b@example.com', datetime_received=received, body=body)
+    email_record.attachments.append(Attachment(filename='report.pdf', data=b'%PDF' * 100, content_hash='h-' + message_id))
+    return email_record
+
+
+def test_archive_moves_old_emails_into_monthly_files(tmp_path):
+    session = make_session()
+    session.add_all([
+        make_email('old-1', datetime(2020, 1, 15, tzinfo=pytz.UTC)),
+        make_email('old-2', datetime(2020, 2, 3, tzinfo=pytz.UTC)),
+        make_email('new-1', datetime.now(pytz.UTC)),
+    ])
+    session.add_all([AttachmentText(content_hash='h-old-1', text='x'), AttachmentText(content_hash='h-new-1', text='y')])
+    session.commit()
+
+    cutoff = datetime.now(pytz.UTC) - timedelta(days=365)
+    assert archive_emails(session, cutoff, tmp_path, batch_size=1) == 2
+    assert [email.message_id for email in session.query(Email)] == ['new-1']
+    assert session.query(Attachment).count() == 1
+    assert [text.content_hash for text in session.query(AttachmentText)] == ['h-new-1']
+    assert list_archives(tmp_path) == ['2020-02', '2020-01']
+
+    matches = search_archives('po-7781', tmp_path)
+    assert [(month, email['subject']) for month, email, _ in matches] == [
+        ('2020-02', 'Quarterly report'), ('2020-01', 'Quarterly report'),
+    ]
+    assert search_archives('po-7781', tmp_path, account='sales') == []
+
+    email, attachments = get_archived_email('2020-01', matches[1][1]['id'], tmp_path)
+    assert email['body'] == '<p>Numbers for PO-7781</p>'
+    assert attachments == [{'filename': 'report.pdf', 'size': 400}]
+    assert get_archived_email('../etc', 1, tmp_path) is None
+
+    # Re-running finds nothing left to move.
+    assert archive_emails(session, cutoff, tmp_path) == 0
+
+
+def test_archive_keeps_emails_whose_ids_were_reused(tmp_path):
+    session = make_session()
+    cutoff = datetime(2021, 1, 1, tzinfo=pytz.UTC)
+    for body in ('<p>first</p>', '<p>second</p>'):
+        email_record = make_email(f'reused-{body}', datetime(2020, 1, 15, tzinfo=pytz.UTC), body=body)
+        email_record.id = 7
+        session.add(email_record)
+        session.commit()
+        assert archive_emails(session, cutoff, tmp_path) == 1
+
+    matches = search_archives('', tmp_path)
+    bodies = sorted(get_archived_email('2020-01', email['id'], tmp_path)[0]['body'] for _, email, _ in matches)
+    assert bodies == ['<p>first</p>', '<p>second</p>']
+
+    # Rerunning an interrupted batch replaces the copy instead of adding one.
+    email_record = make_email('reused-again', datetime(2020, 1, 20, tzinfo=pytz.UTC))
+    email_record.id = 8
+    write_archive_batch(archive_path(tmp_path, '2020-01'), [email_record])
+    write_archive_batch(archive_path(tmp_path, '2020-01'), [email_record])
+    assert len(search_archives('', tmp_path)) == 3
+    with closing(open_archive(archive_path(tmp_path, '2020-01'))) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM attachments").fetchone() == (3,)
+
+
+def test_archive_files_without_their_own_ids_are_upgraded(tmp_path):
+    path = archive_path(tmp_path, '2019-05')
+    with closing(sqlite3.connect(path)) as connection, connection:
+        connection.execute(
+            "CREATE TABLE emails (id INTEGER PRIMARY KEY, message_id TEXT, account_id TEXT, subject TEXT, "
+            "sender TEXT, recipients TEXT, datetime_received TEXT, folder TEXT, attachment_count INTEGER, "
+            "attachment_total_bytes INTEGER, created_at TEXT, body_z BLOB)"
+        )
+        connection.execute(
+            "INSERT INTO emails (id, message_id, subject, datetime_received, body_z) VALUES (?, ?, ?, ?, ?)",
+            (3, 'legacy', 'Legacy', '2019-05-01T00:00:00+00:00', zlib.compress(b'old body')),
+        )
+
+    email_record = make_email('fresh', datetime(2019, 5, 2, tzinfo=pytz.UTC), subject='Fresh')
+    email_record.id = 3
+    write_archive_batch(path, [email_record])
+    assert get_archived_email('2019-05', 3, tmp_path)[0]['subject'] == 'Legacy'
+    assert sorted(email['subject'] for _, email, _ in search_archives('', tmp_path)) == ['Fresh', 'Legacy']
+
+
+def test_purge_attachments_by_age_or_size():
+    session = make_session()
+    now = datetime.now(pytz.UTC)
+    email_record = Email(message_id='purge-1', subject='Files')
+    email_record.attachments.extend([
+        Attachment(filename='old.txt', data=b'old', created_at=now - timedelta(days=400)),
+        Attachment(filename='big.bin', data=b'x' * 5000),
+        Attachment(filename='keep.txt', data=b'keep'),
+    ])
+    session.add(email_record)
+    session.commit()
+
+    assert purge_attachments(session) == 0
+    assert purge_attachments(session, older_than=now - timedelta(days=365), min_bytes=1000, batch_size=1) == 2
+    kept = {attachment.filename: attachment for attachment in session.query(Attachment)}
+    assert kept['old.txt'].data is None and kept['old.txt'].size == 3
+    assert kept['big.bin'].data is None
+    assert kept['keep.txt'].data == b'keep'
+    assert session.get(Email, email_record.id).attachment_total_bytes == 5007
+
+
+def test_search_includes_archive_only_on_request(tmp_path, monkeypatch):
+    import app as app_module
+    from app import app, session_scope
+
+    monkeypatch.setattr(app_module, 'ARCHIVE_DIR', str(tmp_path))
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        session.add(make_email(f'cold-{tag}', datetime(2000, 6, 1, tzinfo=pytz.UTC), subject=f'Cold {tag}'))
+
+    with app.test_client() as client:
+        assert len(client.get(f'/search?query={tag}').get_json()['results']) == 1
+        with session_scope(write=True) as session:
+            archive_emails(session, datetime(2001, 1, 1, tzinfo=pytz.UTC), tmp_path)
+
+        payload = client.get(f'/search?query={tag}').get_json()
+        assert payload['results'] == [] and 'archived_results' not in payload
+        archived = client.get(f'/search?query={tag}&include_archive=1').get_json()['archived_results']
+        assert [(item['archive'], item['subject']) for item in archived] == [('2000-06', f'Cold {tag}')]
+        page = client.get(archived[0]['view_url'])
+        assert page.status_code == 200 and f'Cold {tag}' in page.get_data(as_text=True)
+
+
+def test_download_of_purged_attachment_is_gone():
+    from app import app, session_scope
+
+    with session_scope(write=True) as session:
+        email_record = Email(message_id=f'gone-{uuid.uuid4().hex}', subject='Gone')
+        email_record.attachments.append(Attachment(filename='gone.bin', data=b'abc'))
+        session.add(email_record)
+        session.flush()
+        attachment_id = email_record.attachments[0].id
+        # What purge_attachments() does, limited to this row.
+        session.execute(update(Attachment).where(Attachment.id == attachment_id).values(data=None))
+
+    with app.test_client() as client:
+        assert client.get(f'/attachments/{attachment_id}/download').status_code == 410
+
+
+def test_view_cache_forgets_archived_emails(tmp_path):
+    from app import app, session_scope
+
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        email_record = make_email(f'view-{tag}', datetime(1999, 3, 1, tzinfo=pytz.UTC), subject=f'Archived {tag}')
+        session.add(email_record)
+        session.flush()
+        email_id = email_record.id
+
+    with app.test_client() as client:
+        assert f'Archived {tag}' in client.get(f'/view/{email_id}').get_data(as_text=True)
+        with session_scope(write=True) as session:
+            archive_emails(session, datetime(1999, 4, 1, tzinfo=pytz.UTC), tmp_path)
+            # A database without AUTOINCREMENT may hand the id to a new email.
+            session.add(Email(id=email_id, message_id=f'reuse-{tag}', subject=f'Reused {tag}'))
+
+        page = client.get(f'/view/{email_id}').get_data(as_text=True)
+        assert f'Reused {tag}' in page and f'Archived {tag}' not in page
@@ -0,0 +1,133 @@
+# tests/test_stub_ews.py
+
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+sys.path.insert(0, str(PROJECT_ROOT / 'loadtest'))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+pytest.importorskip('exchangelib')
+
+import throttle
+from accounts import AccountConfig, sync_account
+from app import app, process_email_item, session_scope
+from ingestion import connect_account
+from listener import EWSPullClient, MailListener, load_watermark, save_watermark
+from models import Email
+from run_load import percentile, regressions
+from stub_ews import StubEWSServer, SyntheticMailbox
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(messages=12, **kwargs):
+        server = StubEWSServer(mailbox=SyntheticMailbox(messages, days=2, size='medium'), **kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def sync_from(server, monkeypatch):
+    account_id = f'stub-{uuid.uuid4().hex[:8]}'
+    # Back-off waits pass on a fake clock.
+    now = [0.0]
+    controller = throttle.ThrottleController(account_id, max_rate=1000, min_rate=500, clock=lambda: now[0],
+                                             sleep=lambda seconds: now.__setitem__(0, now[0] + seconds))
+    monkeypatch.setitem(throttle._throttles, account_id, controller)
+    config = AccountConfig(account_id, 'sales@example.com', 'STUB\\svc', 'secret', server.url, days=3)
+    return account_id, controller, sync_account(config, lambda: session_scope(write=True), 'UTC')
+
+
+def test_mail_flows_from_stub_exchange_to_the_web(stub, monkeypatch):
+    server = stub()
+    account_id, _, created = sync_from(server, monkeypatch)
+    # Both folders, all within the sync window.
+    assert created == 24
+    assert server.stats()['requests']['GetAttachment'] == 12
+
+    with app.test_client() as client:
+        results = client.get(f'/search?query=%23&account={account_id}').get_json()['results']
+        assert len(results) == 24
+        view = client.get(f"/view/{results[0]['id']}")
+        assert view.status_code == 200 and b'Q-' in view.data
+        with_attachments = [r for r in results if r['attachment_count']]
+        attachments = client.get(f"/list-attachments/{with_attachments[0]['id']}").get_json()['attachments']
+        download = client.get(attachments[0]['path'])
+        assert len(download.data) == 100 * 1024
+
+
+def test_sync_rides_out_stub_throttling(stub, monkeypatch):
+    server = stub(messages=30, throttle_rate=0.3, back_off_ms=1, seed=3)
+    _, controller, created = sync_from(server, monkeypatch)
+    assert created == 60
+    assert server.stats()['throttled'] > 0
+    assert controller.stats()['retries'] == server.stats()['throttled']
+
+
+def test_listener_follows_new_mail_on_stub_exchange():
+    now = [0.0]
+    server = StubEWSServer(mailbox=SyntheticMailbox(5, days=2, size='small', arrival_rate=1.0,
+                                                    clock=lambda: now[0])).start()
+    try:
+        account_id = f'stub-{uuid.uuid4().hex[:8]}'
+        account = connect_account('sales@example.com', 'STUB\\svc', 'secret', server.url)
+
+        def start_listener(on_gap=None):
+            client = EWSPullClient(account, [account.inbox, account.sent],
+                                   throttle=throttle.ThrottleController(account_id))
+            return MailListener(client, lambda: session_scope(write=True), process_email_item,
+                                account_id=account_id, on_gap=on_gap)
+
+        listener = start_listener()
+        # Only mail that arrives after subscribing is fetched.
+        assert listener.poll_once() == 0
+        now[0] = 2.0
+        assert listener.poll_once() == 4
+        with session_scope() as session:
+            stored = session.query(Email).filter_by(account_id=account_id).all()
+            assert sorted(email.folder for email in stored) == ['Inbox', 'Inbox', 'Sent Items', 'Sent Items']
+            assert load_watermark(session, account_id) == '14'
+
+        # A restarted listener resumes from the stored watermark.
+        now[0] = 3.0
+        assert start_listener().poll_once() == 2
+        assert server.stats()['requests']['Subscribe'] == 2
+
+        # A watermark the server rejects means a fresh subscription and a gap to fill.
+        with session_scope(write=True) as session:
+            save_watermark(session, account_id, 'expired')
+        gaps = []
+        restarted = start_listener(on_gap=gaps.append)
+        assert restarted.poll_once() == 0
+        assert gaps == [account_id]
+        with session_scope() as session:
+            assert session.query(Email).filter_by(account_id=account_id).count() == 6
+            assert load_watermark(session, account_id) == '16'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_percentiles_and_regressions():
+    ordered = [float(value) for value in range(1, 101)]
+    assert (percentile(ordered, 0.5), percentile(ordered, 0.95), percentile(ordered, 0.99)) == (50, 95, 99)
+    baseline = {'endpoints': {'view': {'p95_ms': 100.0}, 'search': {'p95_ms': 50.0}}}
+    results = {'endpoints': {'view': {'p95_ms': 115.0}, 'search': {'p95_ms': 70.0}, 'download': {'p95_ms': 9.0}}}
+    assert regressions(results, baseline, tolerance=0.2) == ['search: p95 70.0 ms vs 50.0 ms']
+    results['endpoints']['download']['errors'] = 2
+    assert regressions(results, baseline, tolerance=0.2) == [
+        'search: p95 70.0 ms vs 50.0 ms', 'download: 2 errors vs 0',
+    ]
@@ -0,0 +1,104 @@
+# tests/test_suggest.py
+
+import gc
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+from models import Email
+from suggest import KIND_SENDER, PrefixIndex
+
+
+def test_prefix_index_ranks_senders_and_matches_address_parts():
+    index = PrefixIndex()
+    index.add_email('jane.smith@example.com', 'bob@example.com, smithers@corp.test', 'Smithfield quarterly report')
+    index.add_email('jane.smith@example.com', 'bob@example.com', 'Budget')
+
+    suggestions = index.suggest('smith')
+    assert suggestions[0] == ('jane.smith@example.com', 'sender')
+    assert ('smithers@corp.test', 'recipient') in suggestions
+    assert ('smithfield', 'subject') in suggestions
+    assert index.suggest('JANE') == [('jane.smith@example.com', 'sender')]
+    assert index.suggest('zzz') == []
+
+
+def test_prefix_index_is_bounded():
+    index = PrefixIndex(max_terms=1000, merge_threshold=100)
+    for number in range(5000):
+        index.add_email(None, None, f'ticket{number:05d}')
+    index.add_email('keeper@example.com', None, None)
+
+    assert len(index) <= 1000
+    assert index.suggest('keeper') == [('keeper@example.com', 'sender')]
+
+
+def test_prefix_index_lookup_is_fast():
+    index = PrefixIndex()
+    for number in range(20000):
+        index.add_email(f'user{number}@example{number % 50}.com', None, f'Invoice {number} shipment')
+    assert len(index) > 20000
+    # Settle the garbage collector so a full pass is not timed as a lookup.
+    gc.collect()
+
+    started = time.perf_counter()
+    for prefix in ('user1', 'example3', 'inv', 'ship', 'user199'):
+        assert index.suggest(prefix)
+    assert (time.perf_counter() - started) / 5 < 0.01
+
+
+def test_suggest_endpoint_sees_new_emails():
+    from app import app, build_suggest_index, session_scope
+
+    build_suggest_index()
+    tag = uuid.uuid4().hex[:8]
+    with session_scope(write=True) as session:
+        session.add(Email(message_id=f'suggest-{tag}', sender=f'typeahead{tag}@example.com', subject='Hello'))
+
+    with app.test_client() as client:
+        response = client.get(f'/suggest?q=typeahead{tag[:4]}')
+        assert response.status_code == 200
+        assert {'value': f'typeahead{tag}@example.com', 'kind': 'sender'} in response.get_json()['suggestions']
+        assert client.get('/suggest?q=').get_json() == {'suggestions': []}
+
+
+def test_prefix_index_queries_do_not_merge():
+    index = PrefixIndex(merge_threshold=1000)
+    index.add_email('jane@example.com', None, 'Budget')
+    index.add(KIND_SENDER, 'jane@example.com', ('jane',))
+    assert index.stats()['pending'] > 0
+
+    assert index.suggest('jan') == [('jane@example.com', 'sender')]
+    assert index.suggest('budg') == [('budget', 'subject')]
+    assert len(index) == 5
+    assert index.stats()['pending'] == 5 and index.stats()['terms'] == 0
+
+    for number in range(1000):
+        index.add_email(None, None, f'filler{number}')
+    assert index.stats()['pending'] < 1000
+    index.add(KIND_SENDER, 'jane@example.com', ('jane',))
+    assert index.suggest('jane') == [('jane@example.com', 'sender')]
+    assert len(index) == 1005
+
+
+def test_suggest_index_skips_rolled_back_emails():
+    from app import build_suggest_index, create_app, session_scope, suggest_index
+
+    create_app()
+    build_suggest_index()
+    tag = uuid.uuid4().hex[:8]
+    try:
+        with session_scope(write=True) as session:
+            session.add(Email(message_id=f'suggest-{tag}', sender=f'rollback{tag}@example.com'))
+            session.flush()
+            assert suggest_index.suggest(f'rollback{tag}') == []
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert suggest_index.suggest(f'rollback{tag}') == []
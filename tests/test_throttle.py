@@ -0,0 +1,142 @@
+# tests/test_throttle.py
+
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+import pytz
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///test.db')
+
+import ingestion
+from ingestion import iter_folder_messages
+from throttle import ThrottleController
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeQuery:
+    def __init__(self, folder, conditions=()):
+        self.folder = folder
+        self.conditions = conditions
+        self.page_size = None
+
+    def filter(self, **conditions):
+        return FakeQuery(self.folder, self.conditions + tuple(conditions.items()))
+
+    def order_by(self, field):
+        return self
+
+    def __iter__(self):
+        items = sorted(self.folder.items, key=lambda item: item.datetime_received, reverse=True)
+        for name, value in self.conditions:
+            if name == 'datetime_received__gte':
+                items = [item for item in items if item.datetime_received >= value]
+            elif name == 'datetime_received__lte':
+                items = [item for item in items if item.datetime_received <= value]
+        for item in items:
+            self.folder.served += 1
+            if self.folder.served in self.folder.fail_at:
+                raise self.folder.error
+            yield item
+
+
+class ThrottlingFolder:
+    """A folder whose queries raise a throttling error after the given numbers of items."""
+
+    name = 'Inbox'
+
+    def __init__(self, items, fail_at, error):
+        self.items = items
+        self.fail_at = set(fail_at)
+        self.error = error
+        self.served = 0
+
+    def filter(self, **conditions):
+        return FakeQuery(self).filter(**conditions)
+
+
+def make_items(count):
+    from exchangelib import Message
+
+    base = datetime(2024, 5, 1, tzinfo=pytz.UTC)
+    # Pairs of items share a timestamp so resuming has to skip by id.
+    return [
+        Message(id=f'item-{number}', message_id=f'<{number}@example>', subject=f'Message {number}',
+                datetime_received=base - timedelta(minutes=number // 2))
+        for number in range(count)
+    ]
+
+
+def test_folder_iteration_resumes_after_server_busy(monkeypatch):
+    from exchangelib.errors import ErrorServerBusy
+
+    monkeypatch.setattr(ingestion, 'EWS_PAGE_SIZE', 3)
+    clock = FakeClock()
+    throttle = ThrottleController('test', max_concurrency=2, max_rate=100, clock=clock, sleep=clock.sleep)
+    folder = ThrottlingFolder(make_items(10), fail_at={5, 9}, error=ErrorServerBusy('busy', back_off=30))
+
+    messages = list(iter_folder_messages(folder, datetime(2024, 1, 1, tzinfo=pytz.UTC), throttle=throttle))
+    assert [message.message_id for message in messages] == [f'<{number}@example>' for number in range(10)]
+
+    stats = throttle.stats()
+    assert (stats['throttled'], stats['retries'], stats['gave_up']) == (2, 2, 0)
+    assert stats['back_off_seconds'] == 60
+    assert clock.now >= 60
+    assert stats['rate'] < 100
+
+
+def test_folder_iteration_gives_up_after_max_retries(monkeypatch):
+    from exchangelib.errors import ErrorTooManyObjectsOpened
+
+    monkeypatch.setattr(ingestion, 'EWS_PAGE_SIZE', 3)
+    clock = FakeClock()
+    throttle = ThrottleController('test', max_retries=1, clock=clock, sleep=clock.sleep)
+    folder = ThrottlingFolder(make_items(6), fail_at=range(2, 100), error=ErrorTooManyObjectsOpened('busy'))
+
+    messages = list(iter_folder_messages(folder, datetime(2024, 1, 1, tzinfo=pytz.UTC), throttle=throttle))
+    assert [message.message_id for message in messages] == ['<0@example>']
+    assert throttle.stats()['gave_up'] == 1
+
+
+def test_controller_backs_off_and_recovers_additively():
+    clock = FakeClock()
+    throttle = ThrottleController('aimd', max_concurrency=4, max_rate=8, min_rate=1, rate_step=1,
+                                  max_retries=2, clock=clock, sleep=clock.sleep)
+
+    class ErrorServerBusy(Exception):
+        back_off = 5
+
+    attempts = []
+
+    def flaky():
+        attempts.append(clock.now)
+        if len(attempts) == 1:
+            raise ErrorServerBusy()
+        return 'ok'
+
+    assert throttle.call(flaky) == 'ok'
+    assert attempts[1] - attempts[0] >= 5
+    assert throttle.stats()['rate'] == 5
+
+    for _ in range(3):
+        throttle.call(lambda: None)
+    assert throttle.stats()['rate'] == 8
+
+    with pytest.raises(ValueError):
+        throttle.call(lambda: (_ for _ in ()).throw(ValueError('not throttling')))
+    assert throttle.stats()['throttled'] == 1
@@ -0,0 +1,173 @@
+# throttle.py
+"""
+Adaptive rate control for Exchange Web Services calls.
+
+Exchange throttles per mailbox: a busy server answers ErrorServerBusy with a
+back-off hint (in seconds), and too many open queries raise
+ErrorTooManyObjectsOpened. A ThrottleController sits in front of every EWS
+request for one account and adjusts two limits AIMD-style:
+
+- concurrency: how many requests may be in flight at once, and
+- rate: how many requests may start per second.
+
+Every successful request raises both limits additively; every throttling
+error halves them (EWS_THROTTLE_DECREASE) and pauses all callers for the
+server's back-off time. Controllers are shared per account through
+get_throttle(), and their counters are served by /metrics/throttle.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+EWS_MAX_CONCURRENCY = int(os.getenv('EWS_MAX_CONCURRENCY', '4'))
+EWS_MAX_RATE = float(os.getenv('EWS_MAX_RATE', '10'))
+EWS_MIN_RATE = float(os.getenv('EWS_MIN_RATE', '0.2'))
+EWS_RATE_STEP = float(os.getenv('EWS_RATE_STEP', '0.5'))
+EWS_THROTTLE_DECREASE = float(os.getenv('EWS_THROTTLE_DECREASE', '0.5'))
+EWS_DEFAULT_BACKOFF = float(os.getenv('EWS_DEFAULT_BACKOFF', '10'))
+EWS_MAX_BACKOFF = float(os.getenv('EWS_MAX_BACKOFF', '300'))
+EWS_MAX_RETRIES = int(os.getenv('EWS_MAX_RETRIES', '5'))
+
+# Matched by class name so callers need not import exchangelib.
+THROTTLING_ERRORS = ('ErrorServerBusy', 'ErrorTooManyObjectsOpened')
+
+
+def is_throttling_error(exc):
+    return any(cls.__name__ in THROTTLING_ERRORS for cls in type(exc).__mro__)
+
+
+def back_off_seconds(exc, default=EWS_DEFAULT_BACKOFF):
+    """The server's back-off hint for a throttling error, capped at EWS_MAX_BACKOFF."""
+    back_off = getattr(exc, 'back_off', None)
+    if not back_off or back_off <= 0:
+        back_off = default
+    return min(float(back_off), EWS_MAX_BACKOFF)
+
+
+class ThrottleController:
+    """AIMD limiter for the EWS requests of one mailbox."""
+
+    def __init__(self, name='default', max_concurrency=EWS_MAX_CONCURRENCY, max_rate=EWS_MAX_RATE,
+                 min_rate=EWS_MIN_RATE, rate_step=EWS_RATE_STEP, decrease=EWS_THROTTLE_DECREASE,
+                 max_retries=EWS_MAX_RETRIES, clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate_step = rate_step
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.clock = clock
+        self.sleep = sleep
+        self.concurrency = float(max_concurrency)
+        self.rate = max_rate
+        self._active = 0
+        self._next_start = float('-inf')
+        self._paused_until = float('-inf')
+        self._condition = threading.Condition()
+        self.counters = {'requests': 0, 'throttled': 0, 'retries': 0, 'gave_up': 0,
+                         'back_off_seconds': 0.0, 'waited_seconds': 0.0}
+
+    def acquire(self):
+        """Block until a request may start under the current limits."""
+        with self._condition:
+            while True:
+                if self._active >= max(1, int(self.concurrency)):
+                    self._condition.wait()
+                    continue
+                now = self.clock()
+                delay = max(self._paused_until, self._next_start) - now
+                if delay <= 0:
+                    break
+                self.counters['waited_seconds'] += delay
+                self._condition.release()
+                try:
+                    self.sleep(delay)
+                finally:
+                    self._condition.acquire()
+            self._active += 1
+            self._next_start = now + 1 / self.rate
+            self.counters['requests'] += 1
+
+    def release(self, exc=None):
+        with self._condition:
+            self._active -= 1
+            if exc is not None and is_throttling_error(exc):
+                self._throttled(exc)
+            elif exc is None:
+                self.rate = min(self.max_rate, self.rate + self.rate_step)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._condition.notify_all()
+
+    def _throttled(self, exc):
+        back_off = back_off_seconds(exc)
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.concurrency = max(1.0, self.concurrency * self.decrease)
+        self._paused_until = max(self._paused_until, self.clock() + back_off)
+        self.counters['throttled'] += 1
+        self.counters['back_off_seconds'] += back_off
+        logging.warning(
+            f"EWS throttled {self.name} ({type(exc).__name__}); backing off {back_off:.0f}s, "
+            f"now {self.rate:.2f} req/s and {int(self.concurrency)} concurrent"
+        )
+
+    @contextmanager
+    def slot(self):
+        """Hold one request slot; a throttling error raised inside lowers the limits."""
+        self.acquire()
+        try:
+            yield
+        except BaseException as e:
+            self.release(e)
+            raise
+        self.release()
+
+    def call(self, func, *args, **kwargs):
+        """Run func under the limits, retrying throttling errors up to max_retries times."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.slot():
+                    return func(*args, **kwargs)
+            except Exception as e:
+                if not is_throttling_error(e) or not self.retry(attempt):
+                    raise
+
+    def retry(self, attempt):
+        """Count a retry after a throttling error; False once max_retries is used up."""
+        with self._condition:
+            if attempt >= self.max_retries:
+                self.counters['gave_up'] += 1
+                return False
+            self.counters['retries'] += 1
+            return True
+
+    def stats(self):
+        with self._condition:
+            return dict(
+                self.counters,
+                rate=round(self.rate, 3),
+                concurrency=int(self.concurrency),
+                active=self._active,
+                paused_for=round(max(0.0, self._paused_until - self.clock()), 3),
+            )
+
+
+_throttles_lock = threading.Lock()
+_throttles = {}
+
+
+def get_throttle(name):
+    """The shared controller for one account."""
+    with _throttles_lock:
+        controller = _throttles.get(name)
+        if controller is None:
+            controller = _throttles[name] = ThrottleController(name)
+        return controller
+
+
+def throttle_metrics():
+    with _throttles_lock:
+        controllers = list(_throttles.values())
+    return {controller.name: controller.stats() for controller in controllers}